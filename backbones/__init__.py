@@ -1,6 +1,5 @@
-from .iresnet import iresnet18, iresnet18_1x512, iresnet34, iresnet50, iresnet100, iresnet200
-from .mobilefacenet import get_mbf
-
+import copy
+import importlib
 
 import torch
 import torch.nn as nn
@@ -29,92 +28,118 @@ class MLP_2layers(nn.Module):
         return x
 
 
+def _factory(module, name):
+    return getattr(importlib.import_module(module, __name__), name)
+
+
+def _unsupported(name, kwargs, *options):
+    """ ValueError for the activation checkpointing options a backbone would otherwise drop """
+    for option in options:
+        if kwargs.get(option):
+            raise ValueError(f"{name} does not support {option}")
+
+
+def _iresnet(module, name, checkpoint_stages=True):
+    # iresnet2060 always checkpoints layer2 and layer3 in segments, it has no per-stage option
+    def build(**kwargs):
+        _unsupported(name, kwargs, "checkpoint_interval", *(() if checkpoint_stages else ("checkpoint_stages",)))
+        kwargs = {k: v for k, v in kwargs.items() if k != "checkpoint_interval"}
+        return _factory(module, name)(False, **kwargs)
+    return build
+
+
+def _mbf(name):
+    def build(fp16=False, num_features=512, **kwargs):
+        _unsupported(name, kwargs, "checkpoint_stages", "checkpoint_interval")
+        return _factory(".mobilefacenet", name)(fp16=fp16, num_features=num_features)
+    return build
+
+
+def _vit(embed_dim, depth, drop_path_rate, mask_ratio, using_checkpoint=False):
+    def build(num_features=512, checkpoint_interval=0, **kwargs):
+        _unsupported("VisionTransformer", kwargs, "checkpoint_stages")
+        return _factory(".vit", "VisionTransformer")(
+            img_size=112, patch_size=9, num_classes=num_features, embed_dim=embed_dim, depth=depth,
+            num_heads=8, drop_path_rate=drop_path_rate, norm_layer="ln", mask_ratio=mask_ratio,
+            using_checkpoint=using_checkpoint, checkpoint_interval=checkpoint_interval)
+    return build
+
+
+# name -> builder(**kwargs), the architecture module (and timm for the ViTs) is imported by the
+# first get_model of one of its backbones, importing backbones does not import them
+MODELS = {
+    "mlp_1layer": lambda **kwargs: MLP_1layer(**kwargs),
+    "mlp_2layers": lambda **kwargs: MLP_2layers(**kwargs),
+    "r18_1x512": _iresnet(".iresnet", "iresnet18_1x512"),
+    "r18": _iresnet(".iresnet", "iresnet18"),
+    "r34": _iresnet(".iresnet", "iresnet34"),
+    "r50": _iresnet(".iresnet", "iresnet50"),
+    "r100": _iresnet(".iresnet", "iresnet100"),
+    "r200": _iresnet(".iresnet", "iresnet200"),
+    "r2060": _iresnet(".iresnet2060", "iresnet2060", checkpoint_stages=False),
+    "mbf": _mbf("get_mbf"),
+    "mbf_large": _mbf("get_mbf_large"),
+    "vit_t": _vit(256, 12, 0.1, 0.1),
+    "vit_t_dp005_mask0": _vit(256, 12, 0.05, 0.0),  # For WebFace42M
+    "vit_s": _vit(512, 12, 0.1, 0.1),
+    "vit_s_dp005_mask_0": _vit(512, 12, 0.05, 0.0),  # For WebFace42M
+    "vit_b": _vit(512, 24, 0.1, 0.1, using_checkpoint=True),
+    "vit_b_dp005_mask_005": _vit(512, 24, 0.05, 0.05, using_checkpoint=True),  # For WebFace42M
+    "vit_l_dp005_mask_005": _vit(768, 24, 0.05, 0.05, using_checkpoint=True),  # For WebFace42M
+}
+
+# former eager imports of this package, resolved on first access
+_EXPORTS = {
+    "IResNet": ".iresnet", "fuse_iresnet": ".iresnet", "iresnet18": ".iresnet", "iresnet18_1x512": ".iresnet",
+    "iresnet34": ".iresnet", "iresnet50": ".iresnet", "iresnet100": ".iresnet", "iresnet200": ".iresnet",
+    "get_mbf": ".mobilefacenet",
+}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return _factory(_EXPORTS[name], name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def register_model(name, builder):
+    """ Adds `builder(**kwargs)` as the backbone `name` of get_model """
+    MODELS[name] = builder
+    return builder
+
+
 def get_model(name, **kwargs):
+    if name not in MODELS:
+        raise ValueError(f"backbone not supported: {name}, choose from {list(MODELS)}")
+    return MODELS[name](**kwargs)
 
-    if name == "mlp_1layer":
-        return MLP_1layer(**kwargs)
-    elif name == "mlp_2layers":
-        return MLP_2layers(**kwargs)
-
-    # resnet
-    if name == "r18_1x512":
-        return iresnet18_1x512(False, **kwargs)
-    elif name == "r18":
-        return iresnet18(False, **kwargs)
-    elif name == "r34":
-        return iresnet34(False, **kwargs)
-    elif name == "r50":
-        return iresnet50(False, **kwargs)
-    elif name == "r100":
-        return iresnet100(False, **kwargs)
-    elif name == "r200":
-        return iresnet200(False, **kwargs)
-    elif name == "r2060":
-        from .iresnet2060 import iresnet2060
-        return iresnet2060(False, **kwargs)
-
-    elif name == "mbf":
-        fp16 = kwargs.get("fp16", False)
-        num_features = kwargs.get("num_features", 512)
-        return get_mbf(fp16=fp16, num_features=num_features)
-
-    elif name == "mbf_large":
-        from .mobilefacenet import get_mbf_large
-        fp16 = kwargs.get("fp16", False)
-        num_features = kwargs.get("num_features", 512)
-        return get_mbf_large(fp16=fp16, num_features=num_features)
-
-    elif name == "vit_t":
-        num_features = kwargs.get("num_features", 512)
-        from .vit import VisionTransformer
-        return VisionTransformer(
-            img_size=112, patch_size=9, num_classes=num_features, embed_dim=256, depth=12,
-            num_heads=8, drop_path_rate=0.1, norm_layer="ln", mask_ratio=0.1)
-
-    elif name == "vit_t_dp005_mask0": # For WebFace42M
-        num_features = kwargs.get("num_features", 512)
-        from .vit import VisionTransformer
-        return VisionTransformer(
-            img_size=112, patch_size=9, num_classes=num_features, embed_dim=256, depth=12,
-            num_heads=8, drop_path_rate=0.05, norm_layer="ln", mask_ratio=0.0)
-
-    elif name == "vit_s":
-        num_features = kwargs.get("num_features", 512)
-        from .vit import VisionTransformer
-        return VisionTransformer(
-            img_size=112, patch_size=9, num_classes=num_features, embed_dim=512, depth=12,
-            num_heads=8, drop_path_rate=0.1, norm_layer="ln", mask_ratio=0.1)
-    
-    elif name == "vit_s_dp005_mask_0":  # For WebFace42M
-        num_features = kwargs.get("num_features", 512)
-        from .vit import VisionTransformer
-        return VisionTransformer(
-            img_size=112, patch_size=9, num_classes=num_features, embed_dim=512, depth=12,
-            num_heads=8, drop_path_rate=0.05, norm_layer="ln", mask_ratio=0.0)
-    
-    elif name == "vit_b":
-        # this is a feature
-        num_features = kwargs.get("num_features", 512)
-        from .vit import VisionTransformer
-        return VisionTransformer(
-            img_size=112, patch_size=9, num_classes=num_features, embed_dim=512, depth=24,
-            num_heads=8, drop_path_rate=0.1, norm_layer="ln", mask_ratio=0.1, using_checkpoint=True)
-
-    elif name == "vit_b_dp005_mask_005":  # For WebFace42M
-        # this is a feature
-        num_features = kwargs.get("num_features", 512)
-        from .vit import VisionTransformer
-        return VisionTransformer(
-            img_size=112, patch_size=9, num_classes=num_features, embed_dim=512, depth=24,
-            num_heads=8, drop_path_rate=0.05, norm_layer="ln", mask_ratio=0.05, using_checkpoint=True)
-
-    elif name == "vit_l_dp005_mask_005":  # For WebFace42M
-        # this is a feature
-        num_features = kwargs.get("num_features", 512)
-        from .vit import VisionTransformer
-        return VisionTransformer(
-            img_size=112, patch_size=9, num_classes=num_features, embed_dim=768, depth=24,
-            num_heads=8, drop_path_rate=0.05, norm_layer="ln", mask_ratio=0.05, using_checkpoint=True)
-
-    else:
-        raise ValueError()
+
+class ChannelsLast(nn.Module):
+    def __init__(self, model):
+        super(ChannelsLast, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+def optimize_for_inference(model, channels_last=True, jit=False, example=None):
+    """
+    Eval-mode copy of a backbone for embedding extraction, load the weights before (the fused
+    model has other state_dict keys). IResNets get their BatchNorms folded (see
+    iresnet.fuse_iresnet), `channels_last` runs the convolutions in NHWC (not for ONNX export)
+    and `jit` freezes a TorchScript trace on `example` (default: one 112x112 image), which also
+    fuses the PReLUs with the surrounding element-wise ops.
+    """
+    from .iresnet import IResNet, fuse_iresnet
+    model = copy.deepcopy(model).eval()
+    if isinstance(model, IResNet):
+        fuse_iresnet(model)
+    if channels_last:
+        model = ChannelsLast(model.to(memory_format=torch.channels_last))
+    if jit:
+        if example is None:
+            example = torch.zeros(1, 3, 112, 112, device=next(model.parameters()).device)
+        with torch.no_grad():
+            model = torch.jit.optimize_for_inference(torch.jit.trace(model, example))
+    return model
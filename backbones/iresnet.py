@@ -1,6 +1,7 @@
 import os, sys
 import torch
 from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torch.utils.checkpoint import checkpoint
 
 __all__ = ['iresnet18', 'iresnet34', 'iresnet50', 'iresnet100', 'iresnet200']
@@ -44,6 +45,8 @@ class IBasicBlock(nn.Module):
         self.bn3 = nn.BatchNorm2d(planes, eps=1e-05,)
         self.downsample = downsample
         self.stride = stride
+        # recompute the activations of the block in the backward pass, set by IResNet(checkpoint_stages)
+        self.use_checkpoint = False
 
     def forward_impl(self, x):
         identity = x
@@ -59,7 +62,7 @@ class IBasicBlock(nn.Module):
         return out        
 
     def forward(self, x):
-        if self.training and using_ckpt:
+        if self.training and (using_ckpt or self.use_checkpoint):
             return checkpoint(self.forward_impl, x)
         else:
             return self.forward_impl(x)
@@ -69,7 +72,12 @@ class IResNet(nn.Module):
     fc_scale = 7 * 7
     def __init__(self,
                  block, layers, dropout=0, num_features=512, zero_init_residual=False,
-                 groups=1, width_per_group=64, replace_stride_with_dilation=None, fp16=False):
+                 groups=1, width_per_group=64, replace_stride_with_dilation=None, fp16=False,
+                 checkpoint_stages=()):
+        """
+        checkpoint_stages: the stages (1 to 4, layer1 to layer4) whose blocks keep only their input
+        for the backward pass and recompute the rest, trading compute for activation memory.
+        """
         super(IResNet, self).__init__()
         self.extra_gflops = 0.0
         self.fp16 = fp16
@@ -120,6 +128,17 @@ class IResNet(nn.Module):
                 if isinstance(m, IBasicBlock):
                     nn.init.constant_(m.bn2.weight, 0)
 
+        self.set_checkpoint_stages(checkpoint_stages)
+
+    def set_checkpoint_stages(self, stages):
+        stages = set(stages or ())
+        if not stages <= {1, 2, 3, 4}:
+            raise ValueError(f"checkpoint_stages should be in 1, 2, 3, 4, got {sorted(stages)}")
+        self.checkpoint_stages = stages
+        for stage, layer in enumerate((self.layer1, self.layer2, self.layer3, self.layer4), 1):
+            for block in layer:
+                block.use_checkpoint = stage in stages
+
     def _make_layer(self, block, planes, blocks, stride=1, dilate=False):
         downsample = None
         previous_dilation = self.dilation
@@ -165,6 +184,48 @@ class IResNet(nn.Module):
 
 
 
+def _bn_scale_shift(bn):
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    return scale, bn.bias - bn.running_mean * scale
+
+
+@torch.no_grad()
+def fuse_iresnet(model):
+    """
+    Inference graph of an IResNet (in place, eval mode): every BatchNorm that follows a conv is
+    folded into it (bn2/bn3 of the blocks, the downsample BN and the stem bn1), the final bn2 is
+    folded into fc (its input) and features into fc (its output).
+    The bn1 of the blocks precede a zero-padded conv, folding it would change the borders of the
+    feature maps, so it stays as a (per-channel affine) BatchNorm, and so do the PReLUs, which
+    have no linear form (see `backbones.optimize_for_inference` to let the TorchScript fuser
+    handle them).
+    """
+    model.eval()
+    model.conv1, model.bn1 = fuse_conv_bn_eval(model.conv1, model.bn1), nn.Identity()
+    for layer in (model.layer1, model.layer2, model.layer3, model.layer4):
+        for block in layer:
+            block.conv1, block.bn2 = fuse_conv_bn_eval(block.conv1, block.bn2), nn.Identity()
+            block.conv2, block.bn3 = fuse_conv_bn_eval(block.conv2, block.bn3), nn.Identity()
+            if block.downsample is not None:
+                conv, bn = block.downsample
+                block.downsample = nn.Sequential(fuse_conv_bn_eval(conv, bn))
+
+    # fc(bn2(x)): the per-channel scale and shift of bn2 repeat over the flattened positions
+    scale, shift = _bn_scale_shift(model.bn2)
+    scale = scale.repeat_interleave(model.fc_scale)
+    shift = shift.repeat_interleave(model.fc_scale)
+    fc = nn.Linear(model.fc.in_features, model.fc.out_features).to(model.fc.weight)
+    fc.weight.copy_(model.fc.weight * scale)
+    fc.bias.copy_(model.fc.bias + model.fc.weight @ shift)
+    # features(fc(x))
+    scale, shift = _bn_scale_shift(model.features)
+    fc.weight.mul_(scale[:, None])
+    fc.bias.mul_(scale).add_(shift)
+    model.fc, model.bn2, model.features = fc, nn.Identity(), nn.Identity()
+    return model
+
+
+
 
 class IBasicBlock_1D(nn.Module):
     expansion = 1
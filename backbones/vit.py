@@ -154,6 +154,7 @@ class VisionTransformer(nn.Module):
                  norm_layer: str = "ln",
                  mask_ratio = 0.1,
                  using_checkpoint = False,
+                 checkpoint_interval: int = 0,
                  ):
         super().__init__()
         self.num_classes = num_classes
@@ -166,6 +167,9 @@ class VisionTransformer(nn.Module):
             self.patch_embed = PatchEmbed(img_size=img_size, patch_size=patch_size, in_channels=in_channels, embed_dim=embed_dim)
         self.mask_ratio = mask_ratio
         self.using_checkpoint = using_checkpoint
+        # recompute the activations of one block out of every checkpoint_interval in the backward pass,
+        # 1 checkpoints every block (as using_checkpoint), 0 none
+        self.checkpoint_interval = checkpoint_interval or int(using_checkpoint)
         num_patches = self.patch_embed.num_patches
         self.num_patches = num_patches
 
@@ -259,8 +263,8 @@ class VisionTransformer(nn.Module):
         if self.training and self.mask_ratio > 0:
             x, _, ids_restore = self.random_masking(x)
 
-        for func in self.blocks:
-            if self.using_checkpoint and self.training:
+        for i, func in enumerate(self.blocks):
+            if self.training and self.checkpoint_interval > 0 and i % self.checkpoint_interval == 0:
                 from torch.utils.checkpoint import checkpoint
                 x = checkpoint(func, x)
             else:
@@ -0,0 +1,187 @@
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# CPU inference sweep over backbones, runtimes, batch sizes and threads, every configuration in a
+# fresh process (so that peak RSS and thread settings do not leak between them), e.g.:
+# python benchmark.py --networks r50 r100 --runtimes eager torchscript ort --batch-sizes 1 8 32 --threads 1 4 8
+# python benchmark.py --networks r100 --runtimes ort --batch-sizes 1 --threads 4 --preprocess --output r100.json
+# Runtimes: "eager" (training graph), "fused" (backbones.optimize_for_inference), "torchscript"
+# (fused and frozen) and "ort" (onnxruntime CPU execution provider, IO binding). The ONNX models
+# are exported by another child beforehand, so the "ort" processes only load onnxruntime and numpy
+# and their peak RSS is that of serving, not of the PyTorch export.
+
+RUNTIMES = ("eager", "fused", "torchscript", "ort")
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def load_backbone(network, weight):
+    import torch
+    from backbones import get_model
+
+    model = get_model(network, dropout=0.0, fp16=False, num_features=512)
+    if weight:
+        model.load_state_dict(torch.load(weight, map_location="cpu"))
+    return model.eval()
+
+
+def export_onnx(network, weight, path):
+    import torch
+    from backbones import optimize_for_inference
+
+    model = optimize_for_inference(load_backbone(network, weight), channels_last=False)
+    torch.onnx.export(
+        model, torch.zeros(1, 3, 112, 112), path, input_names=["data"], output_names=["feature"],
+        dynamic_axes={"data": {0: "batch"}}, opset_version=11)
+    return path
+
+
+def build_runner(config, blob):
+    runtime = config["runtime"]
+    if runtime == "ort":
+        from onnx_helper import BoundBuffers, create_session
+        session = create_session(config["onnx"], ["CPUExecutionProvider"], intra_op_threads=config["threads"])
+        buffers = BoundBuffers(session, "data", "feature", (blob.shape[3], blob.shape[2]), 512)
+
+        def run(blob):
+            inp, out, binding = buffers.next(blob.shape[0])
+            np.copyto(inp, blob)
+            buffers.run(binding)
+            return out
+        return run
+
+    import torch
+    from backbones import optimize_for_inference
+
+    torch.set_num_threads(config["threads"])
+    model = load_backbone(config["network"], config["weight"])
+    if runtime in ("eager", "fused", "torchscript"):
+        if runtime != "eager":
+            model = optimize_for_inference(model, jit=runtime == "torchscript", example=torch.from_numpy(blob))
+
+        def run(blob):
+            with torch.no_grad():
+                return model(torch.from_numpy(blob)).numpy()
+        return run
+
+    raise ValueError(f"runtime not supported: {runtime}")
+
+
+def preprocess(imgs):
+    """ uint8 BGR NHWC to the normalized RGB NCHW blob of the backbones """
+    blob = imgs[..., ::-1].transpose(0, 3, 1, 2).astype(np.float32)
+    blob -= 127.5
+    blob /= 127.5
+    return blob
+
+
+def run_config(config):
+    """ Latency percentiles (ms per batch), images/s and peak RSS of one configuration """
+    imgs = np.random.randint(0, 255, size=(config["batch_size"], 112, 112, 3), dtype=np.uint8)
+    blob = preprocess(imgs)
+    run = build_runner(config, blob)
+    for _ in range(config["warmup"]):
+        run(preprocess(imgs) if config["preprocess"] else blob)
+
+    costs = []
+    start = time.perf_counter()
+    for _ in range(config["runs"]):
+        tic = time.perf_counter()
+        run(preprocess(imgs) if config["preprocess"] else blob)
+        costs.append((time.perf_counter() - tic) * 1000)
+    elapsed = time.perf_counter() - start
+
+    result = dict(config)
+    for q in (50, 90, 99):
+        result[f"latency_p{q}_ms"] = float(np.percentile(costs, q))
+    result["images_per_sec"] = config["batch_size"] * config["runs"] / elapsed
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def print_table(results):
+    columns = ["network", "runtime", "batch_size", "threads",
+               "latency_p50_ms", "latency_p90_ms", "latency_p99_ms", "images_per_sec", "peak_rss_mb"]
+    rows = [[("%.2f" % r[c]) if isinstance(r.get(c), float) else str(r.get(c, "-")) for c in columns]
+            for r in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print("  ".join(c.rjust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(v.rjust(w) for v, w in zip(row, widths)))
+    for r in results:
+        if "error" in r:
+            print("%s %s batch %d threads %d failed: %s" % (
+                r["network"], r["runtime"], r["batch_size"], r["threads"], r["error"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU inference latency/throughput sweep')
+    parser.add_argument('--networks', type=str, nargs='+', default=["r50"], help="get_model names")
+    parser.add_argument('--runtimes', type=str, nargs='+', default=["eager", "torchscript", "ort"], choices=RUNTIMES)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--threads', type=int, nargs='+', default=[os.cpu_count()])
+    parser.add_argument('--weight', type=str, default=None, help="backbone weights, random if not given")
+    parser.add_argument('--preprocess', action='store_true', help="include the uint8 to float preprocessing")
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--output', type=str, default=None, help="JSON results")
+    parser.add_argument('--config', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--export', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.config is not None:
+        # one configuration, run by the sweep in a child process
+        print(json.dumps(run_config(json.loads(args.config))))
+        sys.exit(0)
+    if args.export is not None:
+        export_onnx(**json.loads(args.export))
+        sys.exit(0)
+
+    def child_run(flag, value):
+        """ (stdout, error) of this script run with `flag` in a child process """
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), flag, json.dumps(value)],
+                               capture_output=True, text=True)
+        if child.returncode == 0:
+            return child.stdout, None
+        return None, child.stderr.strip().splitlines()[-1] if child.stderr.strip() else "failed"
+
+    results = []
+    onnx_files = {}
+    workdir = tempfile.mkdtemp()
+    for network, runtime, batch_size, threads in itertools.product(
+            args.networks, args.runtimes, args.batch_sizes, args.threads):
+        config = {"network": network, "runtime": runtime, "batch_size": batch_size, "threads": threads,
+                  "weight": args.weight, "preprocess": args.preprocess, "warmup": args.warmup, "runs": args.runs}
+        error = None
+        if runtime == "ort":
+            if network not in onnx_files:
+                path = os.path.join(workdir, f"{network}.onnx")
+                _, error = child_run("--export", {"network": network, "weight": args.weight, "path": path})
+                onnx_files[network] = (path, error)
+            config["onnx"], error = onnx_files[network]
+        if error is None:
+            stdout, error = child_run("--config", config)
+        if error is None:
+            result = json.loads(stdout.strip().splitlines()[-1])
+        else:
+            result = dict(config, error=error)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    print_table(results)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
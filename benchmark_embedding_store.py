@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from sklearn.metrics import roc_curve
+
+from benchmark_identification import synthetic
+from eval.embedding_store import EmbeddingStore, save_embeddings
+
+# Size, load/scoring time and verification metric delta of the float16 and int8 embedding stores
+# against float32, e.g.:
+# python benchmark_embedding_store.py --num 1000000
+# python benchmark_embedding_store.py --embeddings bupt_feats.npy --issame bupt_issame.npy --output store.json
+# --embeddings holds the verification pairs as consecutive rows (2i, 2i + 1, as load_bin), without
+# it the embeddings are synthetic identities of 4 samples, half of the pairs genuine.
+
+
+def tar_at_far(scores, issame, fars=(1e-4, 1e-3)):
+    fpr, tpr, thresholds = roc_curve(issame, scores)
+    result = {f"TAR@FAR={far}": float(tpr[np.searchsorted(fpr, far, side="right") - 1]) for far in fars}
+    accuracy = [np.mean((scores > t) == issame) for t in thresholds[::max(1, len(thresholds) // 1000)]]
+    result["best_accuracy"] = float(np.max(accuracy))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='embedding store size, speed and metric delta')
+    parser.add_argument('--embeddings', type=str, default=None, help='.npy or embedding store')
+    parser.add_argument('--issame', type=str, default=None, help='.npy pair labels')
+    parser.add_argument('--num', type=int, default=200000, help='synthetic embeddings')
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--queries', type=int, default=256, help='queries of the 1:N scoring timing')
+    parser.add_argument('--output', type=str, default=None, help='JSON results')
+    args = parser.parse_args()
+
+    if args.embeddings is not None:
+        feats = np.load(args.embeddings) if args.embeddings.endswith('.npy') else EmbeddingStore(args.embeddings).to_float32()
+        feats = feats.astype(np.float32)
+        issame = np.load(args.issame).astype(bool)
+        left, right = np.arange(0, 2 * len(issame), 2), np.arange(1, 2 * len(issame), 2)
+    else:
+        feats, _ = synthetic(args.num, 1, args.dim, samples_per_id=4)
+        num_ids = args.num // 4
+        rng = np.random.default_rng(0)
+        num_pairs = args.num // 2
+        left = rng.integers(0, args.num - num_ids, num_pairs)
+        right = np.where(np.arange(num_pairs) % 2 == 0, left + num_ids, rng.integers(0, args.num, num_pairs))
+        issame = (left % num_ids) == (right % num_ids)
+    queries = feats[np.random.default_rng(1).choice(len(feats), min(args.queries, len(feats)), replace=False)]
+    print('embeddings', feats.shape, 'pairs', len(issame))
+
+    results = []
+    reference = None
+    workdir = tempfile.mkdtemp()
+    for dtype in ("float32", "float16", "int8"):
+        path = os.path.join(workdir, f"{dtype}.emb")
+        start = time.perf_counter()
+        save_embeddings(path, feats, dtype, {"flip": "none", "normalization": "none"})
+        save_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store = EmbeddingStore(path)
+        pair_scores = store.pair_scores(left, right, cosine=True)
+        pair_time = time.perf_counter() - start
+        start = time.perf_counter()
+        scores = store.scores(queries, cosine=True)
+        search_time = time.perf_counter() - start
+
+        if reference is None:
+            reference = (pair_scores, scores)
+        result = {"dtype": dtype, "file_mb": os.path.getsize(path) / 1024 ** 2,
+                  "bytes_per_face": store.nbytes / len(store), "save_sec": save_time,
+                  "pair_scoring_sec": pair_time, "queries_per_sec": len(queries) / search_time,
+                  "max_pair_score_diff": float(np.abs(pair_scores - reference[0]).max()),
+                  "max_1n_score_diff": float(np.abs(scores - reference[1]).max()),
+                  "top1_agreement": float(np.mean(scores.argmax(1) == reference[1].argmax(1)))}
+        result.update(tar_at_far(pair_scores, issame))
+        results.append(result)
+        del store
+        os.remove(path)
+
+    base = results[0]
+    for r in results:
+        print("%-8s %8.1f MB (%6.1f B/face, %.1fx)  %8.1f queries/s  max score diff %.2e  top-1 agreement %.4f  " % (
+            r["dtype"], r["file_mb"], r["bytes_per_face"], base["bytes_per_face"] / r["bytes_per_face"],
+            r["queries_per_sec"], r["max_pair_score_diff"], r["top1_agreement"]), end="")
+        print("  ".join("%s %.4f (%+.4f)" % (k, r[k], r[k] - base[k])
+                        for k in r if k.startswith("TAR") or k == "best_accuracy"))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
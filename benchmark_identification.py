@@ -0,0 +1,88 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from eval.identification import ExactIndex, IVFPQIndex, l2_normalize, recall_at_k
+
+# Recall@k against exact search vs queries/s of the IVF-PQ index on CPU, e.g.:
+# python benchmark_identification.py --num-gallery 1000000 --nlist 4096 --m 64 --nprobe 8 16 32 64
+# python benchmark_identification.py --gallery gallery_feats.npy --queries probe_feats.npy --output ivfpq.json
+# Without --gallery, the embeddings are synthetic: identities of --samples-per-id noisy samples
+# around a random center, the queries being other samples of enrolled identities.
+
+
+def synthetic(num_gallery, num_queries, dim, samples_per_id=4, noise=0.6, seed=0):
+    rng = np.random.default_rng(seed)
+    num_ids = max(1, num_gallery // samples_per_id)
+    centers = l2_normalize(rng.standard_normal((num_ids, dim)))
+    gallery_ids = np.arange(num_gallery) % num_ids
+    gallery = l2_normalize(centers[gallery_ids] + noise / np.sqrt(dim) * rng.standard_normal((num_gallery, dim)))
+    query_ids = rng.integers(0, num_ids, num_queries)
+    queries = l2_normalize(centers[query_ids] + noise / np.sqrt(dim) * rng.standard_normal((num_queries, dim)))
+    return gallery.astype(np.float32), queries.astype(np.float32)
+
+
+def timed_search(index, queries, k, **kwargs):
+    start = time.perf_counter()
+    scores, ids = index.search(queries, k, **kwargs)
+    return scores, ids, len(queries) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='1:N search recall@k vs queries/s')
+    parser.add_argument('--gallery', type=str, default=None, help='.npy gallery embeddings')
+    parser.add_argument('--queries', type=str, default=None, help='.npy query embeddings')
+    parser.add_argument('--num-gallery', type=int, default=100000)
+    parser.add_argument('--num-queries', type=int, default=1000)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--samples-per-id', type=int, default=4)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--m', type=int, default=64, help='PQ sub-vectors (bytes per embedding)')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32, 64])
+    parser.add_argument('--add-batch', type=int, default=100000, help='incremental enrollment batch size')
+    parser.add_argument('--output', type=str, default=None, help='JSON results')
+    args = parser.parse_args()
+
+    if args.gallery is not None:
+        gallery = np.load(args.gallery).astype(np.float32)
+        queries = np.load(args.queries).astype(np.float32) if args.queries else \
+            gallery[np.random.default_rng(0).choice(len(gallery), args.num_queries, replace=False)]
+    else:
+        gallery, queries = synthetic(args.num_gallery, args.num_queries, args.dim, args.samples_per_id)
+    dim = gallery.shape[1]
+    print('gallery', gallery.shape, 'queries', queries.shape)
+
+    results = []
+    exact = ExactIndex(dim)
+    start = time.perf_counter()
+    for batch in range(0, len(gallery), args.add_batch):
+        exact.add(gallery[batch:batch + args.add_batch])
+    add_time = time.perf_counter() - start
+    _, true_ids, qps = timed_search(exact, queries, args.k)
+    results.append({"index": "exact", "recall@1": 1.0, f"recall@{args.k}": 1.0, "queries_per_sec": qps,
+                    "add_sec": add_time, "bytes_per_embedding": 4 * dim})
+
+    ivf = IVFPQIndex(dim, nlist=args.nlist, m=args.m)
+    start = time.perf_counter()
+    ivf.train(gallery)
+    train_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for batch in range(0, len(gallery), args.add_batch):
+        ivf.add(gallery[batch:batch + args.add_batch])
+    add_time = time.perf_counter() - start
+    ivf.search(queries[:1], args.k)
+    for nprobe in args.nprobe:
+        _, ids, qps = timed_search(ivf, queries, args.k, nprobe=nprobe)
+        results.append({"index": f"ivfpq nprobe={nprobe}", "recall@1": recall_at_k(ids, true_ids, 1),
+                        f"recall@{args.k}": recall_at_k(ids, true_ids, args.k), "queries_per_sec": qps,
+                        "train_sec": train_time, "add_sec": add_time, "bytes_per_embedding": args.m + 8})
+
+    for r in results:
+        print("%-20s recall@1 %.4f  recall@%d %.4f  %10.1f queries/s" % (
+            r["index"], r["recall@1"], args.k, r[f"recall@{args.k}"], r["queries_per_sec"]))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,74 @@
+import argparse
+import time
+
+import torch
+
+from backbones import get_model, optimize_for_inference
+
+# Parity and latency of the inference graph (folded BatchNorms, channels_last, optional TorchScript)
+# against the training graph, e.g.:
+# python benchmark_inference.py r50 r100 --threads 8
+# python benchmark_inference.py r50 --weight model.pt --jit
+
+
+def randomize_bn(model):
+    """ Non-trivial BatchNorm statistics, so that folding them is actually checked without weights """
+    for m in model.modules():
+        if isinstance(m, (torch.nn.BatchNorm1d, torch.nn.BatchNorm2d)):
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 1.5)
+            if m.weight.requires_grad:
+                m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.1, 0.1)
+
+
+@torch.no_grad()
+def latency(model, img, warmup, steps):
+    for _ in range(warmup):
+        model(img)
+    start = time.perf_counter()
+    for _ in range(steps):
+        model(img)
+    return (time.perf_counter() - start) / steps * 1000
+
+
+@torch.no_grad()
+def run(network, args):
+    torch.manual_seed(0)
+    model = get_model(network, dropout=0.0, fp16=False, num_features=512)
+    if args.weight:
+        model.load_state_dict(torch.load(args.weight, map_location="cpu"))
+    else:
+        randomize_bn(model)
+    model.eval()
+    fused = optimize_for_inference(model, channels_last=not args.nchw, jit=args.jit)
+
+    img = torch.randn(args.batch_size, 3, 112, 112)
+    reference, output = model(img), fused(img)
+    cosine = torch.nn.functional.cosine_similarity(reference, output).min().item()
+    max_diff = (reference - output).abs().max().item() / reference.abs().max().item()
+    print("%s parity: min cosine %.6f, max relative difference %.2e" % (network, cosine, max_diff))
+    if cosine < 1 - 1e-4:
+        raise RuntimeError(f"{network}: the inference graph does not match the training graph")
+
+    eager = latency(model, img, args.warmup, args.steps)
+    optimized = latency(fused, img, args.warmup, args.steps)
+    print("%s latency (batch %d): eager %.2f ms, inference graph %.2f ms (%.2fx)" % (
+        network, args.batch_size, eager, optimized, eager / optimized))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='inference graph parity and CPU latency')
+    parser.add_argument('networks', type=str, nargs='*', default=["r50", "r100"])
+    parser.add_argument('--weight', type=str, default=None, help="backbone weights, random if not given")
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--nchw', action='store_true', help="keep the NCHW layout")
+    parser.add_argument('--jit', action='store_true', help="freeze a TorchScript trace")
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=20)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    for network in args.networks:
+        run(network, args)
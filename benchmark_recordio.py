@@ -0,0 +1,104 @@
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from utils.utils_recordio import MAGIC, IndexedRecordIO, IRHeader, imdecode, pack, resize_short, unpack
+
+# Parity and read speed of utils.utils_recordio against mx.recordio / mx.image (when mxnet is
+# installed), exits 1 on a mismatch, e.g.:
+# python benchmark_recordio.py --rec-dir /train_tmp/faces_emore --num 50000
+# python benchmark_recordio.py --rec-dir /train_tmp/faces_emore --bin /train_tmp/faces_emore/lfw.bin
+# Without --rec-dir, a synthetic train.rec (random JPEGs, payloads containing the RecordIO magic
+# number) is written to a temporary directory first.
+
+
+def write_synthetic(root, num, seed=0):
+    rng = np.random.default_rng(seed)
+    with IndexedRecordIO(os.path.join(root, "train.idx"), os.path.join(root, "train.rec"), "w") as rec:
+        # insightface layout: record 0 holds the range of the image records as an array label
+        rec.write_idx(0, pack(IRHeader(2, [num + 1, num + 1], 0, 0), b""))
+        for i in range(1, num + 1):
+            img = rng.integers(0, 255, (112, 112, 3), dtype=np.uint8)
+            payload = cv2.imencode(".jpg", img)[1].tobytes()
+            if i % 10 == 0:
+                # split into parts on write, decoders stop at the end of the JPEG
+                payload += b"\0" * (-len(payload) % 4) + np.uint32(MAGIC).tobytes() + b"tail"
+            rec.write_idx(i, pack(IRHeader(0, float(i % 1000), i, 0), payload))
+
+
+def read_records(rec, keys, decode):
+    start = time.perf_counter()
+    out = []
+    for key in keys:
+        header, img = decode(rec.read_idx(key))
+        out.append((header, img))
+    return out, len(keys) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RecordIO parity and read speed against mxnet')
+    parser.add_argument('--rec-dir', type=str, default=None, help='directory of train.rec and train.idx')
+    parser.add_argument('--bin', type=str, default=None, help='verification .bin, checked as load_bin')
+    parser.add_argument('--num', type=int, default=10000, help='records read (written when synthetic)')
+    parser.add_argument('--pixel-tolerance', type=int, default=1,
+                        help='bicubic resizes of other OpenCV builds (mxnet bundles its own) round differently')
+    args = parser.parse_args()
+
+    root = args.rec_dir
+    if root is None:
+        root = tempfile.mkdtemp()
+        write_synthetic(root, args.num)
+    path_imgidx, path_imgrec = os.path.join(root, "train.idx"), os.path.join(root, "train.rec")
+
+    def decode(s):
+        header, img = unpack(s)
+        return header, (imdecode(img) if len(img) else None)
+
+    rec = IndexedRecordIO(path_imgidx, path_imgrec, "r")
+    keys = rec.keys[:args.num]
+    ours, speed = read_records(rec, keys, decode)
+    sequential = IndexedRecordIO(path_imgidx, path_imgrec, "r", use_mmap=False)
+    failures = sum(sequential.read() != rec.read_idx(key) for key in keys)
+    print("utils_recordio: %d records, %.1f records/s (read, unpack, decode), sequential mismatches %d" % (
+        len(keys), speed, failures))
+
+    try:
+        import mxnet as mx
+    except ImportError:
+        mx = None
+        print("mxnet is not installed, parity against mx.recordio skipped")
+    if mx is not None:
+        mx_rec = mx.recordio.MXIndexedRecordIO(path_imgidx, path_imgrec, "r")
+
+        def mx_decode(s):
+            header, img = mx.recordio.unpack(s)
+            return header, (mx.image.imdecode(img).asnumpy() if len(img) else None)
+
+        theirs, mx_speed = read_records(mx_rec, keys, mx_decode)
+        for key, (header, img), (mx_header, mx_img) in zip(keys, ours, theirs):
+            same = rec.read_idx(key) == mx_rec.read_idx(key) and header.flag == mx_header.flag \
+                and np.array_equal(header.label, mx_header.label) and (header.id, header.id2) == (mx_header.id, mx_header.id2)
+            if img is not None:
+                same = same and np.array_equal(img, mx_img)
+            failures += not same
+        print("mx.recordio:    %.1f records/s, %.2fx faster, mismatches %d" % (mx_speed, speed / mx_speed, failures))
+
+    if args.bin is not None:
+        with open(args.bin, 'rb') as f:
+            bins, issame_list = pickle.load(f, encoding='bytes')
+        start = time.perf_counter()
+        imgs = [resize_short(imdecode(b), 112) for b in bins]
+        print("%s: %d images, %.1f images/s" % (args.bin, len(imgs), len(imgs) / (time.perf_counter() - start)))
+        if mx is not None:
+            diffs = [np.abs(img.astype(np.int16) - mx.image.resize_short(mx.image.imdecode(b), 112).asnumpy()).max()
+                     for img, b in zip(imgs, bins)]
+            print("max pixel difference against mx.image: %d" % max(diffs))
+            failures += max(diffs) > args.pixel_tolerance
+
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,109 @@
+import argparse
+import time
+
+import torch
+from torch.nn.functional import cross_entropy, linear, normalize
+
+from backbones import get_model
+from losses import CombinedMarginLoss
+from utils.utils_compile import compile_function, compile_module
+
+# Step time of the backbone and the margin loss (single device, dense class centers),
+# eager vs torch.compile, reading the loss back every step vs once per logging interval and
+# with or without activation checkpointing (step time, throughput and peak memory), e.g.:
+# python benchmark_train_step.py r50 --device cuda --mode reduce-overhead
+# python benchmark_train_step.py r18 --device cpu --batch-size 16 --steps 5
+# python benchmark_train_step.py r100 --batch-size 256 --checkpoint-stages 1 2 3
+
+
+def build(args, compiled, checkpointing=False):
+    torch.manual_seed(0)
+    kwargs = {}
+    if checkpointing and args.checkpoint_stages:
+        kwargs["checkpoint_stages"] = args.checkpoint_stages
+    if checkpointing and args.checkpoint_interval:
+        kwargs["checkpoint_interval"] = args.checkpoint_interval
+    backbone = get_model(args.network, dropout=0.0, fp16=args.fp16, num_features=args.embedding_size, **kwargs)
+    backbone = backbone.to(args.device).train()
+    weight = torch.nn.Parameter(torch.normal(0, 0.01, (args.num_classes, args.embedding_size), device=args.device))
+    margin_loss = CombinedMarginLoss(64, 1.0, 0.5, 0.0)
+
+    def margin_logits(embeddings, labels):
+        logits = linear(normalize(embeddings), normalize(weight)).float().clamp(-1, 1)
+        return margin_loss(logits, labels)
+
+    if compiled:
+        compile_module(backbone, args.mode, args.backend)
+        margin_logits = compile_function(margin_logits, args.mode, args.backend, "margin_logits")
+    opt = torch.optim.SGD([{"params": backbone.parameters()}, {"params": [weight]}], lr=0.1, momentum=0.9)
+    return backbone, margin_logits, opt
+
+
+def run(args, compiled, sync_every, checkpointing=False):
+    """ (ms per step, peak device memory in GB) """
+    backbone, margin_logits, opt = build(args, compiled, checkpointing)
+    img = torch.randn(args.batch_size, 3, 112, 112, device=args.device)
+    labels = torch.randint(args.num_classes, (args.batch_size, 1), device=args.device)
+
+    loss_sum = torch.zeros((), device=args.device)
+
+    def step(i):
+        nonlocal loss_sum
+        logits = margin_logits(backbone(img), labels)
+        loss = cross_entropy(logits, labels.view(-1))
+        loss.backward()
+        opt.step()
+        opt.zero_grad(set_to_none=True)
+        loss_sum = loss_sum + loss.detach()
+        if (i + 1) % sync_every == 0:
+            loss_sum.item()
+            loss_sum = torch.zeros((), device=args.device)
+
+    if args.device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    for i in range(args.warmup):
+        step(i)
+    if args.device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for i in range(args.steps):
+        step(i)
+    if args.device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / args.steps * 1000
+    peak_memory = torch.cuda.max_memory_allocated() / 1024 ** 3 if args.device == "cuda" else float("nan")
+    return elapsed, peak_memory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='eager vs compiled training step time')
+    parser.add_argument('network', type=str, default="r50")
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--embedding-size', type=int, default=512)
+    parser.add_argument('--num-classes', type=int, default=10000)
+    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--mode', type=str, default="default", help="default, reduce-overhead or max-autotune")
+    parser.add_argument('--backend', type=str, default="inductor")
+    parser.add_argument('--warmup', type=int, default=5, help="steps before timing, includes the compilation")
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--frequent', type=int, default=10, help="steps between two loss read backs")
+    parser.add_argument('--checkpoint-stages', type=int, nargs='*', default=[], help="iresnet stages to checkpoint")
+    parser.add_argument('--checkpoint-interval', type=int, default=0, help="checkpoint one ViT block out of every n")
+    args = parser.parse_args()
+
+    def report(name, result, baseline=None):
+        ms, peak_memory = result
+        print("%-36s %8.2f ms/step %9.1f samples/s %6.2f GB peak%s" % (
+            name, ms, args.batch_size / ms * 1000, peak_memory,
+            "" if baseline is None else " (%.2fx)" % (baseline[0] / ms)))
+
+    synced = run(args, compiled=False, sync_every=1)
+    report("eager, loss read every step", synced)
+    eager = run(args, compiled=False, sync_every=args.frequent)
+    report("eager, loss read every %d steps" % args.frequent, eager, synced)
+    compiled = run(args, compiled=True, sync_every=args.frequent)
+    report("compiled (%s, %s)" % (args.mode, args.backend), compiled, eager)
+    if args.checkpoint_stages or args.checkpoint_interval:
+        checkpointed = run(args, compiled=False, sync_every=args.frequent, checkpointing=True)
+        report("eager, activation checkpointing", checkpointed, eager)
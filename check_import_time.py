@@ -0,0 +1,103 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Import-time budget of the eval and serving entry points: every check imports its target in a
+# fresh interpreter, fails if one of the optional dependencies it must not load ended up in
+# sys.modules, or if its own import time (the time on top of its required dependencies, imported
+# alone in another interpreter) is over budget, or if the target itself fails to import. A check is
+# skipped when its required dependencies are not installed (a failure with --strict). Exits 1 on
+# failure, e.g.:
+# python check_import_time.py --strict
+# python check_import_time.py --repeat 5 --scale 2 --output import_time.json
+
+OPTIONAL = ["mxnet", "sklearn", "scipy", "pandas", "skimage", "matplotlib", "menpo"]
+
+# (name, statement, required dependencies, modules it must not load, budget in seconds)
+CHECKS = [
+    ("backbones", "import backbones", "import torch",
+     ["backbones.iresnet", "backbones.mobilefacenet", "backbones.vit", "timm"] + OPTIONAL, 0.05),
+    ("get_model mbf", "from backbones import get_model, optimize_for_inference; get_model('mbf')", "import torch",
+     ["backbones.iresnet", "backbones.vit", "timm"] + OPTIONAL, 0.5),
+    ("eval.verification", "import eval.verification", "import numpy, torch", OPTIONAL, 0.1),
+    ("eval.embedding_store", "import eval.embedding_store", "import numpy", ["torch"] + OPTIONAL, 0.05),
+    ("eval.identification", "import eval.identification", "import numpy", ["torch"] + OPTIONAL, 0.05),
+    ("embedding_server", "import embedding_server", "import numpy, cv2",
+     ["torch", "onnxruntime"] + OPTIONAL, 0.1),
+]
+
+SNIPPET = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+print(json.dumps({{"sec": time.perf_counter() - start, "modules": sorted(sys.modules)}}))
+"""
+
+
+def run(statement):
+    out = subprocess.run([sys.executable, "-c", SNIPPET.format(statement=statement)],
+                         capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else statement)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+class MissingDependency(Exception):
+    pass
+
+
+def measure(statement, deps, repeat):
+    """ (median own import time, modules loaded by statement), MissingDependency when `deps` fail """
+    own, modules = [], []
+    for _ in range(repeat):
+        try:
+            base = run(deps)["sec"]
+        except RuntimeError as e:
+            raise MissingDependency(str(e))
+        result = run(statement)
+        own.append(max(0.0, result["sec"] - base))
+        modules = result["modules"]
+    return statistics.median(own), modules
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='import time budget of the eval and serving modules')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies every budget (slow machines)')
+    parser.add_argument('--output', type=str, default=None, help='JSON results')
+    parser.add_argument('--strict', action='store_true', help='fail when a check is skipped')
+    args = parser.parse_args()
+
+    results = []
+    for name, statement, deps, forbidden, budget in CHECKS:
+        result = {"check": name, "budget_sec": budget * args.scale}
+        try:
+            result["own_sec"], modules = measure(statement, deps, args.repeat)
+        except MissingDependency as e:
+            # a missing required dependency is not a budget failure, unless --strict
+            result["skipped"] = str(e)
+            result["ok"] = False if args.strict else None
+            results.append(result)
+            print("%-22s skipped: %s%s" % (name, e, "  FAIL" if args.strict else ""))
+            continue
+        except RuntimeError as e:
+            result["error"] = str(e)
+            result["ok"] = False
+            results.append(result)
+            print("%-22s FAIL: %s" % (name, e))
+            continue
+        loaded = sorted({m for m in modules if m.split(".")[0] in forbidden or m in forbidden})
+        result["forbidden_loaded"] = loaded
+        result["ok"] = not loaded and result["own_sec"] <= result["budget_sec"]
+        results.append(result)
+        print("%-22s %7.3f s (budget %.3f s)  %s%s" % (
+            name, result["own_sec"], result["budget_sec"], "ok" if result["ok"] else "FAIL",
+            "  loads " + ", ".join(loaded) if loaded else ""))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(r["ok"] is False for r in results):
+        sys.exit(1)
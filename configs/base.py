@@ -12,13 +12,46 @@ config.network = "r50"
 config.resume = False
 # config.save_all_states = False
 config.save_all_states = True
+# Also checkpoint every N steps (0: only at the end of every epoch), resumes in the middle of the epoch
+config.checkpoint_every = 0
+# Write the checkpoints in a background thread from a CPU snapshot of the state
+config.async_checkpoint = True
+# Also export the final backbone to model.onnx in the output directory (set by train.py)
+config.export_onnx = False
 config.output = "ms1mv3_arcface_r50"
 
 config.embedding_size = 512
 
+# Training heads of trainer.py, see heads.HEADS: "id", "race_discrim", "attributes", "multi_task"
+# None uses the heads of the train script
+config.heads = None
+# Loss of the "id" head: "CombinedMarginLoss" (Partial FC) or "LDAMLoss"
+config.loss = "CombinedMarginLoss"
+config.train_rule = None    # "Reweight": class-balanced weights of LDAMLoss, "Resample": balanced sampler
+config.partial_fc_version = 2
+config.channels_last = False
+# torch.compile of the backbone and the margin logits of Partial FC, falls back to eager when the
+# first (forward) compile fails: None, "default", "reduce-overhead" (CUDA graphs) or "max-autotune"
+config.compile = None
+config.compile_backend = "inductor"
+# Later compile errors (e.g. of the backward graph) also fall back to eager, process-wide
+# (torch._dynamo.config.suppress_errors)
+config.compile_suppress_errors = False
+# Activation checkpointing (recompute in the backward pass for a larger batch per GPU):
+# stages of iresnet (e.g. [1, 2] for layer1 and layer2), one ViT block out of every checkpoint_interval;
+# r2060 (always checkpointed) and mbf raise a ValueError when one of them is set
+config.checkpoint_stages = []
+config.checkpoint_interval = 0
+
 # Partial FC
 config.sample_rate = 1
 config.interclass_filtering_threshold = 0
+# Update only the sampled class centers (and their optimizer state) when sample_rate < 1
+config.sparse_optimizer = False
+# Keep all class centers and their optimizer state on the host and stream the sampled rows:
+# None, "pinned" (page-locked RAM) or "mmap" (files under config.output), needs sample_rate < 1
+# and gradient_acc = 1
+config.pfc_offload = None
 
 config.fp16 = False
 config.batch_size = 128
@@ -36,6 +69,9 @@ config.weight_decay = 5e-4
 
 config.verbose = 2000
 config.frequent = 10
+# Per-phase step timings (data wait, h2d, forward, heads, backward, optimizer), queue depth and peak
+# memory, logged as percentiles over the last `frequent` steps
+config.profile = False
 
 # For Large Sacle Dataset, such as WebFace42M
 config.dali = False 
@@ -46,9 +82,22 @@ config.gradient_acc = 1
 # setup seed
 config.seed = 2048
 
+# Sampler: "distributed" (uniform shuffle), "balanced" (draws with replacement, balancing the groups
+# of balance_by: "id", "source", "race", "gender", "age" or a combination such as "race,gender")
+# or "pk" (batches of batch_size // num_instances identities x num_instances images)
+config.sampler = "distributed"
+config.balance_by = "id"
+config.balance_power = 1.0    # 0: natural distribution, 1: every group equally often
+config.num_instances = 4
+
 # dataload numworkers
 # config.num_workers = 2
 config.num_workers = 6
+# Batches prefetched by the background thread and copied ahead to the GPU, with reuse_buffers through
+# a ring of pinned host buffers and preallocated device buffers (tune with profile: data_wait/data_stall)
+config.host_prefetch = 6
+config.device_prefetch = 1
+config.reuse_buffers = True
 
 
 
@@ -72,4 +121,12 @@ config.save_artifacts = True
 
 config.wandb_resume = False # resume wandb run: Only if the you wand t resume the last run that it was interrupted
 
-config.notes = ''
\ No newline at end of file
+config.notes = ''
+
+# Attribute heads of the multi-task training (multi_task_head.MultiTaskHead)
+config.attribute_heads = {"age": 8, "gender": 2, "race": 6}    # name: number of classes
+config.attribute_hidden_size = 256
+config.attribute_loss_weights = {"age": 1.0, "gender": 1.0, "race": 1.0}
+# (train_v2_age_gender_race_mlp_classification_frcsyn.py overrides them to id + age only, its old objective)
+config.attribute_mode = "collaborative"    # or "adversarial": reversed gradient into the backbone
+config.attribute_alpha = 1.0               # scale of the reversed gradient
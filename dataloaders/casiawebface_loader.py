@@ -4,7 +4,6 @@ import cv2
 from PIL import Image
 from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
-import random
 import pickle
 
 try:
@@ -62,10 +61,9 @@ class CASIAWebFace_loader(Dataset):
         # print('len(self.subjs_dict)', len(self.subjs_dict))
         print('    num_total_classes (all datasets):', len(self.subjs_dict))        
 
-        self.final_samples_list = self.replace_strings_labels_by_int_labels(self.samples_list, self.subjs_dict, self.ages_dict, self.genders_dict, self.races_dict)
+        self.final_samples_list = ud.SamplesArray(self.replace_strings_labels_by_int_labels(self.samples_list, self.subjs_dict, self.ages_dict, self.genders_dict, self.races_dict))
         # print('self.final_samples_list', self.final_samples_list)
         # print('len(self.final_samples_list)', len(self.final_samples_list))
-        random.shuffle(self.final_samples_list)
 
 
     def append_dataset_name(self, path_files, dataset_name):
@@ -173,11 +171,15 @@ class CASIAWebFace_loader(Dataset):
         return len(self.final_samples_list)  # Bernardo
 
 
+    def get_sample_labels(self):
+        # labels of every sample (in the order of __getitem__) as numpy arrays, used by the samplers
+        if getattr(self, 'sample_labels', None) is None:
+            self.sample_labels = ud.get_sample_labels(self.final_samples_list, {'id': 2, 'age': 3, 'gender': 4, 'race': 5})
+        return self.sample_labels
+
+
     def get_cls_num_list(self):
-        cls_num_list = []
-        for key in list(self.subjs_dict_num_samples.keys()):
-            cls_num_list.append(self.subjs_dict_num_samples[key])
-        return cls_num_list
+        return ud.get_cls_num_list(self.get_sample_labels()['id'], len(self.subjs_dict))
 
 
 
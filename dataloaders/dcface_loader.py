@@ -4,7 +4,6 @@ import cv2
 from PIL import Image
 from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
-import random
 
 try:
     from . import utils_dataloaders as ud
@@ -53,8 +52,7 @@ class DCFace_loader(Dataset):
             self.genders_dict = ud.merge_dicts(self.genders_dict, other_dataset.genders_dict)
             self.samples_list += other_dataset.samples_list
 
-        self.final_samples_list = self.replace_strings_labels_by_int_labels(self.samples_list, self.subjs_dict, self.races_dict, self.genders_dict)
-        random.shuffle(self.final_samples_list)
+        self.final_samples_list = ud.SamplesArray(self.replace_strings_labels_by_int_labels(self.samples_list, self.subjs_dict, self.races_dict, self.genders_dict))
         # print('self.final_samples_list', self.final_samples_list)
         # print('len(self.final_samples_list)', len(self.final_samples_list))
 
@@ -154,11 +152,15 @@ class DCFace_loader(Dataset):
         return len(self.final_samples_list)  # Bernardo
 
 
+    def get_sample_labels(self):
+        # labels of every sample (in the order of __getitem__) as numpy arrays, used by the samplers
+        if getattr(self, 'sample_labels', None) is None:
+            self.sample_labels = ud.get_sample_labels(self.final_samples_list, {'id': 2, 'race': 3, 'gender': 4})
+        return self.sample_labels
+
+
     def get_cls_num_list(self):
-        cls_num_list = []
-        for key in list(self.subjs_dict_num_samples.keys()):
-            cls_num_list.append(self.subjs_dict_num_samples[key])
-        return cls_num_list
+        return ud.get_cls_num_list(self.get_sample_labels()['id'], len(self.subjs_dict))
 
 
 
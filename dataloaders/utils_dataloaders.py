@@ -1,5 +1,6 @@
 import os, sys
 import glob
+import numpy as np
 
 
 def load_file_protocol(file_path):
@@ -44,6 +45,47 @@ def merge_dicts(dict1, dict2, stride=0):
     return dict1
 
 
+class SamplesArray(object):
+    # The samples of a loader as one numpy array per tuple position: strings (dataset name, image path)
+    # as utf-8 bytes, labels as int64. Indexing returns the same tuple as the list of samples, but
+    # without millions of Python objects that every DataLoader worker copies on write.
+    def __init__(self, samples_list):
+        num_fields = len(samples_list[0]) if len(samples_list) > 0 else 0
+        self.columns = []
+        for pos in range(num_fields):
+            values = [sample[pos] for sample in samples_list]
+            if isinstance(values[0], str):
+                self.columns.append(np.array([value.encode('utf-8') for value in values], dtype=np.bytes_))
+            else:
+                self.columns.append(np.array(values, dtype=np.int64))
+
+    def column(self, pos):
+        return self.columns[pos]
+
+    def __getitem__(self, index):
+        return tuple(column[index].decode('utf-8') if column.dtype.kind == 'S' else int(column[index])
+                     for column in self.columns)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __len__(self):
+        return len(self.columns[0]) if len(self.columns) > 0 else 0
+
+
+def get_sample_labels(samples_array, label_positions):
+    # label_positions: {label_name: position in the sample tuple}, e.g. {'id': 2, 'race': 3}
+    # 'source' is the index of the dataset name (position 0) among the sorted dataset names
+    labels = {name: samples_array.column(pos) for name, pos in label_positions.items()}
+    _, labels['source'] = np.unique(samples_array.column(0), return_inverse=True)
+    return labels
+
+
+def get_cls_num_list(subj_labels, num_classes):
+    return np.bincount(subj_labels, minlength=num_classes).tolist()
+
+
 def get_min_max_value_dict(dict):
     min_val, max_val = 0, 0
     for i, key in enumerate(list(dict.keys())):
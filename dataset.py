@@ -2,9 +2,11 @@ import numbers
 import os, sys
 import queue as Queue
 import threading
+import time
+from collections import deque
+from contextlib import nullcontext
 from typing import Iterable
 
-import mxnet as mx
 import numpy as np
 import torch
 from functools import partial
@@ -12,8 +14,9 @@ from torch import distributed
 from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 from torchvision.datasets import ImageFolder
-from utils.utils_distributed_sampler import DistributedSampler
+from utils.utils_distributed_sampler import BalancedDistributedSampler, DistributedSampler, PKDistributedSampler
 from utils.utils_distributed_sampler import get_dist_info, worker_init_fn
+from utils.utils_recordio import IndexedRecordIO, imdecode, unpack
 
 from dataloaders.casiawebface_loader import CASIAWebFace_loader
 from dataloaders.gandiffface_loader import GANDiffFace_loader
@@ -31,6 +34,13 @@ def get_dataloader(
     dali = False,
     seed = 2048,
     num_workers = 2,
+    sampler = "distributed",
+    balance_by = "id",
+    balance_power = 1.0,
+    num_instances = 4,
+    host_prefetch = 6,
+    device_prefetch = 1,
+    reuse_buffers = True,
     ) -> Iterable:
 
     transform = transforms.Compose([
@@ -137,8 +147,19 @@ def get_dataloader(
             num_threads=2, local_rank=local_rank)
 
     rank, world_size = get_dist_info()
-    train_sampler = DistributedSampler(
-        train_set, num_replicas=world_size, rank=rank, shuffle=True, seed=seed)
+    if sampler == "distributed":
+        train_sampler = DistributedSampler(
+            train_set, num_replicas=world_size, rank=rank, shuffle=True, seed=seed)
+    elif sampler == "balanced":
+        train_sampler = BalancedDistributedSampler(
+            train_set, num_replicas=world_size, rank=rank,
+            balance_by=balance_by, balance_power=balance_power, seed=seed)
+    elif sampler == "pk":
+        train_sampler = PKDistributedSampler(
+            train_set, batch_size, num_instances=num_instances,
+            num_replicas=world_size, rank=rank, seed=seed)
+    else:
+        raise ValueError(f"sampler not supported: {sampler}")
 
     if seed is None:
         init_fn = None
@@ -151,6 +172,9 @@ def get_dataloader(
         batch_size=batch_size,
         sampler=train_sampler,
         num_workers=num_workers,
+        host_prefetch=host_prefetch,
+        device_prefetch=device_prefetch,
+        reuse_buffers=reuse_buffers,
         pin_memory=True,
         drop_last=True,
         worker_init_fn=init_fn,
@@ -159,18 +183,31 @@ def get_dataloader(
     return train_loader
 
 class BackgroundGenerator(threading.Thread):
-    def __init__(self, generator, local_rank, max_prefetch=6):
+    """
+    Iterates `generator` in a thread, up to `max_prefetch` items ahead. `transform` is applied in
+    the thread (e.g. the copy to pinned buffers). `stall` is the time, in seconds, the thread spent
+    blocked because the consumer did not keep up.
+    """
+
+    def __init__(self, generator, local_rank, max_prefetch=6, transform=None):
         super(BackgroundGenerator, self).__init__()
         self.queue = Queue.Queue(max_prefetch)
         self.generator = generator
         self.local_rank = local_rank
+        self.transform = transform
+        self.stall = 0.0
         self.daemon = True
         self.start()
 
     def run(self):
-        torch.cuda.set_device(self.local_rank)
+        if self.local_rank is not None and torch.cuda.is_available():
+            torch.cuda.set_device(self.local_rank)
         for item in self.generator:
+            if self.transform is not None:
+                item = self.transform(item)
+            tic = time.perf_counter()
             self.queue.put(item)
+            self.stall += time.perf_counter() - tic
         self.queue.put(None)
 
     def next(self):
@@ -186,33 +223,141 @@ class BackgroundGenerator(threading.Thread):
         return self
 
 
+def _same_shapes(buffers, batch):
+    return buffers is not None and all(
+        not isinstance(t, torch.Tensor) or (b.shape == t.shape and b.dtype == t.dtype)
+        for b, t in zip(buffers, batch))
+
+
+class PinnedBufferRing(object):
+    """
+    `size` slots of page-locked host buffers, reused from batch to batch instead of pinning every
+    batch. `copy` (background thread) blocks until a slot is free, `release` (after the copy to the
+    device is queued) frees it once `event` is reached.
+    """
+
+    def __init__(self, size):
+        self.buffers = [None] * size
+        self.free = Queue.Queue()
+        for slot in range(size):
+            self.free.put((slot, None))
+
+    def copy(self, batch):
+        slot, event = self.free.get()
+        if event is not None:
+            event.synchronize()
+        buffers = self.buffers[slot]
+        if not _same_shapes(buffers, batch):
+            buffers = [torch.empty(t.shape, dtype=t.dtype, pin_memory=True) if isinstance(t, torch.Tensor) else None
+                       for t in batch]
+            self.buffers[slot] = buffers
+        for b, t in zip(buffers, batch):
+            if isinstance(t, torch.Tensor):
+                b.copy_(t)
+        return slot, [b if isinstance(t, torch.Tensor) else t for b, t in zip(buffers, batch)]
+
+    def release(self, slot, event):
+        self.free.put((slot, event))
+
+
 class DataLoaderX(DataLoader):
+    """
+    DataLoader prefetching batches in a background thread (`host_prefetch` batches) and onto the
+    GPU on a side stream (`device_prefetch` batches), overlapped with the training step.
+    With `reuse_buffers` the batches go through a ring of pinned host buffers and are copied to
+    preallocated device buffers, a batch is then only valid until the next one is requested.
+    Without CUDA the batches stay on the CPU and only the background thread is used.
+    """
 
-    def __init__(self, local_rank, **kwargs):
+    def __init__(self, local_rank, host_prefetch=6, device_prefetch=1, reuse_buffers=True, **kwargs):
+        cuda = torch.cuda.is_available()
+        if reuse_buffers or not cuda:
+            kwargs["pin_memory"] = False
         super(DataLoaderX, self).__init__(**kwargs)
-        self.stream = torch.cuda.Stream(local_rank)
+        self.cuda = cuda
         self.local_rank = local_rank
+        self.host_prefetch = host_prefetch
+        self.device_prefetch = max(device_prefetch, 1)
+        self.reuse_buffers = reuse_buffers and self.cuda
+        self.stream = torch.cuda.Stream(local_rank) if self.cuda else None
+        self.pinned = PinnedBufferRing(host_prefetch + 1) if self.reuse_buffers else None
+        self.device_buffers = [None] * (self.device_prefetch + 1)
+        # utils.utils_profiler.StepProfiler, set by the trainer to time the input pipeline
+        self.profiler = None
 
     def __iter__(self):
         self.iter = super(DataLoaderX, self).__iter__()
-        self.iter = BackgroundGenerator(self.iter, self.local_rank)
-        self.preload()
+        self.iter = BackgroundGenerator(
+            self.iter, self.local_rank if self.cuda else None, self.host_prefetch,
+            self.pinned.copy if self.reuse_buffers else None)
+        self.pending = deque()
+        released = None
+        if self.reuse_buffers:
+            # the buffers may still be read by the last steps of the previous epoch
+            released = torch.cuda.Event()
+            released.record()
+        self.device_free = deque((slot, released) for slot in range(len(self.device_buffers)))
+        self.in_use = None
+        for _ in range(self.device_prefetch):
+            self.preload()
         return self
 
+    def _to_device(self, batch):
+        if not self.reuse_buffers:
+            return [t.to(device=self.local_rank, non_blocking=True) for t in batch], None
+        slot_host, batch = batch
+        slot, released = self.device_free.popleft()
+        if released is not None:
+            # the step that used these buffers must be done before they are overwritten
+            self.stream.wait_event(released)
+        buffers = self.device_buffers[slot]
+        if not _same_shapes(buffers, batch):
+            buffers = [torch.empty(t.shape, dtype=t.dtype, device=self.local_rank)
+                       if isinstance(t, torch.Tensor) else None for t in batch]
+            self.device_buffers[slot] = buffers
+        for b, t in zip(buffers, batch):
+            if isinstance(t, torch.Tensor):
+                b.copy_(t, non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record(self.stream)
+        self.pinned.release(slot_host, copied)
+        return [b if isinstance(t, torch.Tensor) else t for b, t in zip(buffers, batch)], slot
+
     def preload(self):
-        self.batch = next(self.iter, None)
-        if self.batch is None:
-            return None
-        with torch.cuda.stream(self.stream):
-            for k in range(len(self.batch)):
-                self.batch[k] = self.batch[k].to(device=self.local_rank, non_blocking=True)
+        batch = next(self.iter, None)
+        if batch is None:
+            return
+        if not self.cuda:
+            self.pending.append((batch, None, None))
+            return
+        with torch.cuda.stream(self.stream), \
+                self.profiler.phase("h2d", self.stream) if self.profiler is not None else nullcontext():
+            batch, slot = self._to_device(batch)
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        self.pending.append((batch, slot, ready))
 
     def __next__(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        batch = self.batch
-        if batch is None:
-            raise StopIteration
+        tic = time.perf_counter()
+        if self.in_use is not None:
+            released = torch.cuda.Event()
+            released.record()
+            self.device_free.append((self.in_use, released))
+            self.in_use = None
         self.preload()
+        if not self.pending:
+            raise StopIteration
+        batch, slot, ready = self.pending.popleft()
+        if ready is not None:
+            torch.cuda.current_stream().wait_event(ready)
+        self.in_use = slot
+        if self.profiler is not None:
+            self.profiler.gauge("queue_depth", self.iter.queue.qsize())
+            # host time blocked on the background queue (and the copy launch) for the next batch,
+            # the producer side (the input pipeline waiting for the step) is reported as data_stall
+            self.profiler.record("data_wait", (time.perf_counter() - tic) * 1000)
+            self.profiler.gauge("data_stall", self.iter.stall * 1000)
+            self.iter.stall = 0.0
         return batch
 
 
@@ -229,9 +374,9 @@ class MXFaceDataset(Dataset):
         self.local_rank = local_rank
         path_imgrec = os.path.join(root_dir, 'train.rec')
         path_imgidx = os.path.join(root_dir, 'train.idx')
-        self.imgrec = mx.recordio.MXIndexedRecordIO(path_imgidx, path_imgrec, 'r')
+        self.imgrec = IndexedRecordIO(path_imgidx, path_imgrec, 'r')
         s = self.imgrec.read_idx(0)
-        header, _ = mx.recordio.unpack(s)
+        header, _ = unpack(s)
         if header.flag > 0:
             self.header0 = (int(header.label[0]), int(header.label[1]))
             self.imgidx = np.array(range(1, int(header.label[0])))
@@ -241,12 +386,12 @@ class MXFaceDataset(Dataset):
     def __getitem__(self, index):
         idx = self.imgidx[index]
         s = self.imgrec.read_idx(idx)
-        header, img = mx.recordio.unpack(s)
+        header, img = unpack(s)
         label = header.label
         if not isinstance(label, numbers.Number):
             label = label[0]
         label = torch.tensor(label, dtype=torch.long)
-        sample = mx.image.imdecode(img).asnumpy()
+        sample = imdecode(img)
         if self.transform is not None:
             sample = self.transform(sample)
         return sample, label
@@ -0,0 +1,293 @@
+import argparse
+import base64
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+# Local embedding server: the images of concurrent requests are decoded and preprocessed in a thread
+# pool, then embedded in dynamic batches (up to --max-batch-size images, the first one waiting at
+# most --max-latency-ms for the others), e.g.:
+# python embedding_server.py onnx_dir --cpu --port 8000
+# python embedding_server.py backbone_ts.pt --socket /tmp/embedding.sock
+# curl --data-binary @Aaron_Peirsol_0001.png localhost:8000/embed
+# curl -H "Content-Type: application/json" -d '{"images": ["<base64>", ...]}' localhost:8000/embed
+# curl localhost:8000/stats
+# python embedding_server.py onnx_dir --cpu --bench-clients 16 --bench-requests 2000
+
+
+def to_chw(img, image_size, crop=None):
+    """ BGR image to the uint8 RGB CHW input of eval.embedding """
+    if crop is not None:
+        img = img[crop[1]:crop[3], crop[0]:crop[2], :]
+    if img.shape[0] != image_size[1] or img.shape[1] != image_size[0]:
+        img = cv2.resize(img, image_size)
+    return img[:, :, ::-1].transpose(2, 0, 1)
+
+
+class ORTBackend(object):
+    """ Directory with an onnx model, see onnx_helper.ArcFaceORT """
+
+    def __init__(self, model_path, cpu=False, max_batch_size=32, flip=False, **session_options):
+        from eval.embedding import embed_blobs
+        from onnx_helper import ArcFaceORT
+        self.embed = embed_blobs
+        self.model = ArcFaceORT(model_path, cpu=cpu, io_binding=True, **session_options)
+        err = self.model.prepare()
+        if err is not None:
+            raise ValueError(f"can not load {model_path}: {err}")
+        self.flip = flip
+        self.model.warmup([1, 2 * max_batch_size if flip else max_batch_size])
+
+    def preprocess(self, img):
+        return to_chw(img, self.model.image_size, self.model.crop)
+
+    def __call__(self, imgs):
+        # the outputs are views of the IO binding buffers, reused by the next batches
+        return self.embed(self.model.forward_blob, imgs, self.flip, input_mean=self.model.input_mean,
+                           input_std=self.model.input_std, dtype=self.model.input_dtype).copy()
+
+
+class TorchScriptBackend(object):
+    """ TorchScript backbone, e.g. torch.jit.save of backbones.optimize_for_inference(..., jit=True) """
+
+    def __init__(self, model_path, cpu=False, image_size=(112, 112), flip=False):
+        import torch
+        from eval.embedding import embed
+        self.embed = embed
+        self.device = "cpu" if cpu or not torch.cuda.is_available() else "cuda"
+        self.model = torch.jit.load(model_path, map_location=self.device).eval()
+        self.image_size = image_size
+        self.flip = flip
+
+    def preprocess(self, img):
+        return to_chw(img, self.image_size)
+
+    def __call__(self, imgs):
+        # normalized (and flipped) on the device
+        return self.embed(self.model, imgs, self.flip, device=self.device).cpu().numpy()
+
+
+class LatencyStats(object):
+    """ Latency percentiles, throughput and batch size over the last `window` requests """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.done = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+
+    def add(self, done, latencies):
+        with self.lock:
+            self.done.extend((done, latency) for latency in latencies)
+            self.batch_sizes.append(len(latencies))
+
+    def summary(self):
+        with self.lock:
+            done = list(self.done)
+            batch_sizes = list(self.batch_sizes)
+        if not done:
+            return {"requests": 0}
+        latencies = np.array([latency for _, latency in done]) * 1000
+        elapsed = done[-1][0] - done[0][0]
+        return {
+            "requests": len(done),
+            "latency_p50_ms": float(np.percentile(latencies, 50)),
+            "latency_p99_ms": float(np.percentile(latencies, 99)),
+            "throughput": len(done) / elapsed if elapsed > 0 else float("nan"),
+            "batch_size": float(np.mean(batch_sizes))}
+
+
+class DynamicBatcher(threading.Thread):
+    """
+    Runs `backend` on batches of the submitted inputs: a batch is run once it has
+    `max_batch_size` inputs or its first input was submitted `max_latency_ms` ago.
+    """
+
+    def __init__(self, backend, max_batch_size=32, max_latency_ms=5.0, stats=None):
+        super(DynamicBatcher, self).__init__()
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.stats = stats
+        self.queue = queue.Queue()
+        self.daemon = True
+        self.start()
+
+    def submit(self, blob, submitted):
+        future = Future()
+        self.queue.put((blob, future, submitted))
+        return future
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = items[0][2] + self.max_latency
+            while len(items) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    items.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                feats = self.backend(np.stack([blob for blob, _, _ in items]))
+            except Exception as e:
+                for _, future, _ in items:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            for (_, future, _), feat in zip(items, feats):
+                future.set_result(feat)
+            if self.stats is not None:
+                self.stats.add(done, [done - submitted for _, _, submitted in items])
+
+
+class EmbeddingService(object):
+
+    def __init__(self, backend, num_workers=4, max_batch_size=32, max_latency_ms=5.0, normalize=False):
+        self.backend = backend
+        self.normalize = normalize
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.stats = LatencyStats()
+        self.batcher = DynamicBatcher(backend, max_batch_size, max_latency_ms, self.stats)
+
+    def _prepare(self, data, submitted):
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("can not decode the image")
+        return self.batcher.submit(self.backend.preprocess(img), submitted)
+
+    def embed(self, images):
+        """ Encoded images (bytes) to their embeddings, blocks the calling thread """
+        submitted = time.perf_counter()
+        futures = [self.pool.submit(self._prepare, data, submitted) for data in images]
+        feats = [future.result().result() for future in futures]
+        if self.normalize:
+            feats = [feat / np.linalg.norm(feat) for feat in feats]
+        return feats
+
+
+def make_handler(service):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if self.path != "/embed":
+                return self.reply(404, {"error": f"unknown path {self.path}"})
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    images = [base64.b64decode(image) for image in json.loads(body)["images"]]
+                    feats = service.embed(images)
+                    payload = {"embeddings": [feat.tolist() for feat in feats]}
+                else:
+                    payload = {"embedding": service.embed([body])[0].tolist()}
+            except (ValueError, KeyError) as e:
+                return self.reply(400, {"error": str(e)})
+            except Exception as e:
+                return self.reply(500, {"error": str(e)})
+            self.reply(200, payload)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                return self.reply(404, {"error": f"unknown path {self.path}"})
+            self.reply(200, service.stats.summary())
+
+        def reply(self, code, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def address_string(self):
+            # the client address of a Unix socket is an empty string
+            return self.client_address[0] if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def benchmark(service, clients, requests, image):
+    data = cv2.imencode(".png", image)[1].tobytes()
+    per_client = [requests // clients + (i < requests % clients) for i in range(clients)]
+
+    def client(n):
+        for _ in range(n):
+            service.embed([data])
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in per_client]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print("%d requests from %d clients in %.2f s" % (requests, clients, elapsed))
+    print(service.stats.summary())
+
+
+def report(service, every):
+    while True:
+        time.sleep(every)
+        print(service.stats.summary(), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='embedding server with dynamic batching')
+    parser.add_argument('model', type=str, help='onnx model directory or TorchScript file')
+    parser.add_argument('--cpu', action='store_true', help='CPU execution provider / device')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', type=str, default=None, help='serve on this Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=4, help='decode and preprocessing threads')
+    parser.add_argument('--intra-op-threads', type=int, default=0, help='onnxruntime threads, 0: all cores')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-latency-ms', type=float, default=5.0, help='batching deadline of a request')
+    parser.add_argument('--normalize', action='store_true', help='L2-normalize the embeddings')
+    parser.add_argument('--flip', action='store_true', help='flip test, sum of the image and flip embeddings')
+    parser.add_argument('--report-every', type=float, default=60, help='seconds between two stats prints')
+    parser.add_argument('--bench-clients', type=int, default=0, help='run an in-process load test instead')
+    parser.add_argument('--bench-requests', type=int, default=1000)
+    parser.add_argument('--bench-image', type=str, default=None)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.model):
+        backend = ORTBackend(args.model, cpu=args.cpu, max_batch_size=args.max_batch_size, flip=args.flip,
+                             intra_op_threads=args.intra_op_threads)
+    else:
+        backend = TorchScriptBackend(args.model, cpu=args.cpu, flip=args.flip)
+    service = EmbeddingService(backend, args.workers, args.max_batch_size, args.max_latency_ms, args.normalize)
+
+    if args.bench_clients > 0:
+        if args.bench_image is None:
+            image = np.random.randint(0, 255, size=(112, 112, 3), dtype=np.uint8)
+        else:
+            image = cv2.imread(args.bench_image)
+        benchmark(service, args.bench_clients, args.bench_requests, image)
+    else:
+        if args.socket is not None:
+            if os.path.exists(args.socket):
+                os.remove(args.socket)
+            server = ThreadingUnixHTTPServer(args.socket, make_handler(service))
+            print(f"serving on unix:{args.socket}")
+        else:
+            server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+            print(f"serving on http://{args.host}:{args.port}")
+        threading.Thread(target=report, args=(service, args.report_every), daemon=True).start()
+        server.serve_forever()
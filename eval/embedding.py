@@ -0,0 +1,86 @@
+import numpy as np
+import torch
+
+# Flip test of every evaluation and serving path: uint8 RGB NCHW images in, the flipped view is
+# built next to the model and both run as one 2B batch, e.g.:
+# feats = embed(backbone, imgs)                  # [B, D], sum of the image and flip embeddings
+# feats = embed(backbone, imgs, fuse="concat")   # [B, 2D], image then flip embedding (IJB-C layout)
+
+
+def fuse_flip(feat, batch_size, fuse="sum"):
+    """ Embeddings of a [images; flipped images] batch to one row per image """
+    if fuse == "sum":
+        return feat[:batch_size] + feat[batch_size:]
+    if fuse == "concat":
+        if isinstance(feat, np.ndarray):
+            return np.concatenate([feat[:batch_size], feat[batch_size:]], axis=1)
+        return torch.cat([feat[:batch_size], feat[batch_size:]], dim=1)
+    raise ValueError(f"flip fusion not supported: {fuse}")
+
+
+@torch.no_grad()
+def embed(backbone, imgs, flip=True, fuse="sum", device=None):
+    """
+    Parameters:
+    ----------
+    backbone: torch.nn.Module
+        takes the [-1, 1] normalized blobs, on `device` (default: the device of its parameters).
+    imgs: torch.Tensor or np.ndarray
+        uint8 RGB NCHW batch, copied to the device as uint8 and normalized there.
+    fuse: str
+        "sum" or "concat" of the image and flip embeddings, see fuse_flip.
+    """
+    if isinstance(imgs, np.ndarray):
+        imgs = torch.from_numpy(imgs)
+    if device is None:
+        device = next(backbone.parameters()).device
+    batch_size = imgs.shape[0]
+    x = imgs.to(device, non_blocking=True).float()
+    x.sub_(127.5).div_(127.5)
+    if flip:
+        x = torch.cat([x, x.flip(3)])
+    feat = backbone(x).float()
+    return fuse_flip(feat, batch_size, fuse) if flip else feat
+
+
+def embed_blobs(run, imgs, flip=True, fuse="sum", input_mean=127.5, input_std=127.5, dtype=np.float32):
+    """
+    embed for numpy runtimes (onnxruntime sessions, e.g. ArcFaceORT.forward_blob), `run` maps a
+    normalized NCHW blob of `dtype` to the embeddings, the image and flip blob is built in one pass.
+    """
+    imgs = imgs.numpy() if isinstance(imgs, torch.Tensor) else imgs
+    batch_size = imgs.shape[0]
+    blob = np.empty((2 * batch_size if flip else batch_size,) + imgs.shape[1:], dtype=dtype)
+    np.subtract(imgs, input_mean, out=blob[:batch_size], dtype=dtype, casting='unsafe')
+    if flip:
+        np.subtract(imgs[..., ::-1], input_mean, out=blob[batch_size:], dtype=dtype, casting='unsafe')
+    if input_std != 1:
+        blob /= input_std
+    feat = np.asarray(run(blob), dtype=np.float32)
+    return fuse_flip(feat, batch_size, fuse) if flip else feat
+
+
+def embed_dataset(backbone, data, batch_size, flip=True, fuse="sum"):
+    """
+    float32 embeddings of a uint8 image tensor (see images_of), `backbone`: torch.nn.Module or a
+    callable of embed_blobs.
+    """
+    feats = []
+    for ba in range(0, data.shape[0], batch_size):
+        batch = data[ba:ba + batch_size]
+        if isinstance(backbone, torch.nn.Module):
+            feats.append(embed(backbone, batch, flip, fuse).cpu().numpy())
+        else:
+            feats.append(embed_blobs(backbone, batch, flip, fuse))
+    return np.concatenate(feats)
+
+
+def images_of(data_set):
+    """
+    uint8 images of a verification data set (eval.verification.load_bin, Loader_BUPT), also of the
+    data sets pickled before, which held the float images and their flipped copies.
+    """
+    data = data_set[0]
+    if isinstance(data, (list, tuple)):
+        data = data[0].to(torch.uint8)
+    return data
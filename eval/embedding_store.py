@@ -0,0 +1,155 @@
+import json
+
+import numpy as np
+
+# Compact embedding files: a JSON header (shape, storage dtype, metadata such as the model, the
+# flip fusion and the normalization) followed by the embeddings as float32, float16 or int8 with
+# one float32 scale per vector, memory-mapped on load, e.g.:
+# save_embeddings("ijbc.emb", feats, "int8", {"model": "r100", "flip": "sum", "normalization": "none"})
+# store = EmbeddingStore("ijbc.emb")
+# scores = store.scores(queries)               # [Q, N], scanned block by block on the int8 data
+# cos = store.pair_scores(p1, p2, cosine=True) # verification pairs
+# Per million 512-d faces: 2 GB float32, 1 GB float16, 516 MB int8, see benchmark_embedding_store.py.
+
+MAGIC = b"EMBSTORE"
+VERSION = 1
+ALIGNMENT = 64
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def quantize(feats, dtype="float16"):
+    """ (stored array, per-vector scales or None), int8: symmetric, scale = max |x| / 127 """
+    feats = np.asarray(feats, dtype=np.float32)
+    if dtype != "int8":
+        return feats.astype(DTYPES[dtype]), None
+    scales = np.abs(feats).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(feats / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def save_embeddings(path, feats, dtype="float16", metadata=None):
+    """
+    Parameters:
+    ----------
+    feats: np.ndarray
+        [N, D] embeddings.
+    dtype: str
+        "float32", "float16" or "int8".
+    metadata: dict
+        JSON serializable, e.g. {"model": ..., "flip": "sum" | "concat" | "none", "normalization": "l2" | "none"}.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"storage dtype not supported: {dtype}")
+    data, scales = quantize(feats, dtype)
+    header = {"version": VERSION, "dtype": dtype, "shape": list(data.shape), "metadata": metadata or {}}
+    text = json.dumps(header).encode()
+    # the data starts on an aligned offset, so that the memory map is aligned too
+    prefix = len(MAGIC) + 4 + len(text)
+    text += b" " * (-prefix % ALIGNMENT)
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint32(len(text)).tobytes())
+        f.write(text)
+        f.write(np.ascontiguousarray(data).tobytes())
+        if scales is not None:
+            f.write(scales.tobytes())
+    return path
+
+
+def read_header(path):
+    """ (header, data offset) """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an embedding store")
+        size = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(size).decode())
+    if header["version"] > VERSION:
+        raise ValueError(f"{path}: embedding store version {header['version']} not supported")
+    return header, len(MAGIC) + 4 + size
+
+
+class EmbeddingStore(object):
+    """ Embeddings of a save_embeddings file, memory-mapped (`mmap`) or read in memory """
+
+    def __init__(self, path, mmap=True):
+        header, offset = read_header(path)
+        self.path = path
+        self.dtype = header["dtype"]
+        self.metadata = header["metadata"]
+        shape = tuple(header["shape"])
+        dtype = DTYPES[self.dtype]
+        scales_offset = offset + int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if mmap:
+            self.data = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+            self.scales = np.memmap(path, dtype=np.float32, mode="r", offset=scales_offset,
+                                    shape=(shape[0],)) if self.dtype == "int8" else None
+        else:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                self.data = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+                self.scales = np.fromfile(f, dtype=np.float32, count=shape[0]) if self.dtype == "int8" else None
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def dim(self):
+        return self.data.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def to_float32(self, rows=slice(None)):
+        feats = np.asarray(self.data[rows], dtype=np.float32)
+        if self.scales is not None:
+            feats *= np.asarray(self.scales[rows])[:, None]
+        return feats
+
+    def norms(self, rows=slice(None)):
+        norms = np.linalg.norm(np.asarray(self.data[rows], dtype=np.float32), axis=1)
+        return norms if self.scales is None else norms * np.asarray(self.scales[rows])
+
+    def scores(self, queries, block_size=65536, cosine=False):
+        """
+        Inner products [Q, N] of float32 `queries` with the stored embeddings, a block of rows is
+        widened to float32 at a time and the int8 scales are applied to the [Q, block] scores.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if cosine:
+            queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        out = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), block_size):
+            end = min(start + block_size, len(self))
+            block = np.asarray(self.data[start:end], dtype=np.float32)
+            out[:, start:end] = queries @ block.T
+            if cosine:
+                # the int8 scales cancel out
+                out[:, start:end] /= np.maximum(np.linalg.norm(block, axis=1), 1e-12)
+            elif self.scales is not None:
+                out[:, start:end] *= np.asarray(self.scales[start:end])
+        return out
+
+    def pair_scores(self, left, right, block_size=65536, cosine=False):
+        """ Inner products (`cosine`: cosine similarities) of the stored rows left[i] and right[i] """
+        left, right = np.asarray(left), np.asarray(right)
+        out = np.empty(len(left), dtype=np.float32)
+        for start in range(0, len(left), block_size):
+            a_rows, b_rows = left[start:start + block_size], right[start:start + block_size]
+            a = np.asarray(self.data[a_rows], dtype=np.float32)
+            b = np.asarray(self.data[b_rows], dtype=np.float32)
+            score = np.einsum("ij,ij->i", a, b)
+            if cosine:
+                # the int8 scales cancel out
+                score /= np.maximum(np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1), 1e-12)
+            elif self.scales is not None:
+                score *= np.asarray(self.scales[a_rows]) * np.asarray(self.scales[b_rows])
+            out[start:start + block_size] = score
+        return out
+
+
+def load_embeddings(path, mmap=True):
+    """ float32 embeddings and metadata of a save_embeddings file """
+    store = EmbeddingStore(path, mmap)
+    return store.to_float32(), store.metadata
@@ -0,0 +1,241 @@
+import numpy as np
+
+# 1:N search of L2-normalized embeddings (cosine similarity) over a gallery, e.g.:
+# index = ExactIndex(512)                       # or IVFPQIndex(512, nlist=4096, m=64).train(sample)
+# index.add(gallery_feats, subject_ids)          # incremental, can be called again to enroll more
+# scores, ids = index.search(probe_feats, k=10)  # [Q, k] each, best first
+# See benchmark_identification.py (recall@k vs queries/s) and eval_ijbc_1n.py (IJB-C 1:N).
+
+
+def l2_normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def top_k(scores, ids, k):
+    """ The `k` best (highest score first) of every row """
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        ids = np.take_along_axis(ids, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def nearest(x, centroids, spherical=False, block_size=65536):
+    """ Index of the closest centroid of every row, by inner product if `spherical` """
+    bias = 0 if spherical else -0.5 * np.sum(centroids ** 2, axis=1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), block_size):
+        assign[start:start + block_size] = np.argmax(x[start:start + block_size] @ centroids.T + bias, axis=1)
+    return assign
+
+
+def kmeans(x, k, iters=20, seed=0, spherical=False):
+    """ Lloyd's k-means, `spherical`: unit norm centroids for inner product assignment """
+    if len(x) < k:
+        raise ValueError(f"{len(x)} training vectors for {k} centroids")
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = nearest(x, centroids, spherical)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        nonempty = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.add.reduceat(x[order], starts[nonempty], axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+        # empty cells restart from random training vectors
+        empty = np.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+        if spherical:
+            centroids = l2_normalize(centroids)
+    return centroids.astype(np.float32)
+
+
+class ExactIndex(object):
+    """
+    Exhaustive search, the gallery is scanned in blocks of `block_size` rows and the queries
+    in batches of `query_batch`, so that the score matrix stays small.
+    """
+
+    def __init__(self, dim, block_size=16384, query_batch=1024):
+        self.dim = dim
+        self.block_size = block_size
+        self.query_batch = query_batch
+        self.feats = np.empty((0, dim), dtype=np.float32)
+        self.ids = np.empty((0,), dtype=np.int64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, feats, ids=None):
+        """ Enrolls `feats` under `ids` (default: their positions in the gallery) """
+        feats = l2_normalize(feats)
+        n = len(feats)
+        ids = np.arange(self.size, self.size + n) if ids is None else np.asarray(ids, dtype=np.int64)
+        if self.size + n > len(self.feats):
+            # amortized growth, enrolling in small batches does not copy the gallery every time
+            capacity = max(self.size + n, 2 * len(self.feats))
+            grown_feats = np.empty((capacity, self.dim), dtype=np.float32)
+            grown_ids = np.empty((capacity,), dtype=np.int64)
+            grown_feats[:self.size] = self.feats[:self.size]
+            grown_ids[:self.size] = self.ids[:self.size]
+            self.feats, self.ids = grown_feats, grown_ids
+        self.feats[self.size:self.size + n] = feats
+        self.ids[self.size:self.size + n] = ids
+        self.size += n
+        return self
+
+    def search(self, queries, k=10):
+        queries = l2_normalize(queries)
+        k = min(k, self.size)
+        all_scores = np.empty((len(queries), k), dtype=np.float32)
+        all_ids = np.empty((len(queries), k), dtype=np.int64)
+        for qa in range(0, len(queries), self.query_batch):
+            q = queries[qa:qa + self.query_batch]
+            best_scores = np.empty((len(q), 0), dtype=np.float32)
+            best_ids = np.empty((len(q), 0), dtype=np.int64)
+            for start in range(0, self.size, self.block_size):
+                end = min(start + self.block_size, self.size)
+                scores = q @ self.feats[start:end].T
+                scores, ids = top_k(scores, np.broadcast_to(self.ids[start:end], scores.shape), k)
+                best_scores, best_ids = top_k(np.concatenate([best_scores, scores], axis=1),
+                                              np.concatenate([best_ids, ids], axis=1), k)
+            all_scores[qa:qa + len(q)] = best_scores
+            all_ids[qa:qa + len(q)] = best_ids
+        return all_scores, all_ids
+
+    def save(self, path):
+        np.savez(path, feats=self.feats[:self.size], ids=self.ids[:self.size])
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        data = np.load(path)
+        return cls(data["feats"].shape[1], **kwargs).add(data["feats"], data["ids"])
+
+
+class IVFPQIndex(object):
+    """
+    Inverted file with product quantization: the gallery is split in `nlist` k-means cells and
+    every embedding is stored as its cell and the PQ code of its residual to the cell centroid
+    (`m` sub-vectors of 2 ** `nbits` centroids each, m bytes per embedding). A query scans the
+    `nprobe` cells closest to it, the residual scores coming from a lookup table of its
+    sub-vectors against the PQ centroids (asymmetric distance computation).
+    """
+
+    def __init__(self, dim, nlist=1024, m=64, nbits=8, nprobe=16):
+        if dim % m != 0:
+            raise ValueError(f"dim {dim} is not a multiple of m {m}")
+        if nbits > 8:
+            raise ValueError("codes are stored as uint8, nbits <= 8")
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.ksub = 2 ** nbits
+        self.dsub = dim // m
+        self.nprobe = nprobe
+        self.centroids = None
+        self.codebooks = None
+        self.size = 0
+        self.list_codes = [[] for _ in range(nlist)]
+        self.list_ids = [[] for _ in range(nlist)]
+
+    def __len__(self):
+        return self.size
+
+    def train(self, feats, iters=20, max_samples=262144, seed=0):
+        """ Coarse and PQ centroids on (a sample of) `feats`, before any add """
+        x = l2_normalize(feats)
+        if len(x) > max_samples:
+            x = x[np.random.default_rng(seed).choice(len(x), max_samples, replace=False)]
+        self.centroids = kmeans(x, self.nlist, iters, seed, spherical=True)
+        residuals = x - self.centroids[nearest(x, self.centroids, spherical=True)]
+        self.codebooks = np.stack([
+            kmeans(np.ascontiguousarray(residuals[:, i * self.dsub:(i + 1) * self.dsub]), self.ksub, iters, seed)
+            for i in range(self.m)])
+        return self
+
+    def encode(self, residuals):
+        codes = np.empty((len(residuals), self.m), dtype=np.uint8)
+        for i in range(self.m):
+            codes[:, i] = nearest(residuals[:, i * self.dsub:(i + 1) * self.dsub], self.codebooks[i])
+        return codes
+
+    def add(self, feats, ids=None):
+        """ Enrolls `feats` under `ids` (default: their positions in the gallery) """
+        if self.centroids is None:
+            raise ValueError("train the index before adding embeddings")
+        x = l2_normalize(feats)
+        ids = np.arange(self.size, self.size + len(x)) if ids is None else np.asarray(ids, dtype=np.int64)
+        cells = nearest(x, self.centroids, spherical=True)
+        codes = self.encode(x - self.centroids[cells])
+        order = np.argsort(cells, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=self.nlist))])
+        for cell in np.flatnonzero(np.diff(bounds)):
+            rows = order[bounds[cell]:bounds[cell + 1]]
+            self.list_codes[cell].append(codes[rows])
+            self.list_ids[cell].append(ids[rows])
+        self.size += len(x)
+        return self
+
+    def _list(self, cell):
+        # the chunks of successive adds are merged at the first search that reads them
+        if len(self.list_codes[cell]) > 1:
+            self.list_codes[cell] = [np.concatenate(self.list_codes[cell])]
+            self.list_ids[cell] = [np.concatenate(self.list_ids[cell])]
+        if not self.list_codes[cell]:
+            return np.empty((0, self.m), dtype=np.uint8), np.empty((0,), dtype=np.int64)
+        return self.list_codes[cell][0], self.list_ids[cell][0]
+
+    def search(self, queries, k=10, nprobe=None):
+        q = l2_normalize(queries)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        coarse = q @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        # lookup tables [Q, m, ksub]: inner products of the query sub-vectors with the PQ centroids
+        luts = np.einsum("qmd,mkd->qmk", q.reshape(len(q), self.m, self.dsub), self.codebooks)
+        sub = np.arange(self.m)
+        all_scores = np.full((len(q), k), -np.inf, dtype=np.float32)
+        all_ids = np.full((len(q), k), -1, dtype=np.int64)
+        for i in range(len(q)):
+            lists = [self._list(cell) for cell in probes[i]]
+            codes = np.concatenate([codes for codes, _ in lists])
+            if len(codes) == 0:
+                continue
+            ids = np.concatenate([ids for _, ids in lists])
+            base = np.repeat(coarse[i, probes[i]], [len(ids) for _, ids in lists])
+            scores = base + luts[i][sub, codes].sum(axis=1)
+            scores, ids = top_k(scores[None], ids[None], min(k, len(ids)))
+            all_scores[i, :scores.shape[1]] = scores[0]
+            all_ids[i, :ids.shape[1]] = ids[0]
+        return all_scores, all_ids
+
+    def save(self, path):
+        lists = [self._list(cell) for cell in range(self.nlist)]
+        np.savez(path, centroids=self.centroids, codebooks=self.codebooks, nprobe=self.nprobe,
+                 codes=np.concatenate([codes for codes, _ in lists]), ids=np.concatenate([ids for _, ids in lists]),
+                 list_sizes=np.array([len(ids) for _, ids in lists]))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        centroids, codebooks = data["centroids"], data["codebooks"]
+        index = cls(centroids.shape[1], nlist=len(centroids), m=len(codebooks),
+                    nbits=int(np.log2(codebooks.shape[1])), nprobe=int(data["nprobe"]))
+        index.centroids, index.codebooks = centroids, codebooks
+        bounds = np.concatenate([[0], np.cumsum(data["list_sizes"])])
+        for cell in range(index.nlist):
+            if bounds[cell + 1] > bounds[cell]:
+                index.list_codes[cell] = [data["codes"][bounds[cell]:bounds[cell + 1]]]
+                index.list_ids[cell] = [data["ids"][bounds[cell]:bounds[cell + 1]]]
+        index.size = int(bounds[-1])
+        return index
+
+
+def recall_at_k(ids, true_ids, k):
+    """ Fraction of the true `k` nearest neighbours (exact search) found in the first `k` results """
+    hits = [len(np.intersect1d(found[:k], true[:k])) for found, true in zip(ids, true_ids)]
+    return float(np.sum(hits)) / (len(ids) * min(k, true_ids.shape[1]))
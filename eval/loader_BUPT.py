@@ -2,8 +2,6 @@ import sys, os
 import cv2
 import numpy as np
 import torch
-import mxnet as mx
-from mxnet import ndarray as nd
 
 
 class Loader_BUPT:
@@ -67,13 +65,12 @@ class Loader_BUPT:
 
 
     def load_dataset(self, protocol_file, data_dir, image_size, replace_ext='.png'):
+        from utils.utils_recordio import resize_short
         pairs = self.load_protocol(protocol_file)
         pairs = self.update_paths(pairs, data_dir, replace_ext)
 
-        data_list = []
-        for flip in [0, 1]:
-            data = torch.empty((len(pairs)*2, 3, image_size[0], image_size[1]))
-            data_list.append(data)
+        # uint8 images only, the flip test runs on the device (see eval.embedding)
+        data = torch.empty((len(pairs)*2, 3, image_size[0], image_size[1]), dtype=torch.uint8)
 
         issame_list = np.array([bool(pairs[i]['pair_label']) for i in range(len(pairs))])
         races_list = np.array([sorted((pairs[i]['sample0_race'], pairs[i]['sample1_race'])) for i in range(len(pairs))])
@@ -96,18 +93,13 @@ class Loader_BUPT:
             else:
                 img = cv2.imread(pairs[idx_pair]['sample1'])
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            img = mx.nd.array(img)
 
             if img.shape[1] != image_size[0]:
-                img = mx.image.resize_short(img, image_size[0])
-            img = nd.transpose(img, axes=(2, 0, 1))
-            for flip in [0, 1]:
-                if flip == 1:
-                    img = mx.ndarray.flip(data=img, axis=2)
-                data_list[flip][idx][:] = torch.from_numpy(img.asnumpy())
+                img = resize_short(img, image_size[0])
+            data[idx][:] = torch.from_numpy(np.transpose(img, (2, 0, 1)))
             if idx % 1000 == 0:
                 print('loading pair', idx)
-        print(data_list[0].shape)
-        return data_list, issame_list, races_list, subj_list
+        print(data.shape)
+        return data, issame_list, races_list, subj_list
 
 
@@ -28,18 +28,13 @@ import datetime
 import os, sys
 import pickle
 
-import torch
-import mxnet as mx
 import numpy as np
-import sklearn
 import torch
-from mxnet import ndarray as nd
-from scipy import interpolate
-from sklearn.decomposition import PCA
-from sklearn.model_selection import KFold
 
 sys.path.insert(0, "../")
-from backbones import get_model
+from backbones import get_model, optimize_for_inference
+from eval.embedding import embed_dataset, images_of
+from eval.embedding_store import EmbeddingStore, save_embeddings
 
 import argparse   # Bernardo
 import itertools
@@ -47,17 +42,30 @@ import itertools
 from loader_BUPT import Loader_BUPT
 
 
+# mxnet (dumpR), OpenCV (load_bin), sklearn (PCA) and scipy (calculate_val) are imported by the
+# functions that use them, importing this module (e.g. from the training callbacks) only needs numpy
+# and torch
+
+
+def normalize(x):
+    """ Rows of `x` scaled to unit L2 norm, as sklearn.preprocessing.normalize """
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return x / norms
+
+
 class LFold:
+    """ sklearn.model_selection.KFold splits: `n_splits` consecutive folds, the first ones one larger """
+
     def __init__(self, n_splits=2, shuffle=False):
         self.n_splits = n_splits
-        if self.n_splits > 1:
-            self.k_fold = KFold(n_splits=n_splits, shuffle=shuffle)
+        self.shuffle = shuffle
 
     def split(self, indices):
-        if self.n_splits > 1:
-            return self.k_fold.split(indices)
-        else:
+        if self.n_splits <= 1:
             return [(indices, indices)]
+        order = np.random.permutation(len(indices)) if self.shuffle else np.arange(len(indices))
+        return [(np.setdiff1d(order, test), test) for test in np.array_split(order, self.n_splits)]
 
 
 def calculate_roc(thresholds,
@@ -87,12 +95,13 @@ def calculate_roc(thresholds,
             embed1_train = embeddings1[train_set]
             embed2_train = embeddings2[train_set]
             _embed_train = np.concatenate((embed1_train, embed2_train), axis=0)
+            from sklearn.decomposition import PCA
             pca_model = PCA(n_components=pca)
             pca_model.fit(_embed_train)
             embed1 = pca_model.transform(embeddings1)
             embed2 = pca_model.transform(embeddings2)
-            embed1 = sklearn.preprocessing.normalize(embed1)
-            embed2 = sklearn.preprocessing.normalize(embed2)
+            embed1 = normalize(embed1)
+            embed2 = normalize(embed2)
             diff = np.subtract(embed1, embed2)
             dist = np.sum(np.square(diff), 1)
 
@@ -157,6 +166,7 @@ def calculate_val(thresholds,
             _, far_train[threshold_idx] = calculate_val_far(
                 threshold, dist[train_set], actual_issame[train_set])
         if np.max(far_train) >= far_target:
+            from scipy import interpolate
             f = interpolate.interp1d(far_train, thresholds, kind='slinear')
             threshold = f(far_target)
         else:
@@ -214,57 +224,30 @@ def load_bin(path, image_size):
     except UnicodeDecodeError as e:
         with open(path, 'rb') as f:
             bins, issame_list = pickle.load(f, encoding='bytes')  # py3
-    data_list = []
-    for flip in [0, 1]:
-        data = torch.empty((len(issame_list) * 2, 3, image_size[0], image_size[1]))
-        data_list.append(data)
+    from utils.utils_recordio import imdecode, resize_short
+    # uint8 images only, the flip test runs on the device (see eval.embedding)
+    data = torch.empty((len(issame_list) * 2, 3, image_size[0], image_size[1]), dtype=torch.uint8)
     for idx in range(len(issame_list) * 2):
         _bin = bins[idx]
-        img = mx.image.imdecode(_bin)
+        img = imdecode(_bin)
         if img.shape[1] != image_size[0]:
-            img = mx.image.resize_short(img, image_size[0])
-        img = nd.transpose(img, axes=(2, 0, 1))
-        for flip in [0, 1]:
-            if flip == 1:
-                img = mx.ndarray.flip(data=img, axis=2)
-            data_list[flip][idx][:] = torch.from_numpy(img.asnumpy())
+            img = resize_short(img, image_size[0])
+        data[idx][:] = torch.from_numpy(np.transpose(img, (2, 0, 1)))
         if idx % 1000 == 0:
             print('loading bin', idx)
-    print(data_list[0].shape)
-    return data_list, issame_list
+    print(data.shape)
+    return data, issame_list
 
 
 @torch.no_grad()
 def test(data_set, backbone, batch_size, nfolds=10):
-    data_list = data_set[0]
+    data = images_of(data_set)
     issame_list = data_set[1]
-    embeddings_list = []
-    time_consumed = 0.0
-    for i in range(len(data_list)):
-        data = data_list[i]
-        embeddings = None
-        ba = 0
-        while ba < data.shape[0]:
-            bb = min(ba + batch_size, data.shape[0])
-            count = bb - ba
-            _data = data[bb - batch_size: bb]
-            time0 = datetime.datetime.now()
-            img = ((_data / 255) - 0.5) / 0.5
-            # print('img:', img)
-            # print('img.size():', img.size())
-
-            net_out: torch.Tensor = backbone(img)         # original
-            # net_out: torch.Tensor = backbone.forward(img)   # Bernardo
-
-            _embeddings = net_out.detach().cpu().numpy()
-            time_now = datetime.datetime.now()
-            diff = time_now - time0
-            time_consumed += diff.total_seconds()
-            if embeddings is None:
-                embeddings = np.zeros((data.shape[0], _embeddings.shape[1]))
-            embeddings[ba:bb, :] = _embeddings[(batch_size - count):, :]
-            ba = bb
-        embeddings_list.append(embeddings)
+    time0 = datetime.datetime.now()
+    # [image embeddings, flip embeddings], both from one forward per batch
+    embeddings = embed_dataset(backbone, data, batch_size, fuse="concat")
+    time_consumed = (datetime.datetime.now() - time0).total_seconds()
+    embeddings_list = np.split(embeddings, 2, axis=1)
 
     _xnorm = 0.0
     _xnorm_cnt = 0
@@ -277,11 +260,11 @@ def test(data_set, backbone, batch_size, nfolds=10):
     _xnorm /= _xnorm_cnt
 
     embeddings = embeddings_list[0].copy()
-    embeddings = sklearn.preprocessing.normalize(embeddings)
+    embeddings = normalize(embeddings)
     acc1 = 0.0
     std1 = 0.0
     embeddings = embeddings_list[0] + embeddings_list[1]
-    embeddings = sklearn.preprocessing.normalize(embeddings)
+    embeddings = normalize(embeddings)
     print(embeddings.shape)
     print('infer time', time_consumed)
     _, _, accuracy, val, val_std, far = evaluate(embeddings, issame_list, nrof_folds=nfolds)
@@ -421,12 +404,13 @@ def calculate_roc_analyze_races(args, thresholds,
             embed1_train = embeddings1[train_set]
             embed2_train = embeddings2[train_set]
             _embed_train = np.concatenate((embed1_train, embed2_train), axis=0)
+            from sklearn.decomposition import PCA
             pca_model = PCA(n_components=pca)
             pca_model.fit(_embed_train)
             embed1 = pca_model.transform(embeddings1)
             embed2 = pca_model.transform(embeddings2)
-            embed1 = sklearn.preprocessing.normalize(embed1)
-            embed2 = sklearn.preprocessing.normalize(embed2)
+            embed1 = normalize(embed1)
+            embed2 = normalize(embed2)
             # diff = np.subtract(embed1, embed2)
             # dist = np.sum(np.square(diff), 1)
             # dist = cosine_dist(embed1, embed2)
@@ -545,6 +529,7 @@ def calculate_fnmr_fmr_analyze_races(args, thresholds,
             _, fmr_train[threshold_idx] = get_fnmr_fmr_analyze_races(
                 args, threshold, dist[train_set], actual_issame[train_set], races_list=None, subj_list=None, races_combs=None)
 
+        from scipy import interpolate
         f = interpolate.interp1d(fmr_train, thresholds, kind='slinear')
         for fmr_target in fmr_targets:
             threshold = f(fmr_target)
@@ -617,6 +602,7 @@ def calculate_val_analyze_races(args, thresholds,
             _, far_train[threshold_idx] = calculate_val_far_analyze_races(
                 args, threshold, dist[train_set], actual_issame[train_set], races_list=None, subj_list=None, races_combs=None)
         if np.max(far_train) >= far_target:
+            from scipy import interpolate
             f = interpolate.interp1d(far_train, thresholds, kind='slinear')
             threshold = f(far_target)
         else:
@@ -856,7 +842,7 @@ def evaluate_analyze_races(args, name, embeddings, actual_issame, races_list, su
 
 @torch.no_grad()
 def test_analyze_races(args, name, data_set, backbone, batch_size, nfolds=10, races_combs=[]):
-    data_list = data_set[0]
+    data = images_of(data_set)
     issame_list = data_set[1]
     if len(data_set) > 2:
         races_list = data_set[2]
@@ -865,46 +851,23 @@ def test_analyze_races(args, name, data_set, backbone, batch_size, nfolds=10, ra
         races_list, subj_list = None, None
 
     dir_embedd = os.path.dirname(args.data_dir) if os.path.isfile(args.data_dir)  else args.data_dir
-    path_embeddings = os.path.join(dir_embedd, 'embeddings_list.pkl')
+    path_embeddings = os.path.join(dir_embedd, 'embeddings.emb')
 
     if not os.path.exists(path_embeddings) or not args.use_saved_embedd:
         print('\nComputing embeddings...')
-        embeddings_list = []
-        time_consumed = 0.0
-        for i in range(len(data_list)):
-            data = data_list[i]
-            embeddings = None
-            ba = 0
-            while ba < data.shape[0]:
-                bb = min(ba + batch_size, data.shape[0])
-                print(f'{i+1}/{len(data_list)} - {bb}/{data.shape[0]}', end='\r')
-                count = bb - ba
-                _data = data[bb - batch_size: bb]
-                time0 = datetime.datetime.now()
-                img = ((_data / 255) - 0.5) / 0.5
-                # print('img:', img)
-                # print('img.size():', img.size())
-
-                net_out: torch.Tensor = backbone(img)             # original
-                # net_out: torch.Tensor = backbone.forward(img)   # Bernardo
-
-                _embeddings = net_out.detach().cpu().numpy()
-                time_now = datetime.datetime.now()
-                diff = time_now - time0
-                time_consumed += diff.total_seconds()
-                if embeddings is None:
-                    embeddings = np.zeros((data.shape[0], _embeddings.shape[1]))
-                embeddings[ba:bb, :] = _embeddings[(batch_size - count):, :]
-                ba = bb
-            embeddings_list.append(embeddings)
-            print('')
+        time0 = datetime.datetime.now()
+        embeddings = embed_dataset(backbone, data, batch_size, fuse="concat")
+        time_consumed = (datetime.datetime.now() - time0).total_seconds()
         print('infer time', time_consumed)
         
         print(f'Saving embeddings in file \'{path_embeddings}\' ...')
-        write_object_to_file(path_embeddings, embeddings_list)
+        save_embeddings(path_embeddings, embeddings, args.embedd_dtype,
+                        {'model': args.model, 'flip': 'concat', 'normalization': 'none'})
+        # scored as stored, so that --use-saved-embedd reruns report the same metrics
+        embeddings_list = np.split(EmbeddingStore(path_embeddings).to_float32(), 2, axis=1)
     else:
         print(f'Loading embeddings from file \'{path_embeddings}\' ...')
-        embeddings_list = read_object_from_file(path_embeddings)
+        embeddings_list = np.split(EmbeddingStore(path_embeddings).to_float32(), 2, axis=1)
 
     print(f'Normalizing embeddings...')
     _xnorm = 0.0
@@ -918,11 +881,11 @@ def test_analyze_races(args, name, data_set, backbone, batch_size, nfolds=10, ra
     _xnorm /= _xnorm_cnt
 
     embeddings = embeddings_list[0].copy()
-    embeddings = sklearn.preprocessing.normalize(embeddings)
+    embeddings = normalize(embeddings)
     acc1 = 0.0
     std1 = 0.0
     embeddings = embeddings_list[0] + embeddings_list[1]
-    embeddings = sklearn.preprocessing.normalize(embeddings)
+    embeddings = normalize(embeddings)
     print(embeddings.shape)
 
     print('\nDoing races test evaluation...')
@@ -952,6 +915,7 @@ def dumpR(data_set,
           name='',
           data_extra=None,
           label_shape=None):
+    import mxnet as mx
     print('dump verification embedding..')
     data_list = data_set[0]
     issame_list = data_set[1]
@@ -965,7 +929,7 @@ def dumpR(data_set,
             bb = min(ba + batch_size, data.shape[0])
             count = bb - ba
 
-            _data = nd.slice_axis(data, axis=0, begin=bb - batch_size, end=bb)
+            _data = mx.nd.slice_axis(data, axis=0, begin=bb - batch_size, end=bb)
             time0 = datetime.datetime.now()
             if data_extra is None:
                 db = mx.io.DataBatch(data=(_data,), label=(_label,))
@@ -984,7 +948,7 @@ def dumpR(data_set,
             ba = bb
         embeddings_list.append(embeddings)
     embeddings = embeddings_list[0] + embeddings_list[1]
-    embeddings = sklearn.preprocessing.normalize(embeddings)
+    embeddings = normalize(embeddings)
     actual_issame = np.asarray(issame_list)
     outname = os.path.join('temp.bin')
     with open(outname, 'wb') as f:
@@ -1021,6 +985,9 @@ if __name__ == '__main__':
     parser.add_argument('--mode', default=0, type=int, help='')
     parser.add_argument('--nfolds', default=10, type=int, help='')
     parser.add_argument('--use-saved-embedd', action='store_true')
+    parser.add_argument('--embedd-dtype', default='float32', choices=['float32', 'float16', 'int8'],
+                        help='saved (and scored) embeddings, float16 and int8 are smaller but change the metrics slightly; '
+                             'embeddings_list.pkl of former runs is not read, the embeddings are computed again')
 
     parser.add_argument('--fusion-dist', type=str, default='', help='')                 # Bernardo
     parser.add_argument('--score', default='cos-sim', type=str, help='')                # Bernardo ('cos-sim', 'cos-dist' or 'eucl-dist')
@@ -1032,9 +999,6 @@ if __name__ == '__main__':
     image_size = [112, 112]
     print('image_size', image_size)
 
-    ctx = mx.gpu(args.gpu)   # original
-    # ctx = mx.cpu()         # Bernardo
-
     nets = []
     vec = args.model.split(',')
     prefix = args.model.split(',')[0]
@@ -1047,7 +1011,7 @@ if __name__ == '__main__':
     weight = torch.load(args.model)
     resnet = get_model(args.network, dropout=0, fp16=False).cuda()
     resnet.load_state_dict(weight)
-    model = torch.nn.DataParallel(resnet)
+    model = torch.nn.DataParallel(optimize_for_inference(resnet))
     model.eval()
     nets.append(model)
     time_now = datetime.datetime.now()
@@ -15,7 +15,8 @@ import cv2
 import numpy as np
 import torch
 from skimage import transform as trans
-from backbones import get_model
+from backbones import get_model, optimize_for_inference
+from eval.embedding import embed
 from sklearn.metrics import roc_curve, auc
 
 from menpo.visualize.viewmatplotlib import sample_colours_from_colourmap
@@ -59,7 +60,7 @@ class Embedding(object):
         weight = torch.load(prefix)
         resnet = get_model(args.network, dropout=0, fp16=False).cuda()
         resnet.load_state_dict(weight)
-        model = torch.nn.DataParallel(resnet)
+        model = torch.nn.DataParallel(optimize_for_inference(resnet))
         self.model = model
         self.model.eval()
         src = np.array([
@@ -94,20 +95,13 @@ class Embedding(object):
         #                      borderValue=0.0)
         img = rimg
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img_flip = np.fliplr(img)
         img = np.transpose(img, (2, 0, 1))  # 3*112*112, RGB
-        img_flip = np.transpose(img_flip, (2, 0, 1))
-        input_blob = np.zeros((2, 3, self.image_size[1], self.image_size[0]), dtype=np.uint8)
-        input_blob[0] = img
-        input_blob[1] = img_flip
-        return input_blob
+        return img
 
     @torch.no_grad()
     def forward_db(self, batch_data):
-        imgs = torch.Tensor(batch_data).cuda()
-        imgs.div_(255).sub_(0.5).div_(0.5)
-        feat = self.model(imgs)
-        feat = feat.reshape([self.batch_size, 2 * feat.shape[1]])
+        # [image embedding, flip embedding] per row, one forward of the 2B batch
+        feat = embed(self.model, batch_data, fuse="concat")
         return feat.cpu().numpy()
 
 
@@ -164,7 +158,7 @@ def get_image_feature(img_path, files_list, model_path, epoch, gpu_id):
     batch = 0
     img_feats = np.empty((len(files), 1024), dtype=np.float32)
 
-    batch_data = np.empty((2 * batch_size, 3, 112, 112))
+    batch_data = np.empty((batch_size, 3, 112, 112), dtype=np.uint8)
     embedding = Embedding(model_path, data_shape, batch_size)
     for img_index, each_line in enumerate(files[:len(files) - rare_size]):
         name_lmk_score = each_line.strip().split(' ')
@@ -175,8 +169,7 @@ def get_image_feature(img_path, files_list, model_path, epoch, gpu_id):
         lmk = lmk.reshape((5, 2))
         input_blob = embedding.get(img, lmk)
 
-        batch_data[2 * (img_index - batch * batch_size)][:] = input_blob[0]
-        batch_data[2 * (img_index - batch * batch_size) + 1][:] = input_blob[1]
+        batch_data[img_index - batch * batch_size][:] = input_blob
         if (img_index + 1) % batch_size == 0:
             print('batch', batch)
             img_feats[batch * batch_size:batch * batch_size +
@@ -184,7 +177,7 @@ def get_image_feature(img_path, files_list, model_path, epoch, gpu_id):
             batch += 1
         faceness_scores.append(name_lmk_score[-1])
 
-    batch_data = np.empty((2 * rare_size, 3, 112, 112))
+    batch_data = np.empty((rare_size, 3, 112, 112), dtype=np.uint8)
     embedding = Embedding(model_path, data_shape, rare_size)
     for img_index, each_line in enumerate(files[len(files) - rare_size:]):
         name_lmk_score = each_line.strip().split(' ')
@@ -194,8 +187,7 @@ def get_image_feature(img_path, files_list, model_path, epoch, gpu_id):
                        dtype=np.float32)
         lmk = lmk.reshape((5, 2))
         input_blob = embedding.get(img, lmk)
-        batch_data[2 * img_index][:] = input_blob[0]
-        batch_data[2 * img_index + 1][:] = input_blob[1]
+        batch_data[img_index][:] = input_blob
         if (img_index + 1) % rare_size == 0:
             print('batch', batch)
             img_feats[len(files) -
@@ -0,0 +1,127 @@
+import argparse
+import os
+import timeit
+
+import numpy as np
+import pandas as pd
+import prettytable
+
+from eval.embedding_store import EmbeddingStore, save_embeddings
+from eval.identification import ExactIndex, IVFPQIndex
+from onnx_ijbc import AlignedDataSet, extract, image2template_feature, read_template_media_list
+
+# IJB-C (IJB-B) 1:N identification: the probe templates of <target>_1N_probe_mixed.csv searched in
+# the galleries G1 and G2, rank-k identification rate (CMC) of the mated probes and TPIR at FPIR,
+# the non-mated probes being those whose subject is enrolled in the other gallery, e.g.:
+# python eval_ijbc_1n.py --model-root onnx_dir --image-path /data/IJBC --save-features ijbc_feats.emb
+# python eval_ijbc_1n.py --features ijbc_feats.emb --image-path /data/IJBC --index ivfpq --distractors mega.npy
+
+
+def read_template_subject_list(path):
+    meta = pd.read_csv(path, sep=',', header=0, usecols=[0, 1]).drop_duplicates()
+    return meta.values[:, 0].astype(int), meta.values[:, 1].astype(int)
+
+
+def template_lookup(unique_templates, templates):
+    """ Rows of `templates` in the template features, -1 for templates without images """
+    pos = np.clip(np.searchsorted(unique_templates, templates), 0, len(unique_templates) - 1)
+    return np.where(unique_templates[pos] == templates, pos, -1)
+
+
+def evaluate_1n(index, probe_feats, probe_subjects, gallery_subjects, ranks=(1, 5, 10, 20), fpirs=(0.01, 0.1)):
+    """ Rank-k identification rates and TPIR@FPIR, `index` ids: gallery subject ids """
+    scores, ids = index.search(probe_feats, max(ranks))
+    mated = np.isin(probe_subjects, gallery_subjects)
+    hits = ids == probe_subjects[:, None]
+    first_hit = np.where(hits.any(axis=1), hits.argmax(axis=1), max(ranks))
+    result = {f"rank-{r}": float(np.mean(first_hit[mated] < r)) for r in ranks}
+    nonmated_top = scores[~mated, 0]
+    for fpir in fpirs:
+        if len(nonmated_top) == 0:
+            break
+        threshold = np.quantile(nonmated_top, 1 - fpir)
+        result[f"TPIR@FPIR={fpir}"] = float(np.mean(hits[mated, 0] & (scores[mated, 0] > threshold)))
+    return result
+
+
+def build_index(args, feats, ids, distractors):
+    if args.index == "exact":
+        index = ExactIndex(feats.shape[1])
+    else:
+        train = feats if distractors is None else np.concatenate([feats, distractors])
+        index = IVFPQIndex(feats.shape[1], nlist=args.nlist, m=args.m, nprobe=args.nprobe).train(train)
+    index.add(feats, ids)
+    if distractors is not None:
+        # enrolled after the gallery, under an id no probe has
+        for start in range(0, len(distractors), 100000):
+            index.add(distractors[start:start + 100000], np.full(len(distractors[start:start + 100000]), -1))
+    return index
+
+
+def main(args):
+    target = args.target.lower()
+    meta_dir = os.path.join(args.image_path, 'meta')
+    templates, medias = read_template_media_list(os.path.join(meta_dir, '%s_face_tid_mid.txt' % target))
+    files = open(os.path.join(meta_dir, '%s_name_5pts_score.txt' % target)).readlines()
+
+    start = timeit.default_timer()
+    if args.features is not None:
+        store = EmbeddingStore(args.features)
+        img_feats, flip = store.to_float32(), store.metadata.get('flip')
+    else:
+        dataset = AlignedDataSet(root=os.path.join(args.image_path, 'loose_crop'), lines=files, align=True)
+        img_feats, flip = extract(args.model_root, dataset), 'concat'
+    print('Time: %.2f s. ' % (timeit.default_timer() - start))
+
+    # flip test (F2), feature norm (N1) and detector score (D1), as onnx_ijbc.py
+    if flip == 'concat':
+        img_feats = img_feats[:, :img_feats.shape[1] // 2] + img_feats[:, img_feats.shape[1] // 2:]
+    if args.save_features is not None:
+        save_embeddings(args.save_features, img_feats, args.features_dtype,
+                        {'model': args.model_root, 'flip': 'sum', 'normalization': 'none'})
+    img_input_feats = img_feats
+    faceness_scores = np.array([line.split()[-1] for line in files]).astype(np.float32)
+    img_input_feats = img_input_feats * faceness_scores[:, np.newaxis]
+    template_norm_feats, unique_templates = image2template_feature(img_input_feats, templates, medias)
+
+    probe_templates, probe_subjects = read_template_subject_list(
+        os.path.join(meta_dir, '%s_1N_probe_mixed.csv' % target))
+    rows = template_lookup(unique_templates, probe_templates)
+    print('probe templates: %d (%d without images)' % (len(rows), np.sum(rows < 0)))
+    probe_feats, probe_subjects = template_norm_feats[rows[rows >= 0]], probe_subjects[rows >= 0]
+    distractors = np.load(args.distractors).astype(np.float32) if args.distractors else None
+
+    table = None
+    for gallery in ('G1', 'G2'):
+        gallery_templates, gallery_subjects = read_template_subject_list(
+            os.path.join(meta_dir, '%s_1N_gallery_%s.csv' % (target, gallery)))
+        rows = template_lookup(unique_templates, gallery_templates)
+        gallery_feats, gallery_subjects = template_norm_feats[rows[rows >= 0]], gallery_subjects[rows >= 0]
+
+        start = timeit.default_timer()
+        index = build_index(args, gallery_feats, gallery_subjects, distractors)
+        print('%s: %d templates, index built in %.2f s' % (gallery, len(index), timeit.default_timer() - start))
+        start = timeit.default_timer()
+        result = evaluate_1n(index, probe_feats, probe_subjects, gallery_subjects)
+        print('%s: %d probes searched in %.2f s' % (gallery, len(probe_feats), timeit.default_timer() - start))
+        if table is None:
+            table = prettytable.PrettyTable(['Gallery'] + list(result))
+        table.add_row(['%s-%s-%s' % (args.target, gallery, args.index)] + ['%.2f' % (v * 100) for v in result.values()])
+    print(table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='do ijb 1:N test')
+    parser.add_argument('--model-root', default='', help='onnx model directory, see onnx_helper.ArcFaceORT')
+    parser.add_argument('--features', default=None, type=str, help='image features of a previous run (--save-features)')
+    parser.add_argument('--save-features', default=None, type=str, help='embedding store, see eval.embedding_store')
+    parser.add_argument('--features-dtype', default='float32', choices=['float32', 'float16', 'int8'],
+                        help='--save-features storage, float16 and int8 are smaller but lossy')
+    parser.add_argument('--image-path', default='/train_tmp/IJB_release/IJBC', type=str, help='')
+    parser.add_argument('--target', default='IJBC', type=str, help='target, set to IJBC or IJBB')
+    parser.add_argument('--index', default='exact', choices=['exact', 'ivfpq'])
+    parser.add_argument('--nlist', default=256, type=int)
+    parser.add_argument('--m', default=64, type=int)
+    parser.add_argument('--nprobe', default=16, type=int)
+    parser.add_argument('--distractors', default=None, type=str, help='.npy embeddings added to both galleries')
+    main(parser.parse_args())
@@ -16,7 +16,9 @@ import cv2
 import numpy as np
 import torch
 from skimage import transform as trans
-from backbones import get_model
+from backbones import get_model, optimize_for_inference
+from eval.embedding import embed
+from eval.embedding_store import EmbeddingStore, save_embeddings
 from sklearn.metrics import roc_curve, auc
 
 from menpo.visualize.viewmatplotlib import sample_colours_from_colourmap
@@ -50,6 +52,9 @@ parser.add_argument('--result-dir', default='results_ijbc_template', type=str, h
 parser.add_argument('--batch-size', default=128, type=int, help='')
 parser.add_argument('--job', default='insightface', type=str, help='job name')
 parser.add_argument('--target', default='IJBC', type=str, help='target, set to IJBC or IJBB')
+parser.add_argument('--feats-dtype', default='float32', choices=['float32', 'float16', 'int8'],
+                    help='saved (and scored) image features, float16 and int8 are smaller but change the metrics slightly; '
+                         'img_feats.npy of former runs is not read, the features are computed again')
 parser.add_argument('--majority-voting', action='store_true')
 args = parser.parse_args()
 
@@ -113,21 +118,13 @@ class Embedding(object):
         img = rimg   # Bernardo
 
         # img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img_flip = np.fliplr(img)
         img = np.transpose(img, (2, 0, 1))  # 3*112*112, RGB
-        img_flip = np.transpose(img_flip, (2, 0, 1))
-        input_blob = np.zeros((2, 3, self.image_size[1], self.image_size[0]), dtype=np.uint8)
-        # input_blob = np.zeros((2, self.image_size[1], self.image_size[0], 3), dtype=np.uint8)
-        input_blob[0] = img
-        input_blob[1] = img_flip
-        return input_blob
+        return img
 
     @torch.no_grad()
     def forward_db(self, batch_data, model):
-        imgs = torch.Tensor(batch_data).cuda()
-        imgs.div_(255).sub_(0.5).div_(0.5)
-        feat = model(imgs)
-        feat = feat.reshape([self.batch_size, 2 * feat.shape[1]])
+        # [image embedding, flip embedding] per row, one forward of the 2B batch
+        feat = embed(model, batch_data, fuse="concat")
         return feat.cpu().numpy()
 
 
@@ -191,12 +188,12 @@ def get_image_feature(img_path, files_list, model_path, epoch, gpu_id):
     weight = torch.load(model_path)
     resnet = get_model(args.network, dropout=0, fp16=False).cuda()
     resnet.load_state_dict(weight)
-    model = torch.nn.DataParallel(resnet)
+    model = torch.nn.DataParallel(optimize_for_inference(resnet))
     # self.model = model
     model.eval()
 
     with torch.no_grad():
-        batch_data = np.empty((2 * batch_size, 3, 112, 112))
+        batch_data = np.empty((batch_size, 3, 112, 112), dtype=np.uint8)
         # batch_data = np.empty((2 * batch_size, 112, 112, 3))
         embedding = Embedding(model_path, data_shape, batch_size)
         for img_index, each_line in enumerate(files[:len(files) - rare_size]):
@@ -207,8 +204,7 @@ def get_image_feature(img_path, files_list, model_path, epoch, gpu_id):
                         dtype=np.float32)
             lmk = lmk.reshape((5, 2))
             input_blob = embedding.get(img, lmk)
-            batch_data[2 * (img_index - batch * batch_size)][:] = input_blob[0]
-            batch_data[2 * (img_index - batch * batch_size) + 1][:] = input_blob[1]
+            batch_data[img_index - batch * batch_size][:] = input_blob
             if (img_index + 1) % batch_size == 0:
                 print('batch', batch)
                 img_feats[batch * batch_size:batch * batch_size +
@@ -216,7 +212,7 @@ def get_image_feature(img_path, files_list, model_path, epoch, gpu_id):
                 batch += 1
             faceness_scores.append(name_lmk_score[-1])
 
-        batch_data = np.empty((2 * rare_size, 3, 112, 112))
+        batch_data = np.empty((rare_size, 3, 112, 112), dtype=np.uint8)
         # batch_data = np.empty((2 * rare_size, 112, 112, 3))
         embedding = Embedding(model_path, data_shape, rare_size)
         for img_index, each_line in enumerate(files[len(files) - rare_size:]):
@@ -227,8 +223,7 @@ def get_image_feature(img_path, files_list, model_path, epoch, gpu_id):
                         dtype=np.float32)
             lmk = lmk.reshape((5, 2))
             input_blob = embedding.get(img, lmk)
-            batch_data[2 * img_index][:] = input_blob[0]
-            batch_data[2 * img_index + 1][:] = input_blob[1]
+            batch_data[img_index][:] = input_blob
             if (img_index + 1) % rare_size == 0:
                 print('batch', batch)
                 img_feats[len(files) -
@@ -526,7 +521,7 @@ exper_id = model_path.split('/')[-2]            # Bernardo
 save_path = os.path.join(result_dir, exper_id)  # Bernardo
 score_save_file = os.path.join(save_path, "%s.npy" % target.lower())
 label_save_file = os.path.join(save_path, "label.npy")
-img_feats_save_file = os.path.join(save_path, "img_feats.npy")
+img_feats_save_file = os.path.join(save_path, "img_feats.emb")
 faceness_scores_save_file = os.path.join(save_path, "faceness_scores.npy")
 templ_sampl_score_save_file = os.path.join(save_path, "%s_templ_sampl_score.npy" % target.lower())
 
@@ -602,13 +597,21 @@ if not os.path.exists(img_feats_save_file):
 
     # score_save_file = os.path.join(save_path, "%s.npy" % target.lower())
     print('Saving img_feats:', img_feats_save_file)
-    np.save(img_feats_save_file, img_feats)
+    # [image, flip] embeddings fused into one, stored as args.feats_dtype
+    if use_flip_test:
+        img_feats = img_feats[:, 0:img_feats.shape[1] // 2] + img_feats[:, img_feats.shape[1] // 2:]
+    else:
+        img_feats = img_feats[:, 0:img_feats.shape[1] // 2]
+    save_embeddings(img_feats_save_file, img_feats, args.feats_dtype,
+                    {'model': model_path, 'flip': 'sum' if use_flip_test else 'none', 'normalization': 'none'})
+    # the saved (quantized) features, as the next runs read them
+    img_feats = EmbeddingStore(img_feats_save_file).to_float32()
     print('Saving faceness_scores:', img_feats_save_file)
     np.save(faceness_scores_save_file, faceness_scores)
 
 else:
     print('Loading img_feats:', img_feats_save_file)
-    img_feats = np.load(img_feats_save_file)
+    img_feats = EmbeddingStore(img_feats_save_file).to_float32()
     print('Loading faceness_scores:', faceness_scores_save_file)
     faceness_scores = np.load(faceness_scores_save_file)
 
@@ -630,14 +633,8 @@ start = timeit.default_timer()
 # 1. FaceScore （Feature Norm）
 # 2. FaceScore （Detector）
 
-if use_flip_test:
-    # concat --- F1
-    # img_input_feats = img_feats
-    # add --- F2
-    img_input_feats = img_feats[:, 0:img_feats.shape[1] //
-                                    2] + img_feats[:, img_feats.shape[1] // 2:]
-else:
-    img_input_feats = img_feats[:, 0:img_feats.shape[1] // 2]
+# flip test (F2) fused before saving img_feats, see its "flip" metadata
+img_input_feats = img_feats
 
 if use_norm_score:
     img_input_feats = img_input_feats
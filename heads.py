@@ -0,0 +1,198 @@
+import numpy as np
+import torch
+from torch.nn.functional import normalize
+from torch.nn.parallel import DistributedDataParallel
+
+from backbones import get_model
+from losses import CombinedMarginLoss
+from losses_frcsyn import LDAMLoss
+from multi_task_head import MultiTaskHead
+from partial_fc import PartialFC, PartialFCAdamW
+from partial_fc_v2 import PartialFC_V2
+from utils.utils_compile import compile_function
+
+
+def get_margin_loss(cfg):
+    return CombinedMarginLoss(
+        64,
+        cfg.margin_list[0],
+        cfg.margin_list[1],
+        cfg.margin_list[2],
+        cfg.interclass_filtering_threshold
+    )
+
+
+def _unwrap(module):
+    return module.module if isinstance(module, DistributedDataParallel) else module
+
+
+class Head(object):
+    """
+    A training head, computes its losses from the backbone embeddings and the batch labels.
+    `modules` maps a checkpoint key (saved as "state_dict_<key>") to a module, `param_groups`
+    are added to the optimizer after the backbone, in the order of the heads (the order of the
+    optimizer state of the checkpoints), `partial_fc_groups` after every other group and
+    `clip_groups` are clipped to a max norm of 5, as the backbone.
+    Calling a head returns the loss added to the total loss and the losses to log, by label.
+    """
+
+    def __init__(self, cfg, train_loader, local_rank):
+        self.cfg = cfg
+        self.local_rank = local_rank
+        self.modules = {}
+        self.param_groups = []
+        self.partial_fc_groups = []
+        self.clip_groups = []
+        self.optimizer = None
+
+    def ddp(self, module):
+        module = DistributedDataParallel(
+            module=module, broadcast_buffers=False, device_ids=[self.local_rank], bucket_cap_mb=16,
+            find_unused_parameters=True)
+        module.train()
+        module._set_static_graph()
+        return module
+
+    def __call__(self, local_embeddings, labels):
+        raise NotImplementedError
+
+    def compile(self, mode, backend, suppress_errors=False):
+        """ Compiles the margin logits of every PartialFC_V2 of the head """
+        for key, module in self.modules.items():
+            module = _unwrap(module)
+            if isinstance(module, PartialFC_V2):
+                module.margin_logits = compile_function(
+                    module.margin_logits, mode, backend, f"{key}.margin_logits", suppress_errors)
+
+    def state_dict(self):
+        return {f"state_dict_{key}": _unwrap(module).state_dict() for key, module in self.modules.items()}
+
+    def load_state_dict(self, checkpoint):
+        for key, module in self.modules.items():
+            _unwrap(module).load_state_dict(checkpoint[f"state_dict_{key}"])
+
+
+class IdentityHead(Head):
+    """ Identity classification: PartialFC_V2 (PartialFC with `partial_fc_version` 1) or LDAMLoss """
+
+    def __init__(self, cfg, train_loader, local_rank):
+        super(IdentityHead, self).__init__(cfg, train_loader, local_rank)
+        if cfg.loss == "LDAMLoss":
+            cls_num_list = train_loader.dataset.get_cls_num_list()
+            per_cls_weights = None
+            if cfg.train_rule == "Reweight":
+                beta = 0.9999
+                effective_num = 1.0 - np.power(beta, cls_num_list)
+                per_cls_weights = (1.0 - beta) / np.array(effective_num)
+                per_cls_weights = per_cls_weights / np.sum(per_cls_weights) * len(cls_num_list)
+                per_cls_weights = torch.FloatTensor(per_cls_weights).cuda()
+            module = LDAMLoss(cls_num_list=cls_num_list, max_m=0.5, s=64, weight=per_cls_weights,
+                              num_classes=cfg.num_classes, embedding_size=cfg.embedding_size)
+        elif cfg.loss == "CombinedMarginLoss" and cfg.partial_fc_version == 1:
+            # the params of partial fc v1 must be the last group of the optimizer (partial_fc_groups)
+            module = (PartialFC if cfg.optimizer == "sgd" else PartialFCAdamW)(
+                get_margin_loss(cfg), cfg.embedding_size, cfg.num_classes,
+                cfg.sample_rate, cfg.fp16)
+        elif cfg.loss == "CombinedMarginLoss":
+            module = PartialFC_V2(
+                get_margin_loss(cfg), cfg.embedding_size, cfg.num_classes,
+                cfg.sample_rate, cfg.fp16, cfg.sparse_optimizer, cfg.pfc_offload, cfg.output)
+        else:
+            raise ValueError(f"loss not supported: {cfg.loss}")
+        self.module_partial_fc = module.train().cuda()
+        self.modules["softmax_fc"] = self.module_partial_fc
+        if isinstance(module, (PartialFC, PartialFCAdamW)):
+            self.partial_fc_groups.append({"params": module.parameters()})
+        else:
+            # right after the backbone, as in the optimizers of the former training scripts
+            self.param_groups.append({"params": module.parameters()})
+
+    def __call__(self, local_embeddings, labels):
+        if isinstance(self.module_partial_fc, (PartialFC, PartialFCAdamW)):
+            loss = self.module_partial_fc(local_embeddings, labels["id"], self.optimizer)
+        else:
+            loss = self.module_partial_fc(local_embeddings, labels["id"])
+        return loss, {"id": loss}
+
+
+class RaceDiscriminatorHead(Head):
+    """
+    Race classification from the normalized embedding by a small backbone (`network_discrim`),
+    added to the identity loss with the weight `alfa_discrim`.
+    """
+
+    def __init__(self, cfg, train_loader, local_rank):
+        super(RaceDiscriminatorHead, self).__init__(cfg, train_loader, local_rank)
+        self.alfa = cfg.alfa_discrim
+        self.backbone_discrim = self.ddp(get_model(
+            cfg.network_discrim, dropout=0.0, fp16=cfg.fp16, num_features=cfg.embedding_size_discrim).cuda())
+        self.module_partial_fc_discrim = PartialFC_V2(
+            get_margin_loss(cfg), cfg.embedding_size_discrim, cfg.num_classes_races, 1.0, cfg.fp16)
+        self.module_partial_fc_discrim.train().cuda()
+        self.modules["backbone_discrim"] = self.backbone_discrim
+        self.modules["softmax_fc_discrim"] = self.module_partial_fc_discrim
+        self.param_groups.append({"params": self.backbone_discrim.parameters()})
+        self.param_groups.append({"params": self.module_partial_fc_discrim.parameters()})
+        self.clip_groups.append(list(self.backbone_discrim.parameters()))
+
+    def __call__(self, local_embeddings, labels):
+        local_embeddings_normalized = torch.unsqueeze(normalize(local_embeddings, dim=1), 1)
+        discrim_embeddings = self.backbone_discrim(local_embeddings_normalized)
+        loss_discrim = self.module_partial_fc_discrim(discrim_embeddings, labels["race"])
+        return self.alfa * loss_discrim, {"discrim": loss_discrim}
+
+
+class AttributeHead(Head):
+    """ One PartialFC_V2 per attribute of `attribute_heads`, directly on the embeddings """
+
+    def __init__(self, cfg, train_loader, local_rank):
+        super(AttributeHead, self).__init__(cfg, train_loader, local_rank)
+        self.loss_weights = cfg.attribute_loss_weights
+        self.modules_partial_fc = {}
+        for name, num_classes in cfg.attribute_heads.items():
+            module = PartialFC_V2(get_margin_loss(cfg), cfg.embedding_size, num_classes, 1.0, cfg.fp16)
+            self.modules_partial_fc[name] = module.train().cuda()
+            self.modules[f"softmax_fc_{name}"] = module
+            self.param_groups.append({"params": module.parameters()})
+
+    def __call__(self, local_embeddings, labels):
+        losses = {name: module(local_embeddings, labels[name]) for name, module in self.modules_partial_fc.items()}
+        loss = sum(self.loss_weights.get(name, 1.0) * value for name, value in losses.items())
+        return loss, losses
+
+
+class MultiTaskAttributeHead(Head):
+    """ All attributes of `attribute_heads` in a single fused MultiTaskHead """
+
+    def __init__(self, cfg, train_loader, local_rank):
+        super(MultiTaskAttributeHead, self).__init__(cfg, train_loader, local_rank)
+        module = MultiTaskHead(
+            get_margin_loss(cfg), cfg.embedding_size, cfg.attribute_heads, cfg.attribute_hidden_size,
+            cfg.attribute_loss_weights, cfg.attribute_mode, cfg.attribute_alpha, cfg.fp16).cuda()
+        self.module_multi_task = DistributedDataParallel(
+            module=module, broadcast_buffers=False, device_ids=[local_rank], bucket_cap_mb=16)
+        self.module_multi_task.train()
+        self.names = module.names
+        self.modules["multi_task"] = self.module_multi_task
+        self.param_groups.append({"params": self.module_multi_task.parameters()})
+
+    def __call__(self, local_embeddings, labels):
+        loss, loss_heads = self.module_multi_task(local_embeddings, labels)
+        return loss, {name: loss_heads[i] for i, name in enumerate(self.names)}
+
+
+HEADS = {
+    "id": IdentityHead,
+    "race_discrim": RaceDiscriminatorHead,
+    "attributes": AttributeHead,
+    "multi_task": MultiTaskAttributeHead,
+}
+
+
+def get_heads(names, cfg, train_loader, local_rank):
+    heads = []
+    for name in names:
+        if name not in HEADS:
+            raise ValueError(f"head not supported: {name}, choose from {list(HEADS)}")
+        heads.append(HEADS[name](cfg, train_loader, local_rank))
+    return heads
@@ -4,7 +4,7 @@ import cv2
 import numpy as np
 import torch
 
-from backbones import get_model
+from backbones import get_model, optimize_for_inference
 
 
 @torch.no_grad()
@@ -21,7 +21,7 @@ def inference(weight, name, img):
     img.div_(255).sub_(0.5).div_(0.5)
     net = get_model(name, fp16=False)
     net.load_state_dict(torch.load(weight))
-    net.eval()
+    net = optimize_for_inference(net)
     feat = net(img).numpy()
     print(feat)
 
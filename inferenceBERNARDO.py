@@ -4,7 +4,7 @@ import cv2
 import numpy as np
 import torch
 
-from backbones import get_model
+from backbones import get_model, optimize_for_inference
 
 
 def cosine_similarity(embedd1, embedd2):
@@ -23,8 +23,7 @@ def get_face_embedd(model, img):
 def load_trained_model(network, path_weights):
     net = get_model(network, fp16=False)
     net.load_state_dict(torch.load(path_weights))
-    net.eval()
-    return net
+    return optimize_for_inference(net)
 
 
 def load_normalize_img(img):
@@ -25,32 +25,34 @@ class CombinedMarginLoss(torch.nn.Module):
 
 
     def forward(self, logits, labels):
-        index_positive = torch.where(labels != -1)[0]
+        # rows without a positive class (label -1) are masked instead of indexed,
+        # boolean indexing would synchronize the device to know the number of rows
+        labels = labels.view(-1, 1)
+        index_positive = labels != -1
+        labels_positive = labels.clamp(min=0)
 
         if self.interclass_filtering_threshold > 0:
             with torch.no_grad():
                 dirty = logits > self.interclass_filtering_threshold
                 dirty = dirty.float()
-                mask = torch.ones([index_positive.size(0), logits.size(1)], device=logits.device)
-                mask.scatter_(1, labels[index_positive], 0)
-                dirty[index_positive] *= mask
+                dirty.scatter_(1, labels_positive, dirty.gather(1, labels_positive) * ~index_positive)
                 tensor_mul = 1 - dirty    
             logits = tensor_mul * logits
 
-        target_logit = logits[index_positive, labels[index_positive].view(-1)]
+        target_logit = logits.gather(1, labels_positive)
 
         if self.m1 == 1.0 and self.m3 == 0.0:
             with torch.no_grad():
                 target_logit.arccos_()
                 logits.arccos_()
-                final_target_logit = target_logit + self.m2
-                logits[index_positive, labels[index_positive].view(-1)] = final_target_logit
+                final_target_logit = torch.where(index_positive, target_logit + self.m2, target_logit)
+                logits.scatter_(1, labels_positive, final_target_logit)
                 logits.cos_()
             logits = logits * self.s        
 
         elif self.m3 > 0:
-            final_target_logit = target_logit - self.m3
-            logits[index_positive, labels[index_positive].view(-1)] = final_target_logit
+            final_target_logit = torch.where(index_positive, target_logit - self.m3, target_logit)
+            logits = logits.scatter(1, labels_positive, final_target_logit)
             logits = logits * self.s
         else:
             raise
@@ -0,0 +1,131 @@
+from typing import Callable
+
+import torch
+from torch.nn.functional import cross_entropy, normalize
+
+
+class GradientReverseFunc(torch.autograd.Function):
+    """Identity in forward, multiplies the gradient by -alpha in backward"""
+
+    @staticmethod
+    def forward(ctx, x, alpha):
+        ctx.alpha = alpha
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad):
+        return grad.neg() * ctx.alpha, None
+
+
+GradientReverse = GradientReverseFunc.apply
+
+
+class MultiTaskHead(torch.nn.Module):
+    """
+    All attribute heads (e.g. age, gender and race) of the multi-task training as one module.
+    The per-head MLPs are fused into a single linear layer and the cosine classifiers of all
+    heads into a single batched matmul, so the heads run a handful of kernels and, wrapped in
+    one DistributedDataParallel, a single gradient all-reduce. With 2 to 8 classes per head
+    there is no need for model parallelism, each rank computes the loss of its local batch.
+    Modes:
+    ------
+    collaborative: the backbone is trained to also predict the attributes.
+    adversarial: the gradient of the heads is reversed (scaled by `alpha`) before entering the
+        backbone, the heads learn the attributes while the backbone learns to hide them.
+    Example:
+    --------
+    >>> head = MultiTaskHead(margin_loss, 512, {"age": 8, "gender": 2, "race": 6})
+    >>> loss_attributes, loss_heads = head(embeddings, {"age": age, "gender": gender, "race": race})
+    >>> loss = loss_id + loss_attributes
+    """
+
+    def __init__(
+        self,
+        margin_loss: Callable,
+        embedding_size: int,
+        heads: dict,
+        hidden_size: int = 256,
+        loss_weights: dict = None,
+        mode: str = "collaborative",
+        alpha: float = 1.0,
+        fp16: bool = False,
+    ):
+        """
+        Paramenters:
+        -----------
+        heads: dict
+            Name and number of classes of every head.
+        hidden_size: int
+            Output size of the per-head MLP, as `MLP_1layer(embedding_size, hidden_size)`.
+        loss_weights: dict
+            Weight of every head in the returned loss, default is 1.0.
+        mode: str
+            "collaborative" or "adversarial".
+        alpha: float
+            Scale of the reversed gradient in adversarial mode.
+        """
+        super(MultiTaskHead, self).__init__()
+        if mode not in ("collaborative", "adversarial"):
+            raise ValueError(f"mode must be 'collaborative' or 'adversarial', got {mode}")
+        if not isinstance(margin_loss, Callable):
+            raise
+        self.margin_softmax = margin_loss
+        self.names = list(heads)
+        self.num_classes = [heads[name] for name in self.names]
+        self.hidden_size = hidden_size
+        self.mode = mode
+        self.alpha = alpha
+        self.fp16 = fp16
+
+        num_heads = len(self.names)
+        max_classes = max(self.num_classes)
+        self.fc1 = torch.nn.Linear(embedding_size, hidden_size * num_heads)
+        self.weight = torch.nn.Parameter(torch.normal(0, 0.01, (num_heads, max_classes, hidden_size)))
+
+        class_mask = torch.zeros(num_heads, max_classes, dtype=torch.bool)
+        for i, num_classes in enumerate(self.num_classes):
+            class_mask[i, :num_classes] = True
+        loss_weights = loss_weights or {}
+        self.register_buffer("class_mask", class_mask, persistent=False)
+        self.register_buffer("num_classes_per_head", torch.tensor(self.num_classes), persistent=False)
+        self.register_buffer(
+            "loss_weights", torch.tensor([float(loss_weights.get(name, 1.0)) for name in self.names]),
+            persistent=False)
+
+    def forward(self, local_embeddings: torch.Tensor, local_labels: dict):
+        """
+        Parameters:
+        ----------
+        local_embeddings: torch.Tensor
+            feature embeddings on each GPU(Rank).
+        local_labels: dict
+            labels of every head on each GPU(Rank), -1 (or any label out of range) is ignored.
+        Returns:
+        -------
+        loss: torch.Tensor
+            weighted sum of the head losses.
+        loss_heads: torch.Tensor
+            loss of every head, in the order of `self.names`.
+        """
+        batch_size = local_embeddings.size(0)
+        num_heads = len(self.names)
+        labels = torch.stack([local_labels[name].view(-1).long() for name in self.names], dim=1)
+        labels = labels.masked_fill((labels < 0) | (labels >= self.num_classes_per_head), -1)
+
+        x = local_embeddings
+        if self.mode == "adversarial":
+            x = GradientReverse(x, self.alpha)
+
+        with torch.cuda.amp.autocast(self.fp16):
+            hidden = torch.relu(self.fc1(x)).view(batch_size, num_heads, self.hidden_size)
+            logits = torch.einsum("bhd,hcd->bhc", normalize(hidden, dim=2), normalize(self.weight, dim=2))
+        logits = logits.float().reshape(batch_size * num_heads, -1).clamp(-1, 1)
+
+        labels = labels.view(-1, 1)
+        logits = self.margin_softmax(logits, labels)
+        logits = logits.masked_fill(~self.class_mask.repeat(batch_size, 1), float("-inf"))
+
+        loss = cross_entropy(logits, labels.view(-1), ignore_index=-1, reduction="none")
+        valid = (labels.view(batch_size, num_heads) != -1).float()
+        loss_heads = (loss.view(batch_size, num_heads) * valid).sum(0) / valid.sum(0).clamp_min(1)
+        return (loss_heads * self.loss_weights).sum(), loss_heads
@@ -4,22 +4,108 @@ import os
 import os.path as osp
 import glob
 import numpy as np
-import cv2
 import sys
+import time
 import onnxruntime
-import onnx
 import argparse
-from onnx import numpy_helper
-from insightface.data import get_image
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+def create_session(model_file, providers=None, intra_op_threads=0, inter_op_threads=0,
+                   graph_optimization='all', mem_arena=True, parallel=False, optimized_model_file=None):
+    """
+    Parameters:
+    ----------
+    intra_op_threads, inter_op_threads: int
+        threads of one operator and across operators (parallel execution only), 0 lets onnxruntime
+        choose, e.g. intra_op_threads = physical cores / concurrent sessions on a serving node.
+    graph_optimization: str
+        "disable", "basic", "extended" or "all".
+    mem_arena: bool
+        CPU memory arena, keeps the activations allocated from one run to the next.
+    optimized_model_file: str
+        saves the optimized graph there (see torch2onnx.optimize_onnx).
+    """
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization]
+    options.enable_cpu_mem_arena = mem_arena
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL if parallel else onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    if optimized_model_file is not None:
+        options.optimized_model_filepath = optimized_model_file
+    return onnxruntime.InferenceSession(model_file, sess_options=options, providers=providers)
+
+
+class BoundBuffers(object):
+    """
+    Preallocated input and output arrays bound to a session (IO binding), `ring` sets per batch
+    size used in turn, so running a batch allocates nothing. The output of a batch stays valid
+    until `ring` more batches of the same size have run.
+    """
+
+    def __init__(self, session, input_name, output_name, image_size, feat_dim, ring=2, dtype=np.float32):
+        self.session = session
+        self.dtype = dtype
+        self.input_name = input_name
+        self.output_name = output_name
+        self.image_size = image_size
+        self.feat_dim = feat_dim
+        self.ring = ring
+        self.slots = {}
+        self.turn = {}
+
+    def _bind(self, batch_size):
+        blob = np.empty((batch_size, 3, self.image_size[1], self.image_size[0]), dtype=self.dtype)
+        out = np.empty((batch_size, self.feat_dim), dtype=np.float32)
+        # OrtValues of CPU numpy arrays share their memory
+        blob_value = onnxruntime.OrtValue.ortvalue_from_numpy(blob)
+        out_value = onnxruntime.OrtValue.ortvalue_from_numpy(out)
+        binding = self.session.io_binding()
+        binding.bind_ortvalue_input(self.input_name, blob_value)
+        binding.bind_ortvalue_output(self.output_name, out_value)
+        return blob, out, binding, (blob_value, out_value)
+
+    def next(self, batch_size):
+        """ (input, output, binding) of the next slot for `batch_size` """
+        if batch_size not in self.slots:
+            self.slots[batch_size] = [self._bind(batch_size) for _ in range(self.ring)]
+            self.turn[batch_size] = 0
+        turn = self.turn[batch_size]
+        self.turn[batch_size] = (turn + 1) % self.ring
+        return self.slots[batch_size][turn][:3]
+
+    def run(self, binding):
+        self.session.run_with_iobinding(binding)
+
 
 class ArcFaceORT:
-    def __init__(self, model_path, cpu=False):
+    def __init__(self, model_path, cpu=False, io_binding=False, ring=2, **session_options):
+        """
+        session_options: see create_session, io_binding: run the batches on preallocated buffers
+        (see BoundBuffers), forward and forward_blob then return views of them that the next
+        `ring` batches of the same size overwrite, copy the outputs that are kept.
+        """
         self.model_path = model_path
         # providers = None will use available provider, for onnxruntime-gpu it will be "CUDAExecutionProvider"
         self.providers = ['CPUExecutionProvider'] if cpu else None
+        self.io_binding = io_binding
+        self.ring = ring
+        self.session_options = session_options
+        self.buffers = None
 
     #input_size is (w,h), return error message, return None if success
-    def check(self, track='cfat', test_img = None):
+    # quantized: accept int8/uint8 initializers (weights, zero points of a quantized model, see quantization.py)
+    def check(self, track='cfat', test_img = None, quantized=False):
+        import cv2
+        import onnx
+        from onnx import numpy_helper
         #default is cfat
         max_model_size_mb=1024
         max_feat_dim=512
@@ -43,6 +129,53 @@ class ArcFaceORT:
         else:
             return "track not found"
 
+        err = self.prepare(track)
+        if err is not None:
+            return err
+
+        self.model_size_mb = os.path.getsize(self.model_file) / float(1024*1024)
+        if self.model_size_mb > max_model_size_mb:
+            return "max model size exceed, given %.3f-MB"%self.model_size_mb
+
+        model = onnx.load(self.model_file)
+        for initn in model.graph.initializer:
+            weight_array = numpy_helper.to_array(initn)
+            dt = weight_array.dtype
+            if quantized and dt in (np.int8, np.uint8):
+                continue
+            if dt.itemsize<4:
+                return 'invalid weight type - (%s:%s)' % (initn.name, dt.name)
+        if test_img is None:
+            from insightface.data import get_image
+            test_img = get_image('Tom_Hanks_54745')
+            test_img = cv2.resize(test_img, self.image_size)
+        else:
+            test_img = cv2.resize(test_img, self.image_size)
+        feat, cost = self.benchmark(test_img)
+        batch_result = self.check_batch(test_img)
+        batch_result_sum = float(np.sum(batch_result))
+        if batch_result_sum in [float('inf'), -float('inf')] or batch_result_sum != batch_result_sum:
+            print(batch_result)
+            print(batch_result_sum)
+            return "batch result output contains NaN!"
+
+        if len(feat.shape) < 2:
+           return "the shape of the feature must be two, but get {}".format(str(feat.shape))
+
+        if feat.shape[1] > max_feat_dim:
+            return "max feat dim exceed, given %d"%feat.shape[1]
+        self.feat_dim = feat.shape[1]
+        cost_ms = cost*1000
+        if cost_ms>max_time_cost:
+            return "max time cost exceed, given %.4f"%cost_ms
+        self.cost_ms = cost_ms
+        print('check stat:, model-size-mb: %.4f, feat-dim: %d, time-cost-ms: %.4f, input-mean: %.3f, input-std: %.3f'%(self.model_size_mb, self.feat_dim, self.cost_ms, self.input_mean, self.input_std))
+        return None
+
+    # loads the session and the preprocessing (crop, pixel norm) without the challenge limits and
+    # benchmarks of check, e.g. for serving, return error message, return None if success
+    def prepare(self, track='cfat'):
+        import onnx
         if not os.path.exists(self.model_path):
             return "model_path not exists"
         if not os.path.isdir(self.model_path):
@@ -56,30 +189,29 @@ class ArcFaceORT:
         self.model_file = sorted(onnx_files)[-1]
         print('use onnx-model:', self.model_file)
         try:
-            session = onnxruntime.InferenceSession(self.model_file, providers=self.providers)
+            model = onnx.load(self.model_file)
         except:
             return "load onnx failed"
-        input_cfg = session.get_inputs()[0]
-        input_shape = input_cfg.shape
-        print('input-shape:', input_shape)
-        if len(input_shape)!=4:
-            return "length of input_shape should be 4"
-        if not isinstance(input_shape[0], str):
+        batch_dim = model.graph.input[0].type.tensor_type.shape.dim[0]
+        if not batch_dim.HasField('dim_param'):
             #return "input_shape[0] should be str to support batch-inference"
             print('reset input-shape[0] to None')
-            model = onnx.load(self.model_file)
-            model.graph.input[0].type.tensor_type.shape.dim[0].dim_param = 'None'
+            batch_dim.dim_param = 'None'
             new_model_file = osp.join(self.model_path, 'zzzzrefined.onnx')
             onnx.save(model, new_model_file)
             self.model_file = new_model_file
             print('use new onnx-model:', self.model_file)
-            try:
-                session = onnxruntime.InferenceSession(self.model_file, providers=self.providers)
-            except:
-                return "load onnx failed"
-            input_cfg = session.get_inputs()[0]
-            input_shape = input_cfg.shape
-            print('new-input-shape:', input_shape)
+        try:
+            session = create_session(self.model_file, self.providers, **self.session_options)
+        except:
+            return "load onnx failed"
+        input_cfg = session.get_inputs()[0]
+        input_shape = input_cfg.shape
+        # models exported with torch2onnx.py --uint8 normalize the raw pixels in the graph
+        self.input_dtype = np.uint8 if input_cfg.type == 'tensor(uint8)' else np.float32
+        print('input-shape:', input_shape)
+        if len(input_shape)!=4:
+            return "length of input_shape should be 4"
 
         self.image_size = tuple(input_shape[2:4][::-1])
         #print('image_size:', self.image_size)
@@ -94,8 +226,9 @@ class ArcFaceORT:
         self.session = session
         self.input_name = input_name
         self.output_names = output_names
+        output_shape = outputs[0].shape
+        self.feat_dim = output_shape[1] if len(output_shape) == 2 and isinstance(output_shape[1], int) else None
         #print(self.output_names)
-        model = onnx.load(self.model_file)
         graph = model.graph
         if len(graph.node)<8:
             return "too small onnx graph"
@@ -114,10 +247,6 @@ class ArcFaceORT:
         if input_size!=self.image_size:
             return "input-size is inconsistant with onnx model input, %s vs %s"%(input_size, self.image_size)
 
-        self.model_size_mb = os.path.getsize(self.model_file) / float(1024*1024)
-        if self.model_size_mb > max_model_size_mb:
-            return "max model size exceed, given %.3f-MB"%self.model_size_mb
-
         input_mean = None
         input_std = None
         if track=='cfat':
@@ -128,7 +257,10 @@ class ArcFaceORT:
                     return "pixel_norm.txt should contain 2 lines"
                 input_mean = float(lines[0])
                 input_std = float(lines[1])
-        if input_mean is not None or input_std is not None:
+        if self.input_dtype == np.uint8:
+            input_mean = 0.0
+            input_std = 1.0
+        elif input_mean is not None or input_std is not None:
             if input_mean is None or input_std is None:
                 return "please set input_mean and input_std simultaneously"
         else:
@@ -150,38 +282,23 @@ class ArcFaceORT:
                 input_std = 127.5
         self.input_mean = input_mean
         self.input_std = input_std
-        for initn in graph.initializer:
-            weight_array = numpy_helper.to_array(initn)
-            dt = weight_array.dtype
-            if dt.itemsize<4:
-                return 'invalid weight type - (%s:%s)' % (initn.name, dt.name)
-        if test_img is None:
-            test_img = get_image('Tom_Hanks_54745')
-            test_img = cv2.resize(test_img, self.image_size)
-        else:
-            test_img = cv2.resize(test_img, self.image_size)
-        feat, cost = self.benchmark(test_img)
-        batch_result = self.check_batch(test_img)
-        batch_result_sum = float(np.sum(batch_result))
-        if batch_result_sum in [float('inf'), -float('inf')] or batch_result_sum != batch_result_sum:
-            print(batch_result)
-            print(batch_result_sum)
-            return "batch result output contains NaN!"
-
-        if len(feat.shape) < 2:
-           return "the shape of the feature must be two, but get {}".format(str(feat.shape))
-
-        if feat.shape[1] > max_feat_dim:
-            return "max feat dim exceed, given %d"%feat.shape[1]
-        self.feat_dim = feat.shape[1]
-        cost_ms = cost*1000
-        if cost_ms>max_time_cost:
-            return "max time cost exceed, given %.4f"%cost_ms
-        self.cost_ms = cost_ms
-        print('check stat:, model-size-mb: %.4f, feat-dim: %d, time-cost-ms: %.4f, input-mean: %.3f, input-std: %.3f'%(self.model_size_mb, self.feat_dim, self.cost_ms, self.input_mean, self.input_std))
+        if self.feat_dim is None:
+            blob = np.zeros((1, 3, self.image_size[1], self.image_size[0]), dtype=self.input_dtype)
+            self.feat_dim = session.run(output_names, {input_name: blob})[0].shape[1]
+        if self.io_binding:
+            self.buffers = BoundBuffers(session, input_name, output_names[0], self.image_size, self.feat_dim, self.ring,
+                                        self.input_dtype)
         return None
 
+    # first runs of each batch size (arena allocations, kernel selection) before timing or serving
+    def warmup(self, batch_sizes=(1,), runs=2):
+        for batch_size in batch_sizes:
+            blob = np.zeros((batch_size, 3, self.image_size[1], self.image_size[0]), dtype=self.input_dtype)
+            for _ in range(runs):
+                self.forward_blob(blob)
+
     def check_batch(self, img):
+        import cv2
         if not isinstance(img, list):
             imgs = [img, ] * 32
         if self.crop is not None:
@@ -194,7 +311,7 @@ class ArcFaceORT:
             imgs = nimgs
         blob = cv2.dnn.blobFromImages(
             images=imgs, scalefactor=1.0 / self.input_std, size=self.image_size,
-            mean=(self.input_mean, self.input_mean, self.input_mean), swapRB=True)
+            mean=(self.input_mean, self.input_mean, self.input_mean), swapRB=True).astype(self.input_dtype)
         net_out = self.session.run(self.output_names, {self.input_name: blob})[0]
         return net_out
 
@@ -203,7 +320,9 @@ class ArcFaceORT:
         return {'model-size-mb':self.model_size_mb, 'feature-dim':self.feat_dim, 'infer': self.cost_ms}
 
 
-    def forward(self, imgs):
+    # BGR images to the NCHW input blob of the session, written to `out` if given
+    def preprocess(self, imgs, out=None):
+        import cv2
         if not isinstance(imgs, list):
             imgs = [imgs]
         input_size = self.image_size
@@ -215,11 +334,42 @@ class ArcFaceORT:
                     nimg = cv2.resize(nimg, input_size)
                 nimgs.append(nimg)
             imgs = nimgs
-        blob = cv2.dnn.blobFromImages(imgs, 1.0/self.input_std, input_size, (self.input_mean, self.input_mean, self.input_mean), swapRB=True)
-        net_out = self.session.run(self.output_names, {self.input_name : blob})[0]
-        return net_out
+        if out is None:
+            blob = cv2.dnn.blobFromImages(imgs, 1.0/self.input_std, input_size, (self.input_mean, self.input_mean, self.input_mean), swapRB=True)
+            return blob.astype(self.input_dtype, copy=False)
+        for i, img in enumerate(imgs):
+            if img.shape[0]!=input_size[1] or img.shape[1]!=input_size[0]:
+                img = cv2.resize(img, input_size)
+            # BGR HWC to RGB CHW, as blobFromImages(swapRB=True)
+            if self.input_dtype == np.uint8:
+                out[i] = img[:, :, ::-1].transpose(2, 0, 1)
+            else:
+                np.subtract(img[:, :, ::-1].transpose(2, 0, 1), self.input_mean, out=out[i], dtype=np.float32, casting='unsafe')
+        if self.input_dtype != np.uint8:
+            out *= 1.0/self.input_std
+        return out
+
+    # with io_binding the outputs are views of the buffers (see BoundBuffers), not thread safe
+    def forward_blob(self, blob):
+        if self.buffers is None:
+            return self.session.run(self.output_names, {self.input_name : blob})[0]
+        inp, out, binding = self.buffers.next(blob.shape[0])
+        np.copyto(inp, blob)
+        self.buffers.run(binding)
+        return out
+
+    def forward(self, imgs):
+        if not isinstance(imgs, list):
+            imgs = [imgs]
+        if self.buffers is None:
+            return self.forward_blob(self.preprocess(imgs))
+        inp, out, binding = self.buffers.next(len(imgs))
+        self.preprocess(imgs, out=inp)
+        self.buffers.run(binding)
+        return out
 
     def benchmark(self, img):
+        import cv2
         input_size = self.image_size
         if self.crop is not None:
             nimg = img[self.crop[1]:self.crop[3],self.crop[0]:self.crop[2],:]
@@ -227,15 +377,16 @@ class ArcFaceORT:
                 nimg = cv2.resize(nimg, input_size)
             img = nimg
         blob = cv2.dnn.blobFromImage(img, 1.0/self.input_std, input_size, (self.input_mean, self.input_mean, self.input_mean), swapRB=True)
+        blob = blob.astype(self.input_dtype, copy=False)
+        # median of 50 runs after a warm-up, the sweep over batch sizes, threads and runtimes is benchmark.py
+        for _ in range(5):
+            self.session.run(self.output_names, {self.input_name : blob})
         costs = []
         for _ in range(50):
-            ta = datetime.datetime.now()
+            ta = time.perf_counter()
             net_out = self.session.run(self.output_names, {self.input_name : blob})[0]
-            tb = datetime.datetime.now()
-            cost = (tb-ta).total_seconds()
-            costs.append(cost)
-        costs = sorted(costs)
-        cost = costs[5]
+            costs.append(time.perf_counter() - ta)
+        cost = float(np.median(costs))
         return net_out, cost
 
 
@@ -244,7 +395,32 @@ if __name__ == '__main__':
     # general
     parser.add_argument('workdir', help='submitted work dir', type=str)
     parser.add_argument('--track', help='track name, for different challenge', type=str, default='cfat')
+    parser.add_argument('--cpu', action='store_true', help='CPU execution provider')
+    parser.add_argument('--quantized', action='store_true', help='accept int8 models')
+    parser.add_argument('--intra-op-threads', type=int, default=0)
+    parser.add_argument('--inter-op-threads', type=int, default=0)
+    parser.add_argument('--graph-optimization', type=str, default='all', choices=list(GRAPH_OPTIMIZATION_LEVELS))
+    parser.add_argument('--latency', type=int, nargs='*', default=None,
+                        help='batch sizes: compare session.run on new blobs with the IO binding path instead of check')
+    parser.add_argument('--runs', type=int, default=100)
     args = parser.parse_args()
-    handler = ArcFaceORT(args.workdir)
-    err = handler.check(args.track)
-    print('err:', err)
+    handler = ArcFaceORT(args.workdir, cpu=args.cpu, io_binding=args.latency is not None, intra_op_threads=args.intra_op_threads,
+                         inter_op_threads=args.inter_op_threads, graph_optimization=args.graph_optimization)
+    if args.latency is None:
+        err = handler.check(args.track, quantized=args.quantized)
+        print('err:', err)
+    else:
+        err = handler.prepare(args.track)
+        assert err is None, err
+        img = np.random.randint(0, 255, size=(handler.image_size[1], handler.image_size[0], 3), dtype=np.uint8)
+        for batch_size in args.latency or [1, 8, 32]:
+            imgs = [img] * batch_size
+            handler.warmup([batch_size])
+            for name, run in (('session.run', lambda: handler.session.run(handler.output_names, {handler.input_name: handler.preprocess(imgs)})),
+                              ('io binding', lambda: handler.forward(imgs))):
+                costs = []
+                for _ in range(args.runs):
+                    ta = datetime.datetime.now()
+                    run()
+                    costs.append((datetime.datetime.now() - ta).total_seconds() * 1000)
+                print('batch %d, %s: p50 %.3f ms, p99 %.3f ms' % (batch_size, name, np.percentile(costs, 50), np.percentile(costs, 99)))
@@ -4,16 +4,13 @@ import pickle
 import timeit
 
 import cv2
-import mxnet as mx
 import numpy as np
 import pandas as pd
 import prettytable
-import skimage.transform
 import torch
-from sklearn.metrics import roc_curve
-from sklearn.preprocessing import normalize
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 from onnx_helper import ArcFaceORT
+from eval.embedding import embed_blobs
 
 SRC = np.array(
     [
@@ -27,7 +24,7 @@ SRC[:, 0] += 8.0
 
 
 @torch.no_grad()
-class AlignedDataSet(mx.gluon.data.Dataset):
+class AlignedDataSet(Dataset):
     def __init__(self, root, lines, align=True):
         self.lines = lines
         self.root = root
@@ -37,6 +34,7 @@ class AlignedDataSet(mx.gluon.data.Dataset):
         return len(self.lines)
 
     def __getitem__(self, idx):
+        import skimage.transform
         each_line = self.lines[idx]
         name_lmk_score = each_line.strip().split(' ')
         name = os.path.join(self.root, name_lmk_score[0])
@@ -45,11 +43,8 @@ class AlignedDataSet(mx.gluon.data.Dataset):
         st = skimage.transform.SimilarityTransform()
         st.estimate(landmark5, SRC)
         img = cv2.warpAffine(img, st.params[0:2, :], (112, 112), borderValue=0.0)
-        img_1 = np.expand_dims(img, 0)
-        img_2 = np.expand_dims(np.fliplr(img), 0)
-        output = np.concatenate((img_1, img_2), axis=0).astype(np.float32)
-        output = np.transpose(output, (0, 3, 1, 2))
-        return torch.from_numpy(output)
+        # uint8 RGB CHW, the flip is added at embedding time (see eval.embedding)
+        return torch.from_numpy(np.ascontiguousarray(np.transpose(img, (2, 0, 1))))
 
 
 @torch.no_grad()
@@ -59,16 +54,15 @@ def extract(model_root, dataset):
     feat_mat = np.zeros(shape=(len(dataset), 2 * model.feat_dim))
 
     def collate_fn(data):
-        return torch.cat(data, dim=0)
+        return torch.stack(data, dim=0)
 
     data_loader = DataLoader(
         dataset, batch_size=128, drop_last=False, num_workers=4, collate_fn=collate_fn, )
     num_iter = 0
     for batch in data_loader:
-        batch = batch.numpy()
-        batch = (batch - model.input_mean) / model.input_std
-        feat = model.session.run(model.output_names, {model.input_name: batch})[0]
-        feat = np.reshape(feat, (-1, model.feat_dim * 2))
+        # [image embedding, flip embedding] per row, one run of the 2B batch
+        feat = embed_blobs(model.forward_blob, batch.numpy(), fuse="concat", input_mean=model.input_mean,
+                           input_std=model.input_std, dtype=model.input_dtype)
         feat_mat[128 * num_iter: 128 * num_iter + feat.shape[0], :] = feat
         num_iter += 1
         if num_iter % 50 == 0:
@@ -78,16 +72,16 @@ def extract(model_root, dataset):
 
 def read_template_media_list(path):
     ijb_meta = pd.read_csv(path, sep=' ', header=None).values
-    templates = ijb_meta[:, 1].astype(np.int)
-    medias = ijb_meta[:, 2].astype(np.int)
+    templates = ijb_meta[:, 1].astype(int)
+    medias = ijb_meta[:, 2].astype(int)
     return templates, medias
 
 
 def read_template_pair_list(path):
     pairs = pd.read_csv(path, sep=' ', header=None).values
-    t1 = pairs[:, 0].astype(np.int)
-    t2 = pairs[:, 1].astype(np.int)
-    label = pairs[:, 2].astype(np.int)
+    t1 = pairs[:, 0].astype(int)
+    t2 = pairs[:, 1].astype(int)
+    label = pairs[:, 2].astype(int)
     return t1, t2, label
 
 
@@ -119,6 +113,7 @@ def image2template_feature(img_feats=None,
         if count_template % 2000 == 0:
             print('Finish Calculating {} template features.'.format(
                 count_template))
+    from sklearn.preprocessing import normalize
     template_norm_feats = normalize(template_feats)
     return template_norm_feats, unique_templates
 
@@ -168,6 +163,7 @@ def verification2(template_norm_feats=None,
 
 
 def main(args):
+    from sklearn.metrics import roc_curve
     use_norm_score = True  # if Ture, TestMode(N1)
     use_detector_score = True  # if Ture, TestMode(D1)
     use_flip_test = True  # if Ture, TestMode(F1)
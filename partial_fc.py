@@ -195,8 +195,7 @@ class PartialFC(torch.nn.Module):
         index_positive = (self.class_start <= labels) & (
             labels < self.class_start + self.num_local
         )
-        labels[~index_positive] = -1
-        labels[index_positive] -= self.class_start
+        labels = (labels - self.class_start).masked_fill_(~index_positive, -1)
 
         if self.sample_rate < 1:
             self.sample(labels, index_positive, optimizer)
@@ -395,8 +394,7 @@ class PartialFCAdamW(torch.nn.Module):
         index_positive = (self.class_start <= labels) & (
             labels < self.class_start + self.num_local
         )
-        labels[~index_positive] = -1
-        labels[index_positive] -= self.class_start
+        labels = (labels - self.class_start).masked_fill_(~index_positive, -1)
 
         if self.sample_rate < 1:
             self.sample(labels, index_positive, optimizer)
@@ -458,10 +456,10 @@ class DistCrossEntropyFunc(torch.autograd.Function):
         # local to global
         distributed.all_reduce(sum_logits_exp, distributed.ReduceOp.SUM)
         logits.div_(sum_logits_exp)
-        index = torch.where(label != -1)[0]
-        # loss
-        loss = torch.zeros(batch_size, 1, device=logits.device)
-        loss[index] = logits[index].gather(1, label[index])
+        # loss, masked rather than indexed to avoid a device sync
+        index = label != -1
+        label = label.clamp(min=0)
+        loss = logits.gather(1, label) * index
         distributed.all_reduce(loss, distributed.ReduceOp.SUM)
         ctx.save_for_backward(index, logits, label)
         return loss.clamp_min_(1e-30).log_().mean() * (-1)
@@ -481,13 +479,9 @@ class DistCrossEntropyFunc(torch.autograd.Function):
             label,
         ) = ctx.saved_tensors
         batch_size = logits.size(0)
-        one_hot = torch.zeros(
-            size=[index.size(0), logits.size(1)], device=logits.device
-        )
-        one_hot.scatter_(1, label[index], 1)
-        logits[index] -= one_hot
+        logits.scatter_add_(1, label, -index.to(logits.dtype))
         logits.div_(batch_size)
-        return logits * loss_gradient.item(), None
+        return logits.mul_(loss_gradient), None
 
 
 class DistCrossEntropy(torch.nn.Module):
@@ -0,0 +1,215 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+
+class HostClassCenters(object):
+    """
+    Keeps the class centers of one PartialFC_V2 shard, and the optimizer state of every
+    center, in host memory (pinned RAM or a memory-mapped file), and streams the sampled
+    rows to the device each step.
+    While the device computes a step, a background thread writes the updated rows back and
+    prefetches the rows of a random candidate set for the next step; the next step takes its
+    negative centers from those candidates and only gathers its positive centers synchronously.
+    The number of classes is then bounded by the host memory (or disk), not by the device.
+    Parameters:
+    ----------
+    num_rows: int
+        Number of class centers of this shard.
+    embedding_size: int
+        The dimension of the centers.
+    num_sample: int
+        Number of centers sampled per step.
+    offload: str
+        "pinned" keeps the centers in page-locked RAM, "mmap" in files under `path`.
+    path: str
+        Directory of the memory-mapped files, required for "mmap".
+    """
+
+    def __init__(self, num_rows, embedding_size, num_sample, offload="pinned", path=None):
+        if offload not in ("pinned", "mmap"):
+            raise ValueError(f"offload must be 'pinned' or 'mmap', got {offload}")
+        if offload == "mmap" and path is None:
+            raise ValueError("a path is required to memory-map the class centers")
+        self.num_rows = num_rows
+        self.embedding_size = embedding_size
+        self.num_sample = num_sample
+        self.offload = offload
+        self.path = path
+        self.pin = torch.cuda.is_available()
+
+        self.weight = self._allocate("weight", (num_rows, embedding_size))
+        self.weight.normal_(0, 0.01)
+        self.state = {}
+
+        # rows of the current step, index on host, rows on device
+        self.index = None
+        self.rows = None
+        self.state_rows = {}
+
+        self.device = None
+        self.stream = None
+        self.generator = torch.Generator()
+        self.generator.manual_seed(torch.initial_seed())
+        self.staging = {}
+        self.staging_events = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.prefetched = None
+
+    def _allocate(self, name, shape):
+        if self.offload == "mmap":
+            os.makedirs(self.path, exist_ok=True)
+            array = np.memmap(os.path.join(self.path, f"{name}.bin"), dtype=np.float32, mode="w+", shape=shape)
+            return torch.from_numpy(array)
+        return torch.zeros(shape, pin_memory=self.pin)
+
+    def _sources(self):
+        return dict(weight=self.weight, **self.state)
+
+    def _staging_buffer(self, slot, name, source, num_rows):
+        """ Page-locked buffers used to gather rows before a copy, one set per slot """
+        buffers = self.staging.setdefault(slot, {})
+        if name not in buffers or buffers[name].size(0) < num_rows:
+            buffers[name] = torch.empty(
+                (max(num_rows, self.num_sample),) + tuple(source.shape[1:]), pin_memory=self.pin)
+        return buffers[name][:num_rows]
+
+    def _wait_staging(self, slot):
+        event = self.staging_events.pop(slot, None)
+        if event is not None:
+            event.synchronize()
+
+    def _record_staging(self, slot):
+        if self.pin:
+            event = torch.cuda.Event()
+            event.record()
+            self.staging_events[slot] = event
+
+    def _gather(self, index, slot, names=None):
+        """ Gathers rows of the host tensors and copies them to the device asynchronously """
+        self._wait_staging(slot)
+        rows = {}
+        for name, source in self._sources().items():
+            if names is not None and name not in names:
+                continue
+            buffer = self._staging_buffer(slot, name, source, index.size(0))
+            torch.index_select(source, 0, index, out=buffer)
+            rows[name] = buffer.to(self.device, non_blocking=True)
+        self._record_staging(slot)
+        return rows
+
+    def _prefetch(self):
+        """ Runs in the background thread: draws and uploads the candidate rows of the next step """
+        candidates = torch.unique(torch.randint(
+            self.num_rows, (self.num_sample + self.num_sample // 8 + 64,), generator=self.generator))
+        if candidates.size(0) < self.num_sample:
+            candidates = torch.randperm(self.num_rows, generator=self.generator)
+        candidates = candidates[torch.randperm(candidates.size(0), generator=self.generator)[:self.num_sample]]
+        with torch.cuda.stream(self.stream) if self.stream is not None else nullcontext():
+            rows = self._gather(candidates, "prefetch")
+        if self.stream is not None:
+            self.stream.synchronize()
+        self.prefetched = (candidates, rows)
+
+    def _write_back(self, index, buffers, event):
+        if event is not None:
+            event.synchronize()
+        sources = self._sources()
+        for name, buffer in buffers.items():
+            sources[name].index_copy_(0, index, buffer)
+        self._prefetch()
+
+    def flush(self):
+        """ Waits for the write-back and the prefetch in flight """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def select(self, positive):
+        """
+        Selects the rows of this step, the positive centers and random negative centers, and
+        loads them (and their optimizer state) on the device.
+        Returns the sorted index of the selected rows, on the device of `positive`.
+        """
+        if self.device is None:
+            self.device = positive.device
+            if self.device.type == "cuda":
+                self.stream = torch.cuda.Stream(self.device)
+        self.flush()
+        positive = positive.cpu()
+        num_negative = self.num_sample - positive.size(0)
+        prefetched, self.prefetched = self.prefetched, None
+
+        if num_negative < 0:
+            index = positive
+            rows = self._gather(index, "select")
+        elif prefetched is None:
+            perm = torch.rand(self.num_rows, generator=self.generator)
+            perm[positive] = 2.0
+            index = torch.topk(perm, k=self.num_sample)[1].sort()[0]
+            rows = self._gather(index, "select")
+        else:
+            candidates, candidate_rows = prefetched
+            keep = torch.nonzero(~torch.isin(candidates, positive)).view(-1)[:num_negative]
+            index, order = torch.cat([positive, candidates[keep]]).sort()
+            rows = self._gather(positive, "select")
+            keep, order = keep.to(self.device), order.to(self.device)
+            for name in list(rows):
+                if name not in candidate_rows:
+                    # state created after the prefetch, gathered again on first use
+                    del rows[name]
+                    continue
+                tensor = candidate_rows[name]
+                if self.stream is not None:
+                    tensor.record_stream(torch.cuda.current_stream(self.device))
+                rows[name] = torch.cat([rows[name], tensor.index_select(0, keep)]).index_select(0, order)
+
+        self.index = index
+        self.rows = rows.pop("weight")
+        self.state_rows = rows
+        return index.to(self.device)
+
+    def state_rows_for(self, name, per_row=False):
+        """ Device rows of an optimizer state of the current step, allocated with zeros on first use """
+        if name not in self.state:
+            shape = (self.num_rows,) if per_row else (self.num_rows, self.embedding_size)
+            self.state[name] = self._allocate(name, shape)
+        if name not in self.state_rows:
+            self.state_rows.update(self._gather(self.index, "select", names=(name,)))
+        return self.state_rows[name]
+
+    def write_back(self):
+        """ Called after the optimizer updated the device rows in place """
+        rows = dict(weight=self.rows, **self.state_rows)
+        buffers = {}
+        for name, tensor in rows.items():
+            buffers[name] = self._staging_buffer("write_back", name, tensor, tensor.size(0))
+            buffers[name].copy_(tensor, non_blocking=True)
+        event = None
+        if self.pin:
+            event = torch.cuda.Event()
+            event.record()
+        self.pending = self.executor.submit(self._write_back, self.index, buffers, event)
+        self.rows, self.state_rows = None, {}
+
+    def state_dict(self):
+        self.flush()
+        state = {"weight": self.weight}
+        for name, tensor in self.state.items():
+            state[f"state.{name}"] = tensor
+        return state
+
+    def load_state_dict(self, state_dict):
+        self.flush()
+        self.prefetched = None
+        self.weight.copy_(state_dict["weight"])
+        for key, tensor in state_dict.items():
+            if key.startswith("state."):
+                name = key[len("state."):]
+                if name not in self.state:
+                    self.state[name] = self._allocate(name, tuple(tensor.shape))
+                self.state[name].copy_(tensor)
@@ -1,10 +1,13 @@
 
 import math
+import os
 from typing import Callable
 
 import torch
 from torch import distributed
-from torch.nn.functional import linear, normalize
+from torch.nn.functional import embedding, linear, normalize
+
+from partial_fc_offload import HostClassCenters
 
 
 class PartialFC_V2(torch.nn.Module):
@@ -35,6 +38,9 @@ class PartialFC_V2(torch.nn.Module):
         num_classes: int,
         sample_rate: float = 1.0,
         fp16: bool = False,
+        sparse_grad: bool = False,
+        offload: str = None,
+        offload_dir: str = None,
     ):
         """
         Paramenters:
@@ -45,6 +51,14 @@ class PartialFC_V2(torch.nn.Module):
             Total number of classes, required
         sample_rate: float
             The rate of negative centers participating in the calculation, default is 1.0.
+        sparse_grad: bool
+            When sample rate less than 1, produce a row-sparse gradient that only holds the
+            sampled centers, to be used with `sparse_optimizer.SparseRowSGD/SparseRowAdamW`.
+        offload: str
+            Keep all centers and their optimizer state on the host, "pinned" or "mmap" (files
+            under `offload_dir`), and stream the sampled rows to the device, see
+            `partial_fc_offload.HostClassCenters`. Requires sample rate less than 1, no gradient
+            accumulation and `sparse_optimizer.SparseRowSGD/SparseRowAdamW`.
         """
         super(PartialFC_V2, self).__init__()
         assert (
@@ -65,10 +79,23 @@ class PartialFC_V2(torch.nn.Module):
         )
         self.num_sample: int = int(self.sample_rate * self.num_local)
         self.last_batch_size: int = 0
+        self.sparse_grad: bool = sparse_grad
 
         self.is_updated: bool = True
         self.init_weight_update: bool = True
-        self.weight = torch.nn.Parameter(torch.normal(0, 0.01, (self.num_local, embedding_size)))
+        self.centers = None
+        if offload:
+            if self.sample_rate >= 1:
+                raise ValueError("offloading class centers requires sample rate less than 1")
+            if offload_dir is not None:
+                offload_dir = os.path.join(offload_dir, f"class_centers_rank_{self.rank}")
+            self.centers = HostClassCenters(
+                self.num_local, embedding_size, self.num_sample, offload, offload_dir)
+            # only holds the rows sampled in the current step
+            self.weight = torch.nn.Parameter(torch.empty(0, embedding_size))
+            self.weight.row_store = self.centers
+        else:
+            self.weight = torch.nn.Parameter(torch.normal(0, 0.01, (self.num_local, embedding_size)))
 
         # margin_loss
         if isinstance(margin_loss, Callable):
@@ -88,6 +115,17 @@ class PartialFC_V2(torch.nn.Module):
             optimizer: torch.optim.Optimizer
                 pass
         """
+        if self.centers is not None:
+            if self.weight.grad is not None:
+                # the rows of the previous micro-batch would be replaced before their optimizer step
+                raise ValueError("offloaded class centers do not support gradient accumulation")
+            with torch.no_grad():
+                positive = torch.unique(labels[index_positive], sorted=True)
+                self.weight_index = self.centers.select(positive)
+                labels[index_positive] = torch.searchsorted(self.weight_index, labels[index_positive])
+            self.weight.data = self.centers.rows
+            return self.weight
+
         with torch.no_grad():
             positive = torch.unique(labels[index_positive], sorted=True).cuda()
             if self.num_sample - positive.size(0) >= 0:
@@ -101,6 +139,8 @@ class PartialFC_V2(torch.nn.Module):
 
             labels[index_positive] = torch.searchsorted(index, labels[index_positive])
 
+        if self.sparse_grad:
+            return embedding(self.weight_index, self.weight, sparse=True)
         return self.weight[self.weight_index]
 
     def forward(
@@ -146,14 +186,19 @@ class PartialFC_V2(torch.nn.Module):
         index_positive = (self.class_start <= labels) & (
             labels < self.class_start + self.num_local
         )
-        labels[~index_positive] = -1
-        labels[index_positive] -= self.class_start
+        labels = (labels - self.class_start).masked_fill_(~index_positive, -1)
 
         if self.sample_rate < 1:
             weight = self.sample(labels, index_positive)
         else:
             weight = self.weight
 
+        logits = self.margin_logits(embeddings, weight, labels)
+        loss = self.dist_cross_entropy(logits, labels)
+        return loss
+
+    def margin_logits(self, embeddings, weight, labels):
+        """ Cosine logits with the margin, the static-shape part of the step (see utils.utils_compile) """
         with torch.cuda.amp.autocast(self.fp16):
             norm_embeddings = normalize(embeddings)
             norm_weight_activated = normalize(weight)
@@ -161,11 +206,25 @@ class PartialFC_V2(torch.nn.Module):
         if self.fp16:
             logits = logits.float()
         logits = logits.clamp(-1, 1)
+        return self.margin_softmax(logits, labels)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        if self.centers is None:
+            return super(PartialFC_V2, self)._save_to_state_dict(destination, prefix, keep_vars)
+        for key, tensor in self.centers.state_dict().items():
+            destination[prefix + key] = tensor
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        if self.centers is None:
+            return super(PartialFC_V2, self)._load_from_state_dict(
+                state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+        if prefix + "weight" not in state_dict:
+            missing_keys.append(prefix + "weight")
+            return
+        self.centers.load_state_dict(
+            {key[len(prefix):]: tensor for key, tensor in state_dict.items() if key.startswith(prefix)})
 
-        logits = self.margin_softmax(logits, labels)
-        loss = self.dist_cross_entropy(logits, labels)
-        return loss
-    
 
 
 # Bernardo
@@ -308,8 +367,7 @@ class PartialFC_V2_INVERSE(torch.nn.Module):
         index_positive = (self.class_start <= labels) & (
             labels < self.class_start + self.num_local
         )
-        labels[~index_positive] = -1
-        labels[index_positive] -= self.class_start
+        labels = (labels - self.class_start).masked_fill_(~index_positive, -1)
 
         if self.sample_rate < 1:
             weight = self.sample(labels, index_positive)
@@ -350,10 +408,10 @@ class DistCrossEntropyFunc(torch.autograd.Function):
         # local to global
         distributed.all_reduce(sum_logits_exp, distributed.ReduceOp.SUM)
         logits.div_(sum_logits_exp)
-        index = torch.where(label != -1)[0]
-        # loss
-        loss = torch.zeros(batch_size, 1, device=logits.device)
-        loss[index] = logits[index].gather(1, label[index])
+        # loss, masked rather than indexed to avoid a device sync
+        index = label != -1
+        label = label.clamp(min=0)
+        loss = logits.gather(1, label) * index
         distributed.all_reduce(loss, distributed.ReduceOp.SUM)
         ctx.save_for_backward(index, logits, label)
         return loss.clamp_min_(1e-30).log_().mean() * (-1)
@@ -373,13 +431,9 @@ class DistCrossEntropyFunc(torch.autograd.Function):
             label,
         ) = ctx.saved_tensors
         batch_size = logits.size(0)
-        one_hot = torch.zeros(
-            size=[index.size(0), logits.size(1)], device=logits.device
-        )
-        one_hot.scatter_(1, label[index], 1)
-        logits[index] -= one_hot
+        logits.scatter_add_(1, label, -index.to(logits.dtype))
         logits.div_(batch_size)
-        return logits * loss_gradient.item(), None
+        return logits.mul_(loss_gradient), None
 
 
 class DistCrossEntropy(torch.nn.Module):
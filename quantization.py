@@ -0,0 +1,251 @@
+import argparse
+import copy
+import glob
+import json
+import os
+import pickle
+import sys
+import time
+
+import cv2
+import numpy as np
+
+# Post-training int8 quantization of a face backbone, with an accuracy gate against the fp32 model:
+# static int8 for ONNX Runtime (QDQ, calibrated on aligned faces), or PyTorch dynamic (Linear
+# layers) / static (FX graph mode) quantization of get_model backbones (IResNet, MobileFaceNet), e.g.:
+# python quantization.py onnx work_dirs/r100/model.onnx --calib /data/aligned_faces --output r100_int8/model.onnx \
+#     --gate lfw=/data/lfw.bin cfp_fp=/data/cfp_fp.bin
+# python quantization.py torch r100 --weight work_dirs/r100/model.pt --mode static --calib /data/lfw.bin \
+#     --output r100_int8.pt --gate lfw=/data/lfw.bin --bupt /data/bupt --bupt-protocol bupt_comparison.txt
+# The quantized onnx model is accepted by `python onnx_helper.py <dir> --quantized`, the TorchScript
+# file by embedding_server.py. The exit code is 1 when the accuracy gate fails.
+
+CALIBRATION_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def normalize_images(imgs):
+    """ uint8 RGB NHWC to the normalized NCHW float32 blob of the backbones """
+    blob = imgs.transpose(0, 3, 1, 2).astype(np.float32)
+    blob -= 127.5
+    blob /= 127.5
+    return blob
+
+
+def load_calibration(source, num_samples=512, batch_size=32, image_size=(112, 112), seed=0):
+    """
+    Batches (normalized blobs) of `num_samples` aligned faces drawn from a directory of images
+    (searched recursively) or from a verification .bin file.
+    """
+    if os.path.isfile(source):
+        with open(source, 'rb') as f:
+            bins, _ = pickle.load(f, encoding='bytes')
+        decode = lambda item: cv2.imdecode(np.frombuffer(item, dtype=np.uint8), cv2.IMREAD_COLOR)
+        items = list(bins)
+    else:
+        decode = cv2.imread
+        items = sorted(path for path in glob.glob(os.path.join(source, "**", "*"), recursive=True)
+                       if path.lower().endswith(CALIBRATION_EXTENSIONS))
+    if not items:
+        raise ValueError(f"no calibration images in {source}")
+    rng = np.random.default_rng(seed)
+    items = [items[i] for i in rng.permutation(len(items))[:num_samples]]
+
+    imgs = []
+    for item in items:
+        img = decode(item)
+        if img.shape[0] != image_size[1] or img.shape[1] != image_size[0]:
+            img = cv2.resize(img, image_size)
+        imgs.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    imgs = np.stack(imgs)
+    return [normalize_images(imgs[i:i + batch_size]) for i in range(0, len(imgs), batch_size)]
+
+
+def onnx_input_name(model_file):
+    import onnx
+    graph = onnx.load(model_file).graph
+    initializers = {init.name for init in graph.initializer}
+    return [i.name for i in graph.input if i.name not in initializers][0]
+
+
+def quantize_onnx(model_file, output, calibration, per_channel=True, method="minmax", preprocess=True):
+    """
+    Static int8 quantization (QDQ format, uint8 activations, int8 weights) for the ONNX Runtime
+    CPU execution provider, `calibration`: batches of load_calibration.
+    """
+    from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static
+
+    methods = {"minmax": CalibrationMethod.MinMax, "entropy": CalibrationMethod.Entropy,
+               "percentile": CalibrationMethod.Percentile}
+    input_name = onnx_input_name(model_file)
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.batches = iter(calibration)
+
+        def get_next(self):
+            blob = next(self.batches, None)
+            return None if blob is None else {input_name: blob}
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    if preprocess:
+        # shape inference and graph optimization before quantization (onnxruntime >= 1.13)
+        try:
+            from onnxruntime.quantization.shape_inference import quant_pre_process
+            prepared = output + ".prep.onnx"
+            quant_pre_process(model_file, prepared)
+            model_file = prepared
+        except ImportError:
+            pass
+    quantize_static(model_file, output, Reader(), quant_format=QuantFormat.QDQ, per_channel=per_channel,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    calibrate_method=methods[method])
+    if model_file.endswith(".prep.onnx"):
+        os.remove(model_file)
+    return output
+
+
+def quantize_torch(model, mode="static", calibration=None, backend="x86"):
+    """
+    mode: "dynamic" quantizes the Linear layers (weights int8, activations quantized on the fly),
+    "static" the whole graph (FX graph mode, calibrated on `calibration`).
+    """
+    import torch
+    model = model.eval()
+    if mode == "dynamic":
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if mode != "static":
+        raise ValueError(f"quantization mode not supported: {mode}")
+
+    try:
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+    except ImportError:
+        # torch < 1.13: qconfig dict and prepare_fx without example inputs
+        get_default_qconfig_mapping = None
+        from torch.quantization import get_default_qconfig
+        from torch.quantization.quantize_fx import convert_fx, prepare_fx
+    if backend not in torch.backends.quantized.supported_engines:
+        backend = "fbgemm"
+    torch.backends.quantized.engine = backend
+    if get_default_qconfig_mapping is not None:
+        prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (torch.from_numpy(calibration[0]),))
+    else:
+        prepared = prepare_fx(model, {"": get_default_qconfig(backend)})
+    with torch.no_grad():
+        for blob in calibration:
+            prepared(torch.from_numpy(blob))
+    return convert_fx(prepared)
+
+
+def onnx_runner(model_file):
+    from onnx_helper import create_session
+    session = create_session(model_file, ["CPUExecutionProvider"])
+    input_name, output_name = session.get_inputs()[0].name, session.get_outputs()[0].name
+    return lambda blob: session.run([output_name], {input_name: blob})[0]
+
+
+def torch_runner(model):
+    import torch
+
+    def run(blob):
+        with torch.no_grad():
+            return model(torch.from_numpy(blob)).numpy()
+    return run
+
+
+def verification_metrics(run, data_set, batch_size=64, nfolds=10):
+    """ Accuracy and TAR@FAR=1e-3 (flip test) on a data set of eval.verification.load_bin format """
+    import sklearn.preprocessing
+    from eval.embedding import embed_dataset, images_of
+    from eval.verification import evaluate
+
+    embeddings = sklearn.preprocessing.normalize(embed_dataset(run, images_of(data_set), batch_size))
+    _, _, accuracy, val, _, _ = evaluate(embeddings, data_set[1], nrof_folds=nfolds)
+    return {"accuracy": float(np.mean(accuracy)), "tar_at_far_1e-3": float(val)}
+
+
+def throughput(run, batch_size=32, runs=20):
+    blob = np.random.uniform(-1, 1, size=(batch_size, 3, 112, 112)).astype(np.float32)
+    run(blob)
+    start = time.perf_counter()
+    for _ in range(runs):
+        run(blob)
+    return batch_size * runs / (time.perf_counter() - start)
+
+
+def accuracy_gate(reference, quantized, data_sets, max_accuracy_drop=0.005, max_tar_drop=0.01, batch_size=64):
+    """
+    Compares the quantized model with the fp32 reference on every data set, (passed, report).
+    `reference`, `quantized`: callables from normalized blobs to embeddings.
+    """
+    if not data_sets:
+        raise ValueError("the accuracy gate needs at least one verification set")
+    report = {"throughput": {"reference": throughput(reference), "quantized": throughput(quantized)}}
+    passed = True
+    for name, data_set in data_sets.items():
+        ref = verification_metrics(reference, data_set, batch_size)
+        quant = verification_metrics(quantized, data_set, batch_size)
+        ok = ref["accuracy"] - quant["accuracy"] <= max_accuracy_drop and \
+            ref["tar_at_far_1e-3"] - quant["tar_at_far_1e-3"] <= max_tar_drop
+        report[name] = {"reference": ref, "quantized": quant, "passed": ok}
+        passed = passed and ok
+    report["passed"] = passed
+    return passed, report
+
+
+def load_gate_sets(gate, bupt=None, bupt_protocol=None, image_size=(112, 112)):
+    from eval.verification import load_bin
+    data_sets = {}
+    for item in gate or []:
+        name, path = item.split("=", 1)
+        data_sets[name] = load_bin(path, image_size)
+    if bupt is not None:
+        from eval.loader_BUPT import Loader_BUPT
+        data_sets["bupt"] = Loader_BUPT().load_dataset(bupt_protocol, bupt, image_size)
+    return data_sets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='post-training int8 quantization with an accuracy gate')
+    parser.add_argument('runtime', type=str, choices=["onnx", "torch"])
+    parser.add_argument('model', type=str, help='fp32 .onnx file (onnx) or get_model name (torch)')
+    parser.add_argument('--weight', type=str, default=None, help='backbone weights (torch)')
+    parser.add_argument('--mode', type=str, default="static", choices=["static", "dynamic"], help='torch only')
+    parser.add_argument('--calib', type=str, default=None, help='directory of aligned faces or .bin file')
+    parser.add_argument('--num-calib', type=int, default=512)
+    parser.add_argument('--calib-method', type=str, default="minmax", choices=["minmax", "entropy", "percentile"])
+    parser.add_argument('--per-tensor', action='store_true', help='per-tensor instead of per-channel weights (onnx)')
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--gate', type=str, nargs='*', default=[], help='name=path.bin verification sets')
+    parser.add_argument('--bupt', type=str, default=None, help='BUPT image directory')
+    parser.add_argument('--bupt-protocol', type=str, default=None)
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.005)
+    parser.add_argument('--max-tar-drop', type=float, default=0.01)
+    args = parser.parse_args()
+    if not args.gate and args.bupt is None:
+        parser.error("the accuracy gate needs --gate name=path.bin sets and/or --bupt")
+
+    if args.calib is None and not (args.runtime == "torch" and args.mode == "dynamic"):
+        parser.error("--calib is required for static quantization")
+    calibration = load_calibration(args.calib, args.num_calib) if args.calib else None
+
+    if args.runtime == "onnx":
+        quantize_onnx(args.model, args.output, calibration, per_channel=not args.per_tensor, method=args.calib_method)
+        reference, quantized = onnx_runner(args.model), onnx_runner(args.output)
+    else:
+        import torch
+        from backbones import get_model, optimize_for_inference
+        model = get_model(args.model, dropout=0.0, fp16=False, num_features=512)
+        if args.weight:
+            model.load_state_dict(torch.load(args.weight, map_location="cpu"))
+        model = optimize_for_inference(model, channels_last=False)
+        quantized_model = quantize_torch(copy.deepcopy(model), args.mode, calibration)
+        example = torch.zeros(1, 3, 112, 112)
+        torch.jit.save(torch.jit.trace(quantized_model, example), args.output)
+        reference, quantized = torch_runner(model), torch_runner(quantized_model)
+    print(f"saved {args.output}")
+
+    data_sets = load_gate_sets(args.gate, args.bupt, args.bupt_protocol)
+    passed, report = accuracy_gate(reference, quantized, data_sets, args.max_accuracy_drop, args.max_tar_drop)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if passed else 1)
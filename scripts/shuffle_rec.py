@@ -1,19 +1,22 @@
 import argparse
 import multiprocessing
 import os
+import sys
 import time
 
-import mxnet as mx
 import numpy as np
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.utils_recordio import IndexedRecordIO, IRHeader, pack, unpack
+
 
 def read_worker(args, q_in):
     path_imgidx = os.path.join(args.input, "train.idx")
     path_imgrec = os.path.join(args.input, "train.rec")
-    imgrec = mx.recordio.MXIndexedRecordIO(path_imgidx, path_imgrec, "r")
+    imgrec = IndexedRecordIO(path_imgidx, path_imgrec, "r")
 
     s = imgrec.read_idx(0)
-    header, _ = mx.recordio.unpack(s)
+    header, _ = unpack(s)
     assert header.flag > 0
 
     imgidx = np.array(range(1, int(header.label[0])))
@@ -39,7 +42,7 @@ def write_worker(args, q_out):
     
     path_imgidx = os.path.join(output, "train.idx")
     path_imgrec = os.path.join(output, "train.rec")
-    save_record = mx.recordio.MXIndexedRecordIO(path_imgidx, path_imgrec, "w")
+    save_record = IndexedRecordIO(path_imgidx, path_imgrec, "w")
     more = True
     count = 0
     while more:
@@ -47,15 +50,15 @@ def write_worker(args, q_out):
         if deq is None:
             more = False
         else:
-            header, jpeg = mx.recordio.unpack(deq)
+            header, jpeg = unpack(deq)
             # TODO it is currently not fully developed
             if isinstance(header.label, float):
                 label = header.label
             else:
                 label = header.label[0]
 
-            header = mx.recordio.IRHeader(flag=header.flag, label=label, id=header.id, id2=header.id2)
-            save_record.write_idx(count, mx.recordio.pack(header, jpeg))
+            header = IRHeader(flag=header.flag, label=label, id=header.id, id2=header.id2)
+            save_record.write_idx(count, pack(header, jpeg))
             count += 1
             if count % 10000 == 0:
                 cur_time = time.time()
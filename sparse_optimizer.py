@@ -0,0 +1,186 @@
+import math
+
+import torch
+
+
+def _sgd_rows(rows, grad, momentum_buffer, lr, momentum, dampening, weight_decay, nesterov):
+    """ In-place SGD update of a block of rows and its momentum rows """
+    if weight_decay != 0:
+        grad = grad.add(rows, alpha=weight_decay)
+    if momentum != 0:
+        momentum_buffer.mul_(momentum).add_(grad, alpha=1 - dampening)
+        if nesterov:
+            grad = grad.add(momentum_buffer, alpha=momentum)
+        else:
+            grad = momentum_buffer
+    rows.add_(grad, alpha=-lr)
+
+
+def _adamw_rows(rows, grad, exp_avg, exp_avg_sq, bias_correction1, bias_correction2,
+                lr, beta1, beta2, eps, weight_decay):
+    """ In-place AdamW update of a block of rows, bias corrections are floats or (rows, 1) tensors """
+    rows.mul_(1 - lr * weight_decay)
+    exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+    denom = (exp_avg_sq.sqrt() / bias_correction2 ** 0.5).add_(eps)
+    rows.addcdiv_(exp_avg / bias_correction1, denom, value=-lr)
+
+
+def _row_store(param):
+    """ Host storage of a parameter that only holds the sampled rows, see `partial_fc_offload` """
+    return getattr(param, "row_store", None)
+
+
+def _sparse_rows(param):
+    """ Returns (index, values) of a row-sparse gradient, e.g. from `embedding(..., sparse=True)` """
+    grad = param.grad.coalesce()
+    return grad.indices()[0], grad.values()
+
+
+class SparseRowSGD(torch.optim.Optimizer):
+    """
+    SGD with momentum that updates parameters with a row-sparse gradient lazily.
+    Dense gradients (the backbone) follow `torch.optim.SGD`. For a sparse gradient (the
+    class centers of PartialFC_V2 with `sparse_grad=True`) only the rows that received a
+    gradient are read, decayed and written back, together with their momentum rows, so the
+    cost of a step scales with the sample rate instead of the number of classes. Class centers
+    offloaded to the host keep their momentum in the host store and are written back to it.
+    Example:
+    --------
+    >>> module_pfc = PartialFC_V2(margin_loss, 512, 8000000, sample_rate=0.1, sparse_grad=True)
+    >>> opt = SparseRowSGD(
+    >>>     [{"params": backbone.parameters()}, {"params": module_pfc.parameters()}],
+    >>>     lr=0.1, momentum=0.9, weight_decay=5e-4)
+    """
+
+    def __init__(self, params, lr, momentum=0, dampening=0, weight_decay=0, nesterov=False):
+        if lr < 0.0:
+            raise ValueError(f"Invalid learning rate: {lr}")
+        if nesterov and (momentum <= 0 or dampening != 0):
+            raise ValueError("Nesterov momentum requires a momentum and zero dampening")
+        defaults = dict(lr=lr, momentum=momentum, dampening=dampening,
+                        weight_decay=weight_decay, nesterov=nesterov)
+        super(SparseRowSGD, self).__init__(params, defaults)
+
+    def _momentum_buffer(self, param):
+        state = self.state[param]
+        if "momentum_buffer" not in state:
+            state["momentum_buffer"] = torch.zeros_like(param, memory_format=torch.preserve_format)
+        return state["momentum_buffer"]
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            args = (group["lr"], group["momentum"], group["dampening"],
+                    group["weight_decay"], group["nesterov"])
+            for param in group["params"]:
+                if param.grad is None:
+                    continue
+                if _row_store(param) is not None:
+                    store = _row_store(param)
+                    buffer = store.state_rows_for("momentum_buffer") if group["momentum"] != 0 else None
+                    _sgd_rows(param, param.grad, buffer, *args)
+                    store.write_back()
+                    continue
+                buffer = self._momentum_buffer(param) if group["momentum"] != 0 else None
+                if param.grad.is_sparse:
+                    index, grad = _sparse_rows(param)
+                    rows = param.index_select(0, index)
+                    buffer_rows = buffer.index_select(0, index) if buffer is not None else None
+                    _sgd_rows(rows, grad, buffer_rows, *args)
+                    param.index_copy_(0, index, rows)
+                    if buffer is not None:
+                        buffer.index_copy_(0, index, buffer_rows)
+                else:
+                    _sgd_rows(param, param.grad, buffer, *args)
+        return loss
+
+    def zero_grad(self, set_to_none: bool = False):
+        # a sparse or offloaded gradient holds different rows every step, never zero it in place
+        for group in self.param_groups:
+            for param in group["params"]:
+                if param.grad is not None and (param.grad.is_sparse or _row_store(param) is not None):
+                    param.grad = None
+        super(SparseRowSGD, self).zero_grad(set_to_none)
+
+
+class SparseRowAdamW(torch.optim.Optimizer):
+    """
+    AdamW (decoupled weight decay) with lazy, row-wise state for row-sparse gradients.
+    Dense gradients follow `torch.optim.AdamW`. For a sparse gradient, moments, weight
+    decay and the bias correction are applied only to the sampled rows; every row keeps its
+    own step count, so a class center that is sampled rarely is still bias-corrected as if
+    it had been trained alone.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2):
+        if lr < 0.0:
+            raise ValueError(f"Invalid learning rate: {lr}")
+        if not 0.0 <= betas[0] < 1.0 or not 0.0 <= betas[1] < 1.0:
+            raise ValueError(f"Invalid beta parameters: {betas}")
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super(SparseRowAdamW, self).__init__(params, defaults)
+
+    def _init_state(self, param, sparse):
+        state = self.state[param]
+        if len(state) == 0:
+            state["exp_avg"] = torch.zeros_like(param, memory_format=torch.preserve_format)
+            state["exp_avg_sq"] = torch.zeros_like(param, memory_format=torch.preserve_format)
+            # one step count per row for sparse parameters, a scalar otherwise
+            state["step"] = torch.zeros(param.size(0), device=param.device) if sparse else 0
+        return state
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            args = (group["lr"], beta1, beta2, group["eps"], group["weight_decay"])
+            for param in group["params"]:
+                if param.grad is None:
+                    continue
+                if _row_store(param) is not None:
+                    store = _row_store(param)
+                    step = store.state_rows_for("step", per_row=True).add_(1).unsqueeze(1)
+                    _adamw_rows(param, param.grad,
+                                store.state_rows_for("exp_avg"), store.state_rows_for("exp_avg_sq"),
+                                1 - torch.pow(beta1, step), 1 - torch.pow(beta2, step), *args)
+                    store.write_back()
+                    continue
+                state = self._init_state(param, param.grad.is_sparse)
+                if param.grad.is_sparse:
+                    index, grad = _sparse_rows(param)
+                    step = state["step"].index_select(0, index).add_(1)
+                    state["step"].index_copy_(0, index, step)
+                    step = step.unsqueeze(1)
+                    rows = param.index_select(0, index)
+                    exp_avg = state["exp_avg"].index_select(0, index)
+                    exp_avg_sq = state["exp_avg_sq"].index_select(0, index)
+                    _adamw_rows(rows, grad, exp_avg, exp_avg_sq,
+                                1 - torch.pow(beta1, step), 1 - torch.pow(beta2, step), *args)
+                    param.index_copy_(0, index, rows)
+                    state["exp_avg"].index_copy_(0, index, exp_avg)
+                    state["exp_avg_sq"].index_copy_(0, index, exp_avg_sq)
+                else:
+                    state["step"] += 1
+                    _adamw_rows(param, param.grad, state["exp_avg"], state["exp_avg_sq"],
+                                1 - math.pow(beta1, state["step"]), 1 - math.pow(beta2, state["step"]),
+                                *args)
+        return loss
+
+    def zero_grad(self, set_to_none: bool = False):
+        for group in self.param_groups:
+            for param in group["params"]:
+                if param.grad is not None and (param.grad.is_sparse or _row_store(param) is not None):
+                    param.grad = None
+        super(SparseRowAdamW, self).zero_grad(set_to_none)
+
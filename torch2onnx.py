@@ -1,32 +1,114 @@
+import json
+import os
+
 import numpy as np
 import onnx
 import torch
 
+# Export of a backbone to a serving directory of onnx_helper.ArcFaceORT / embedding_server.py, e.g.:
+# python torch2onnx.py work_dirs/r100 --network r100 --uint8 --flip
+# writes work_dirs/r100/model.onnx (dynamic batch), model_opt.onnx (graph optimized offline, loaded
+# by ArcFaceORT since it sorts last) and parity.json (both models against the PyTorch backbone).
 
-def convert_onnx(net, path_module, output, opset=11, simplify=False):
-    assert isinstance(net, torch.nn.Module)
-    img = np.random.randint(0, 255, size=(112, 112, 3), dtype=np.int32)
-    img = img.astype(np.float)
-    img = (img / 255. - 0.5) / 0.5  # torch style norm
-    img = img.transpose((2, 0, 1))
-    img = torch.from_numpy(img).unsqueeze(0).float()
 
-    weight = torch.load(path_module)
+class ExportWrapper(torch.nn.Module):
+    """
+    Backbone with the preprocessing and the flip test in the graph:
+    `uint8`: the input is the raw RGB NCHW uint8 image, normalized to [-1, 1] in the graph,
+    `flip`: the embedding is the sum of those of the image and of its horizontal flip.
+    """
+
+    def __init__(self, backbone, uint8=False, flip=False):
+        super(ExportWrapper, self).__init__()
+        self.backbone = backbone
+        self.uint8 = uint8
+        self.flip = flip
+
+    def forward(self, x):
+        if self.uint8:
+            x = (x.float() - 127.5) * (1 / 127.5)
+        if not self.flip:
+            return self.backbone(x)
+        batch_size = x.shape[0]
+        # a Gather on the width: torch.flip has no ONNX export before torch 1.13
+        flipped = x.index_select(3, torch.arange(x.shape[3] - 1, -1, -1, device=x.device))
+        feat = self.backbone(torch.cat([x, flipped]))
+        return feat[:batch_size] + feat[batch_size:]
+
+
+def convert_onnx(net, path_module, output, opset=13, simplify=False, fuse=True, uint8=False, flip=False,
+                 fp16=False, image_size=(112, 112)):
+    """
+    Parameters:
+    ----------
+    net: torch.nn.Module
+        backbone of get_model, `path_module` its weights.
+    fuse: bool
+        fold the BatchNorms (see backbones.optimize_for_inference).
+    uint8, flip: bool
+        preprocessing and flip test in the graph, see ExportWrapper.
+    fp16: bool
+        float16 weights and activations, float32 inputs and outputs (onnxconverter-common), for GPUs.
+    """
+    assert isinstance(net, torch.nn.Module)
+    weight = torch.load(path_module, map_location="cpu")
     net.load_state_dict(weight, strict=True)
     net.eval()
-    torch.onnx.export(net, img, output, input_names=["data"], keep_initializers_as_inputs=False, verbose=False, opset_version=opset)
-    model = onnx.load(output)
-    graph = model.graph
-    graph.input[0].type.tensor_type.shape.dim[0].dim_param = 'None'
+    if fuse:
+        from backbones import optimize_for_inference
+        net = optimize_for_inference(net, channels_last=False)
+    model = ExportWrapper(net, uint8=uint8, flip=flip).eval()
+
+    img = np.random.randint(0, 255, size=(2, 3, image_size[1], image_size[0]), dtype=np.uint8)
+    img = torch.from_numpy(img) if uint8 else torch.from_numpy((img / 255. - 0.5) / 0.5).float()
+    with torch.no_grad():
+        torch.onnx.export(model, img, output, input_names=["data"], output_names=["feature"],
+                          dynamic_axes={"data": {0: "batch"}, "feature": {0: "batch"}},
+                          keep_initializers_as_inputs=False, verbose=False, opset_version=opset)
+    onnx_model = onnx.load(output)
     if simplify:
         from onnxsim import simplify
-        model, check = simplify(model)
+        onnx_model, check = simplify(onnx_model)
         assert check, "Simplified ONNX model could not be validated"
-    onnx.save(model, output)
+    if fp16:
+        from onnxconverter_common import float16
+        onnx_model = float16.convert_float_to_float16(onnx_model, keep_io_types=True)
+    onnx.checker.check_model(onnx_model)
+    onnx.save(onnx_model, output)
+    return model
+
+
+def optimize_onnx(model_file, output, level="extended"):
+    """
+    Saves the graph optimized by onnxruntime, so that serving does not optimize it again at load
+    time. "extended" keeps the model portable, "all" adds layout transformations specific to the CPU
+    of the export machine.
+    """
+    from onnx_helper import create_session
+    create_session(model_file, ["CPUExecutionProvider"], graph_optimization=level, optimized_model_file=output)
+    return output
+
+
+def parity_report(model, onnx_files, uint8=False, batch_sizes=(1, 8), image_size=(112, 112)):
+    """ Minimum cosine similarity and maximum absolute difference of every onnx model against `model` """
+    from onnx_helper import create_session
+    report = {}
+    sessions = {os.path.basename(f): create_session(f, ["CPUExecutionProvider"]) for f in onnx_files}
+    for batch_size in batch_sizes:
+        img = np.random.randint(0, 255, size=(batch_size, 3, image_size[1], image_size[0]), dtype=np.uint8)
+        blob = img if uint8 else ((img / 255. - 0.5) / 0.5).astype(np.float32)
+        with torch.no_grad():
+            reference = model(torch.from_numpy(blob)).numpy()
+        for name, session in sessions.items():
+            feat = session.run(None, {session.get_inputs()[0].name: blob})[0].astype(np.float32)
+            cosine = np.sum(reference * feat, axis=1) / (
+                np.linalg.norm(reference, axis=1) * np.linalg.norm(feat, axis=1))
+            report.setdefault(name, {})[f"batch_{batch_size}"] = {
+                "min_cosine": float(cosine.min()), "max_abs_diff": float(np.abs(reference - feat).max())}
+    return report
+
 
-    
 if __name__ == '__main__':
-    import os
     import argparse
     from backbones import get_model
 
@@ -34,7 +116,14 @@ if __name__ == '__main__':
     parser.add_argument('input', type=str, help='input backbone.pth file or path')
     parser.add_argument('--output', type=str, default=None, help='output onnx path')
     parser.add_argument('--network', type=str, default=None, help='backbone network')
-    parser.add_argument('--simplify', type=bool, default=False, help='onnx simplify')
+    parser.add_argument('--opset', type=int, default=13, help='13 exports on torch >= 1.8, 17 needs torch >= 1.13')
+    parser.add_argument('--simplify', action='store_true', help='onnx simplify')
+    parser.add_argument('--no-fuse', action='store_true', help='keep the BatchNorms of iresnet unfolded')
+    parser.add_argument('--uint8', action='store_true', help='uint8 RGB input, pixel normalization in the graph')
+    parser.add_argument('--flip', action='store_true', help='flip test in the graph')
+    parser.add_argument('--fp16', action='store_true', help='float16 model (GPU)')
+    parser.add_argument('--optimization', type=str, default='extended', choices=['disable', 'basic', 'extended', 'all'],
+                        help='offline onnxruntime graph optimization, "disable": no optimized model')
     args = parser.parse_args()
     input_file = args.input
     if os.path.isdir(input_file):
@@ -49,5 +138,13 @@ if __name__ == '__main__':
     print(args)
     backbone_onnx = get_model(args.network, dropout=0.0, fp16=False, num_features=512)
     if args.output is None:
-        args.output = os.path.join(os.path.dirname(args.input), "model.onnx")
-    convert_onnx(backbone_onnx, input_file, args.output, simplify=args.simplify)
+        args.output = os.path.join(os.path.dirname(input_file), "model.onnx")
+    model = convert_onnx(backbone_onnx, input_file, args.output, opset=args.opset, simplify=args.simplify,
+                         fuse=not args.no_fuse, uint8=args.uint8, flip=args.flip, fp16=args.fp16)
+    onnx_files = [args.output]
+    if args.optimization != 'disable':
+        onnx_files.append(optimize_onnx(args.output, os.path.splitext(args.output)[0] + "_opt.onnx", args.optimization))
+    report = parity_report(model, onnx_files, uint8=args.uint8)
+    print(json.dumps(report, indent=2))
+    with open(os.path.join(os.path.dirname(os.path.abspath(args.output)), "parity.json"), "w") as f:
+        json.dump(report, f, indent=2)
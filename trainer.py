@@ -0,0 +1,408 @@
+import argparse
+import logging
+import os
+import random
+from datetime import datetime
+
+import torch
+from backbones import get_model
+from dataset import get_dataloader
+from heads import get_heads
+from lr_scheduler import PolyScheduler
+from sparse_optimizer import SparseRowAdamW, SparseRowSGD
+from torch import distributed
+from torch.utils.data import DataLoader
+from torch.utils.tensorboard import SummaryWriter
+from utils.utils_callbacks_frcsyn import CallBackLogging, CallBackVerification
+from utils.utils_checkpoint import BACKBONE_CHECKPOINT, AsyncCheckpointer, load_checkpoint, split_checkpoint
+from utils.utils_compile import compile_module
+from utils.utils_config import get_config
+from utils.utils_distributed_sampler import setup_seed
+from utils.utils_logging import AverageMeter, init_logging
+from utils.utils_profiler import StepProfiler
+
+
+def init_distributed():
+    try:
+        rank = int(os.environ["RANK"])
+        local_rank = int(os.environ["LOCAL_RANK"])
+        world_size = int(os.environ["WORLD_SIZE"])
+        distributed.init_process_group("nccl")
+    except KeyError:
+        rank = 0
+        local_rank = 0
+        world_size = 1
+        distributed.init_process_group(
+            backend="nccl",
+            init_method="tcp://127.0.0.1:" + str(int(random.random() * 10000 + 12000)),
+            rank=rank,
+            world_size=world_size,
+        )
+    return rank, local_rank, world_size
+
+
+def unpack_batch(train_batch):
+    """
+    Splits a batch of any of the dataloaders into the images and a dict of labels.
+    2-tuple: (img, id), 4-tuple: (img, id, race, gender), 5-tuple: (img, id, age, gender, race).
+    Missing labels are -1, ignored by the heads.
+    """
+    if len(train_batch) == 2:
+        img, local_labels = train_batch
+        labels = {"id": local_labels}
+    elif len(train_batch) == 4:
+        img, local_labels, race_labels, gender_labels = train_batch
+        labels = {"id": local_labels, "race": race_labels, "gender": gender_labels}
+    elif len(train_batch) == 5:
+        img, local_labels, age_labels, gender_labels, race_labels = train_batch
+        labels = {"id": local_labels, "age": age_labels, "gender": gender_labels, "race": race_labels}
+    else:
+        raise ValueError(f"unexpected batch of {len(train_batch)} elements")
+    for name in ("age", "gender", "race"):
+        if name not in labels:
+            labels[name] = torch.full_like(local_labels, -1)
+    return img, labels
+
+
+def init_wandb(cfg, rank, run_name):
+    import wandb
+    # Sign in to wandb
+    try:
+        wandb.login(key=cfg.wandb_key)
+    except Exception as e:
+        print("WandB Key must be provided in config file (base.py).")
+        print(f"Config Error: {e}")
+    # Initialize wandb
+    run_name = run_name if cfg.suffix_run_name is None else run_name + f"_{cfg.suffix_run_name}"
+    try:
+        wandb_logger = wandb.init(
+            entity = cfg.wandb_entity,
+            project = cfg.wandb_project,
+            sync_tensorboard = True,
+            resume=cfg.wandb_resume,
+            name = run_name,
+            notes = cfg.notes) if rank == 0 or cfg.wandb_log_all else None
+        if wandb_logger:
+            wandb_logger.config.update(cfg)
+        return wandb_logger
+    except Exception as e:
+        print("WandB Data (Entity and Project name) must be provided in config file (base.py).")
+        print(f"Config Error: {e}")
+    return None
+
+
+def build_optimizer(cfg, param_groups):
+    # the sparse optimizers are only needed by the sampled (or offloaded) class centers of PartialFC_V2
+    sparse = cfg.sparse_optimizer or cfg.pfc_offload
+    if cfg.optimizer == "sgd":
+        return (SparseRowSGD if sparse else torch.optim.SGD)(
+            params=param_groups, lr=cfg.lr, momentum=0.9, weight_decay=cfg.weight_decay)
+    elif cfg.optimizer == "adamw":
+        return (SparseRowAdamW if sparse else torch.optim.AdamW)(
+            params=param_groups, lr=cfg.lr, weight_decay=cfg.weight_decay)
+    raise ValueError(f"optimizer not supported: {cfg.optimizer}")
+
+
+def save_artifact(wandb_logger, artifact_name, path_module):
+    import wandb
+    model = wandb.Artifact(artifact_name, type='model')
+    model.add_file(path_module)
+    wandb_logger.log_artifact(model)
+
+
+def main(args, heads=("id",), **overrides):
+    """
+    Trains `cfg.network` with the heads of `cfg.heads` (or `heads` when the config has none),
+    see heads.HEADS. `overrides` are set on the config after it is loaded.
+    """
+    rank, local_rank, world_size = init_distributed()
+
+    run_name = datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + f"_GPU{rank}"
+    run_name += f'_{args.annotation}' if args.annotation != '' else ''
+
+    # get config
+    cfg = get_config(args.config, run_name)
+    cfg.update(overrides)
+    cfg.heads = list(cfg.heads or heads)
+    if cfg.pfc_offload and cfg.gradient_acc != 1:
+        raise ValueError("pfc_offload does not support gradient accumulation, set gradient_acc = 1")
+    # global control random seed
+    setup_seed(seed=cfg.seed, cuda_deterministic=False)
+
+    torch.cuda.set_device(local_rank)
+
+    os.makedirs(cfg.output, exist_ok=True)
+    init_logging(rank, cfg.output)
+
+    summary_writer = (
+        SummaryWriter(log_dir=os.path.join(cfg.output, "tensorboard"))
+        if rank == 0
+        else None
+    )
+    wandb_logger = init_wandb(cfg, rank, run_name) if cfg.using_wandb else None
+
+    train_loader = get_dataloader(
+        cfg.rec,
+        local_rank,
+        cfg.batch_size,
+        cfg.dali,
+        cfg.seed,
+        cfg.num_workers,
+        "balanced" if cfg.train_rule == "Resample" else cfg.sampler,
+        cfg.balance_by,
+        cfg.balance_power,
+        cfg.num_instances,
+        cfg.host_prefetch,
+        cfg.device_prefetch,
+        cfg.reuse_buffers
+    )
+
+    backbone_kwargs = {}
+    if cfg.checkpoint_stages:
+        backbone_kwargs["checkpoint_stages"] = cfg.checkpoint_stages
+    if cfg.checkpoint_interval:
+        backbone_kwargs["checkpoint_interval"] = cfg.checkpoint_interval
+    backbone = get_model(
+        cfg.network, dropout=0.0, fp16=cfg.fp16, num_features=cfg.embedding_size, **backbone_kwargs).cuda()
+    if cfg.channels_last:
+        backbone = backbone.to(memory_format=torch.channels_last)
+    if cfg.compile:
+        compile_module(backbone, cfg.compile, cfg.compile_backend, cfg.compile_suppress_errors)
+
+    backbone = torch.nn.parallel.DistributedDataParallel(
+        module=backbone, broadcast_buffers=False, device_ids=[local_rank], bucket_cap_mb=16,
+        find_unused_parameters=True)
+    backbone.train()
+    # FIXME using gradient checkpoint if there are some unused parameters will cause error
+    backbone._set_static_graph()
+
+    train_heads = get_heads(cfg.heads, cfg, train_loader, local_rank)
+    if cfg.compile:
+        for head in train_heads:
+            head.compile(cfg.compile, cfg.compile_backend, cfg.compile_suppress_errors)
+
+    # the params of partial fc v1 must be last in the params list
+    param_groups = [{"params": backbone.parameters()}]
+    for head in train_heads:
+        param_groups += head.param_groups
+    for head in train_heads:
+        param_groups += head.partial_fc_groups
+    opt = build_optimizer(cfg, param_groups)
+    for head in train_heads:
+        head.optimizer = opt
+    clip_groups = [list(backbone.parameters())]
+    for head in train_heads:
+        clip_groups += head.clip_groups
+
+    cfg.total_batch_size = cfg.batch_size * world_size
+    cfg.warmup_step = cfg.num_image // cfg.total_batch_size * cfg.warmup_epoch
+    cfg.total_step = cfg.num_image // cfg.total_batch_size * cfg.num_epoch
+
+    lr_scheduler = PolyScheduler(
+        optimizer=opt,
+        base_lr=cfg.lr,
+        max_steps=cfg.total_step,
+        warmup_steps=cfg.warmup_step,
+        last_epoch=-1
+    )
+
+    start_epoch = 0
+    start_batch = 0
+    global_step = 0
+    path_checkpoint = os.path.join(cfg.output, f"checkpoint_gpu_{rank}.pt") if cfg.resume else None
+    if args.resume != '' and os.path.isfile(args.resume):
+        path_checkpoint = args.resume
+    if path_checkpoint:
+        logging.info(f"Loading checkpoint '{path_checkpoint}'")
+        dict_checkpoint = load_checkpoint(path_checkpoint)
+        start_epoch = dict_checkpoint["epoch"]
+        start_batch = dict_checkpoint.get("batch_in_epoch", 0)
+        if "state_sampler" in dict_checkpoint and isinstance(train_loader, DataLoader):
+            train_loader.sampler.load_state_dict(dict_checkpoint["state_sampler"])
+        global_step = dict_checkpoint["global_step"]
+        backbone.module.load_state_dict(dict_checkpoint["state_dict_backbone"])
+        for head in train_heads:
+            head.load_state_dict(dict_checkpoint)
+        opt.load_state_dict(dict_checkpoint["state_optimizer"])
+        lr_scheduler.load_state_dict(dict_checkpoint["state_lr_scheduler"])
+        del dict_checkpoint
+
+    for key, value in cfg.items():
+        num_space = 25 - len(key)
+        logging.info(": " + key + " " * num_space + str(value))
+
+    callback_verification = CallBackVerification(
+        val_targets=cfg.val_targets, rec_prefix=cfg.rec,
+        summary_writer=summary_writer, wandb_logger = wandb_logger,
+        cfg=cfg
+    )
+    profiler = StepProfiler(enabled=cfg.profile, window=cfg.frequent)
+    if hasattr(train_loader, "profiler"):
+        train_loader.profiler = profiler if cfg.profile else None
+    callback_logging = CallBackLogging(
+        frequent=cfg.frequent,
+        num_epoch=cfg.num_epoch,
+        total_step=cfg.total_step,
+        batch_size=cfg.batch_size,
+        start_step = global_step,
+        writer=summary_writer,
+        profiler=profiler if cfg.profile else None,
+        wandb_logger=wandb_logger
+    )
+
+    checkpointer = AsyncCheckpointer(cfg.async_checkpoint)
+
+    def checkpoint_files(epoch, batch_in_epoch):
+        """ Backbone once (rank 0), the heads and the rest of the optimizer state on every rank """
+        checkpoint = {
+            "epoch": epoch,
+            "batch_in_epoch": batch_in_epoch,
+            "global_step": global_step,
+            "state_dict_backbone": backbone.module.state_dict(),
+            "state_optimizer": opt.state_dict(),
+            "state_lr_scheduler": lr_scheduler.state_dict()
+        }
+        if isinstance(train_loader, DataLoader):
+            checkpoint["state_sampler"] = dict(
+                train_loader.sampler.state_dict(batch_in_epoch * cfg.batch_size), epoch=epoch)
+        for head in train_heads:
+            checkpoint.update(head.state_dict())
+        shared, local = split_checkpoint(checkpoint)
+        files = {os.path.join(cfg.output, f"checkpoint_gpu_{rank}.pt"): local}
+        if rank == 0:
+            files[os.path.join(cfg.output, BACKBONE_CHECKPOINT)] = shared
+        return files
+
+    loss_am = {}
+    loss_sums, loss_steps = {}, 0
+    amp = torch.cuda.amp.grad_scaler.GradScaler(growth_interval=100)
+
+    for epoch in range(start_epoch, cfg.num_epoch):
+
+        batch_in_epoch = start_batch if epoch == start_epoch else 0
+        if isinstance(train_loader, DataLoader):
+            train_loader.sampler.set_epoch(epoch)
+            train_loader.sampler.set_start_index(batch_in_epoch * cfg.batch_size)
+        elif batch_in_epoch > 0:
+            logging.warning("DALI can not resume in the middle of an epoch, the epoch restarts")
+        for _, train_batch in enumerate(train_loader):
+            img, labels = unpack_batch(train_batch)
+            if cfg.channels_last:
+                img = img.contiguous(memory_format=torch.channels_last)
+
+            global_step += 1
+            batch_in_epoch += 1
+            with profiler.phase("forward"):
+                local_embeddings = backbone(img)
+
+            loss_total = 0
+            losses = {}
+            for name, head in zip(cfg.heads, train_heads):
+                with profiler.phase(f"head_{name}"):
+                    loss_head, losses_head = head(local_embeddings, labels)
+                loss_total = loss_total + loss_head
+                losses.update(losses_head)
+            if len(losses) > 1:
+                losses["total"] = loss_total
+
+            if cfg.fp16:
+                with profiler.phase("backward"):
+                    amp.scale(loss_total).backward()
+                if global_step % cfg.gradient_acc == 0:
+                    with profiler.phase("optimizer"):
+                        amp.unscale_(opt)
+                        for params in clip_groups:
+                            torch.nn.utils.clip_grad_norm_(params, 5)
+                        amp.step(opt)
+                        amp.update()
+                        opt.zero_grad()
+            else:
+                with profiler.phase("backward"):
+                    loss_total.backward()
+                if global_step % cfg.gradient_acc == 0:
+                    with profiler.phase("optimizer"):
+                        for params in clip_groups:
+                            torch.nn.utils.clip_grad_norm_(params, 5)
+                        opt.step()
+                        opt.zero_grad()
+            lr_scheduler.step()
+            profiler.step()
+
+            with torch.no_grad():
+                # the losses are summed on the device and read back once per logging interval,
+                # a .item() per step would make the host wait for the step to finish
+                for label, loss in losses.items():
+                    loss = loss.detach()
+                    loss_sums[label] = loss_sums[label] + loss if label in loss_sums else loss
+                loss_steps += 1
+
+                if global_step % cfg.frequent == 0:
+                    loss_avgs = torch.stack(list(loss_sums.values())).div_(loss_steps).tolist()
+                    loss_avgs = dict(zip(loss_sums, loss_avgs))
+                    learning_rate = lr_scheduler.get_last_lr()[0]
+                    if wandb_logger:
+                        if len(loss_avgs) == 1:
+                            log_losses = {'Loss/Step Loss': next(iter(loss_avgs.values()))}
+                        else:
+                            log_losses = {f'Loss/Step Loss{label.upper()}': loss for label, loss in loss_avgs.items()}
+                        wandb_logger.log({
+                            **log_losses,
+                            'Process/Step': global_step,
+                            'Process/Epoch': epoch,
+                            'Process/Learning Rate': learning_rate
+                        })
+                    for label, loss in loss_avgs.items():
+                        loss_am.setdefault(label, AverageMeter()).update(loss, loss_steps)
+                        callback_logging(label, global_step, loss_am[label], epoch, cfg.fp16, learning_rate, amp)
+                    loss_sums, loss_steps = {}, 0
+
+                if global_step % cfg.verbose == 0 and global_step > 0:
+                    callback_verification(global_step, backbone)
+
+            if cfg.save_all_states and cfg.checkpoint_every > 0 and global_step % cfg.checkpoint_every == 0 \
+                    and global_step % cfg.gradient_acc == 0:
+                checkpointer.save(checkpoint_files(epoch, batch_in_epoch))
+
+        files = checkpoint_files(epoch + 1, 0) if cfg.save_all_states else {}
+        path_module = os.path.join(cfg.output, "model.pt")
+        if rank == 0:
+            files[path_module] = backbone.module.state_dict()
+        checkpointer.save(files)
+
+        if rank == 0 and wandb_logger and cfg.save_artifacts:
+            checkpointer.wait()
+            save_artifact(wandb_logger, f"{run_name}_E{epoch}", path_module)
+
+        if cfg.dali:
+            train_loader.reset()
+
+    if rank == 0:
+        path_module = os.path.join(cfg.output, "model.pt")
+        checkpointer.save({path_module: backbone.module.state_dict()})
+        checkpointer.wait()
+
+        if cfg.export_onnx:
+            from torch2onnx import convert_onnx
+            # a new eager CPU backbone (the trained one may be compiled), convert_onnx loads model.pt
+            net = get_model(cfg.network, dropout=0.0, fp16=False, num_features=cfg.embedding_size)
+            convert_onnx(net, path_module, os.path.join(cfg.output, "model.onnx"))
+
+        if wandb_logger and cfg.save_artifacts:
+            save_artifact(wandb_logger, f"{run_name}_Final", path_module)
+    checkpointer.wait()
+
+    distributed.destroy_process_group()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Distributed Arcface Training in Pytorch")
+    parser.add_argument("config", type=str, help="py config file")
+    parser.add_argument("--annotation", default="", type=str, help="suffix of the run name")
+    parser.add_argument("--resume", default="", type=str, help="checkpoint to resume from, overrides config.resume")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    torch.backends.cudnn.benchmark = True
+    main(get_args())
@@ -100,7 +100,8 @@ class CallBackVerification(object):
 
 
 class CallBackLogging(object):
-    def __init__(self, frequent, num_epoch, total_step, batch_size, start_step=0, writer=None):
+    def __init__(self, frequent, num_epoch, total_step, batch_size, start_step=0, writer=None,
+                 profiler=None, wandb_logger=None):
         self.frequent: int = frequent
         self.rank: int = distributed.get_rank()
         self.world_size: int = distributed.get_world_size()
@@ -110,9 +111,48 @@ class CallBackLogging(object):
         self.start_step: int = start_step
         self.batch_size: int = batch_size
         self.writer = writer
+        self.profiler = profiler
+        self.wandb_logger = wandb_logger
 
         self.init = False
         self.tic = 0
+        # speed and ETA of the last logged step, shared by all the labels logged at that step
+        self.logged_step = None
+        self.speed_total = 0.0
+        self.time_for_end = 0.0
+
+    def log_step(self, global_step: int, learning_rate: float):
+        """ Speed, ETA and profile of the step, computed once per step whatever the number of labels """
+        try:
+            speed: float = self.frequent * self.batch_size / (time.time() - self.tic)
+            self.speed_total = speed * self.world_size
+        except ZeroDivisionError:
+            self.speed_total = float('inf')
+
+        #time_now = (time.time() - self.time_start) / 3600
+        #time_total = time_now / ((global_step + 1) / self.total_step)
+        #time_for_end = time_total - time_now
+        time_now = time.time()
+        time_sec = int(time_now - self.time_start)
+        time_sec_avg = time_sec / (global_step - self.start_step + 1)
+        eta_sec = time_sec_avg * (self.total_step - global_step - 1)
+        self.time_for_end = eta_sec/3600
+        if self.writer is not None:
+            self.writer.add_scalar('time_for_end', self.time_for_end, global_step)
+            self.writer.add_scalar('learning_rate', learning_rate, global_step)
+
+        if self.profiler is not None:
+            stats = self.profiler.summary()
+            if stats:
+                logging.info("Profile   " + "   ".join("%s %.2f" % (name, value) for name, value in stats.items()))
+                if self.writer is not None:
+                    for name, value in stats.items():
+                        self.writer.add_scalar(f'profile/{name}', value, global_step)
+                if self.wandb_logger:
+                    self.wandb_logger.log({f'Profile/{name}': value for name, value in stats.items()})
+
+        self.logged_step = global_step
+        self.tic = time.time()
 
     def __call__(self,
                  label,
@@ -123,39 +163,32 @@ class CallBackLogging(object):
                  learning_rate: float,
                  grad_scaler: torch.cuda.amp.GradScaler):
         if self.rank == 0 and global_step > 0 and global_step % self.frequent == 0:
-            if self.init:
-                try:
-                    speed: float = self.frequent * self.batch_size / (time.time() - self.tic)
-                    speed_total = speed * self.world_size
-                except ZeroDivisionError:
-                    speed_total = float('inf')
-
-                #time_now = (time.time() - self.time_start) / 3600
-                #time_total = time_now / ((global_step + 1) / self.total_step)
-                #time_for_end = time_total - time_now
-                time_now = time.time()
-                time_sec = int(time_now - self.time_start)
-                time_sec_avg = time_sec / (global_step - self.start_step + 1)
-                eta_sec = time_sec_avg * (self.total_step - global_step - 1)
-                time_for_end = eta_sec/3600
-                if self.writer is not None:
-                    self.writer.add_scalar('time_for_end', time_for_end, global_step)
-                    self.writer.add_scalar('learning_rate', learning_rate, global_step)
-                    self.writer.add_scalar(f'loss_{label}', loss.avg, global_step)
-                if fp16:
-                    msg = "Speed %.2f samples/sec   Loss (%s) %.4f   LearningRate %.6f   Epoch: %d/%d   Global Step: %d   " \
-                          "Fp16 Grad Scale: %2.f   Required: %1.f hours" % (
-                              speed_total, label, loss.avg, learning_rate, epoch, self.num_epoch, global_step,
-                              grad_scaler.get_scale(), time_for_end
-                          )
+            if self.logged_step != global_step:
+                if self.init:
+                    self.log_step(global_step, learning_rate)
                 else:
-                    msg = "Speed %.2f samples/sec   Loss (%s) %.4f   LearningRate %.6f   Epoch: %d/%d   Global Step: %d   " \
-                          "Required: %1.f hours" % (
-                              speed_total, label, loss.avg, learning_rate, epoch, self.num_epoch, global_step, time_for_end
-                          )
-                logging.info(msg)
-                loss.reset()
-                self.tic = time.time()
+                    # the first interval only starts the timer
+                    self.init = True
+                    self.logged_step = global_step
+                    self.tic = time.time()
+                    self.speed_total = None
+                    if self.profiler is not None:
+                        self.profiler.summary()
+            if self.speed_total is None:
+                return
+            speed_total, time_for_end = self.speed_total, self.time_for_end
+            if self.writer is not None:
+                self.writer.add_scalar(f'loss_{label}', loss.avg, global_step)
+            if fp16:
+                msg = "Speed %.2f samples/sec   Loss (%s) %.4f   LearningRate %.6f   Epoch: %d/%d   Global Step: %d   " \
+                      "Fp16 Grad Scale: %2.f   Required: %1.f hours" % (
+                          speed_total, label, loss.avg, learning_rate, epoch, self.num_epoch, global_step,
+                          grad_scaler.get_scale(), time_for_end
+                      )
             else:
-                self.init = True
-                self.tic = time.time()
+                msg = "Speed %.2f samples/sec   Loss (%s) %.4f   LearningRate %.6f   Epoch: %d/%d   Global Step: %d   " \
+                      "Required: %1.f hours" % (
+                          speed_total, label, loss.avg, learning_rate, epoch, self.num_epoch, global_step, time_for_end
+                      )
+            logging.info(msg)
+            loss.reset()
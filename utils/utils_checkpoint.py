@@ -0,0 +1,124 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+BACKBONE_CHECKPOINT = "checkpoint_backbone.pt"
+
+
+def split_checkpoint(checkpoint, num_shared_groups=1):
+    """
+    Splits a training checkpoint into the state shared by all ranks, the backbone and the optimizer
+    state of the first `num_shared_groups` param groups (saved once, by rank 0), and the state of
+    this rank: the heads (the Partial FC shards) and the rest of the optimizer state.
+    """
+    shared = {"epoch": checkpoint["epoch"], "global_step": checkpoint["global_step"],
+              "state_dict_backbone": checkpoint["state_dict_backbone"]}
+    local = {key: value for key, value in checkpoint.items() if key != "state_dict_backbone"}
+    if "state_optimizer" in checkpoint:
+        state_optimizer = checkpoint["state_optimizer"]
+        param_groups = state_optimizer["param_groups"]
+        shared_params = set()
+        for group in param_groups[:num_shared_groups]:
+            shared_params.update(group["params"])
+        shared["state_optimizer"] = {
+            "state": {key: value for key, value in state_optimizer["state"].items() if key in shared_params},
+            "param_groups": param_groups[:num_shared_groups]}
+        local["state_optimizer"] = {
+            "state": {key: value for key, value in state_optimizer["state"].items() if key not in shared_params},
+            "param_groups": param_groups[num_shared_groups:]}
+    return shared, local
+
+
+def merge_checkpoint(shared, local):
+    if shared["global_step"] != local["global_step"]:
+        raise RuntimeError(
+            f"backbone checkpoint at step {shared['global_step']} does not match "
+            f"the rank checkpoint at step {local['global_step']}")
+    checkpoint = dict(local)
+    checkpoint["state_dict_backbone"] = shared["state_dict_backbone"]
+    if "state_optimizer" in local:
+        checkpoint["state_optimizer"] = {
+            "state": {**shared["state_optimizer"]["state"], **local["state_optimizer"]["state"]},
+            "param_groups": shared["state_optimizer"]["param_groups"] + local["state_optimizer"]["param_groups"]}
+    return checkpoint
+
+
+def load_checkpoint(path):
+    """
+    Loads the checkpoint of a rank on the CPU. Checkpoints written by AsyncCheckpointer are merged
+    with the backbone checkpoint of the same directory, older (full) checkpoints are loaded as they are.
+    """
+    checkpoint = torch.load(path, map_location="cpu")
+    if "state_dict_backbone" in checkpoint:
+        return checkpoint
+    shared = torch.load(os.path.join(os.path.dirname(path), BACKBONE_CHECKPOINT), map_location="cpu")
+    return merge_checkpoint(shared, checkpoint)
+
+
+class AsyncCheckpointer(object):
+    """
+    Writes checkpoints in a background thread. `save` copies the state to page-locked CPU buffers,
+    reused from one save to the next, and returns once the copies are queued; the thread waits for
+    them, writes every file to "<path>.tmp" and renames it, so a crash never leaves a partial file.
+    Only one save is in flight, a new save first waits for the previous one.
+    With `enabled=False` the files are written synchronously, still with the rename.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.pin = torch.cuda.is_available()
+        self.buffers = {}
+        self.executor = ThreadPoolExecutor(max_workers=1) if enabled else None
+        self.pending = None
+
+    def _snapshot(self, obj, key, memo):
+        if isinstance(obj, torch.Tensor):
+            if id(obj) in memo:
+                return memo[id(obj)]
+            buffer = self.buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self.pin and obj.is_cuda)
+                self.buffers[key] = buffer
+            buffer.copy_(obj.detach(), non_blocking=True)
+            memo[id(obj)] = buffer
+            return buffer
+        if isinstance(obj, dict):
+            return type(obj)((k, self._snapshot(v, f"{key}/{k}", memo)) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, f"{key}/{i}", memo) for i, v in enumerate(obj))
+        return obj
+
+    @staticmethod
+    def _write(files, event):
+        if event is not None:
+            event.synchronize()
+        for path, state in files.items():
+            path_tmp = path + ".tmp"
+            torch.save(state, path_tmp)
+            os.replace(path_tmp, path)
+
+    def save(self, files):
+        """
+        Parameters:
+        ----------
+        files: dict
+            path: state to save, tensors shared by several files are copied once.
+        """
+        if not self.enabled:
+            self._write(files, None)
+            return
+        self.wait()
+        memo = {}
+        snapshot = {path: self._snapshot(state, path, memo) for path, state in files.items()}
+        event = None
+        if self.pin:
+            event = torch.cuda.Event()
+            event.record()
+        self.pending = self.executor.submit(self._write, snapshot, event)
+
+    def wait(self):
+        """ Waits for the save in flight, raises its error if it failed """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
@@ -0,0 +1,67 @@
+import logging
+
+import torch
+
+
+def compile_available():
+    return hasattr(torch, "compile")
+
+
+class CompiledFunction(object):
+    """
+    Calls the compiled version of `function`, falling back to the eager one when the first call,
+    which traces and compiles the forward graph, fails. Only that call is guarded: a compile error
+    on a later call (e.g. of the backward graph, compiled at the first backward) is raised, unless
+    dynamo itself runs the failing frames eagerly (compile_function(..., suppress_errors=True)).
+    """
+
+    def __init__(self, function, compiled, name):
+        self.function = function
+        self.compiled = compiled
+        self.name = name
+        self.checked = False
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is None:
+            return self.function(*args, **kwargs)
+        if self.checked:
+            return self.compiled(*args, **kwargs)
+        try:
+            output = self.compiled(*args, **kwargs)
+        except Exception as e:
+            logging.warning(f"torch.compile failed for {self.name}, running it eagerly: {e}")
+            self.compiled = None
+            return self.function(*args, **kwargs)
+        self.checked = True
+        return output
+
+
+def compile_function(function, mode="default", backend="inductor", name=None, suppress_errors=False):
+    """
+    Parameters:
+    ----------
+    mode: str
+        "default", "reduce-overhead" (CUDA graphs) or "max-autotune", see torch.compile.
+    backend: str
+        "inductor" (also runs on CPU) or any other dynamo backend, e.g. "aot_eager".
+    suppress_errors: bool
+        sets torch._dynamo.config.suppress_errors, which is global: compile errors of every
+        compiled function of the process then fall back to eager with a warning.
+    """
+    name = name or getattr(function, "__qualname__", str(function))
+    if not compile_available():
+        logging.warning(f"torch.compile is not available in torch {torch.__version__}, {name} runs eagerly")
+        return CompiledFunction(function, None, name)
+    if suppress_errors:
+        import torch._dynamo
+        torch._dynamo.config.suppress_errors = True
+    return CompiledFunction(function, torch.compile(function, mode=mode, backend=backend), name)
+
+
+def compile_module(module, mode="default", backend="inductor", suppress_errors=False):
+    """
+    Compiles the forward of `module` in place, the module (and its state_dict keys) stays the
+    same, so it can still be wrapped by DistributedDataParallel and saved as before.
+    """
+    module.forward = compile_function(module.forward, mode, backend, type(module).__name__, suppress_errors)
+    return module
@@ -1,3 +1,4 @@
+import logging
 import math
 import os
 import random
@@ -98,8 +99,33 @@ class DistributedSampler(_DistributedSampler):
         # could use different indices to select non-overlapped data from the
         # same data list.
         self.seed = sync_random_seed(seed)
+        self.start_index = 0
+        # permutation of the current epoch, kept as a tensor
+        self._indices = None
+        self._indices_key = None
 
-    def __iter__(self):
+    def set_start_index(self, start_index):
+        """Skips the first `start_index` samples of this rank, to resume in the middle of an epoch.
+        The permutation is sliced, the skipped samples are never iterated."""
+        self.start_index = start_index
+
+    def state_dict(self, start_index=0):
+        """`start_index`: number of samples of this rank already consumed in the current epoch."""
+        return {"epoch": self.epoch, "seed": self.seed, "start_index": start_index}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict["epoch"]
+        self.seed = state_dict["seed"]
+        self.start_index = state_dict["start_index"]
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+    def rank_indices(self):
+        """Indices of this rank for the current epoch, as a tensor (before skipping `start_index`)."""
+        key = (self.epoch, self.seed, self.shuffle)
+        if self._indices_key == key:
+            return self._indices
         # deterministically shuffle based on epoch
         if self.shuffle:
             g = torch.Generator()
@@ -108,19 +134,206 @@ class DistributedSampler(_DistributedSampler):
             # Otherwise, the next iteration of this sampler will
             # yield the same ordering.
             g.manual_seed(self.epoch + self.seed)
-            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+            indices = torch.randperm(len(self.dataset), generator=g)
         else:
-            indices = torch.arange(len(self.dataset)).tolist()
+            indices = torch.arange(len(self.dataset))
 
         # add extra samples to make it evenly divisible
         # in case that indices is shorter than half of total_size
-        indices = (indices * math.ceil(self.total_size / len(indices)))[
+        indices = indices.repeat(math.ceil(self.total_size / len(indices)))[
             : self.total_size
         ]
         assert len(indices) == self.total_size
 
         # subsample
-        indices = indices[self.rank : self.total_size : self.num_replicas]
+        indices = indices[self.rank : self.total_size : self.num_replicas].clone()
+        assert len(indices) == self.num_samples
+
+        self._indices, self._indices_key = indices, key
+        return indices
+
+    def __iter__(self):
+        indices = self.rank_indices()[self.start_index:]
+        # converted to python ints by chunks, never as a whole list
+        for chunk in indices.split(8192):
+            yield from chunk.tolist()
+
+
+def build_alias_table(weights):
+    """Walker/Vose alias table of a discrete distribution, for O(1) draws:
+    draw k uniformly, keep it with probability `prob[k]`, otherwise take `alias[k]`."""
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(weights)
+    scaled = weights * n / weights.sum()
+    prob = np.ones(n, dtype=np.float64)
+    alias = np.arange(n, dtype=np.int64)
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    return torch.from_numpy(prob), torch.from_numpy(alias)
+
+
+def group_samples(labels):
+    """Groups the samples by label (one row of `labels` per sample, several columns to group by
+    a combination of labels). Returns the group of every sample and the samples of every group as
+    CSR arrays: the samples of group g are order[offsets[g]:offsets[g + 1]]."""
+    labels = np.asarray(labels).reshape(len(labels), -1)
+    _, group_ids = np.unique(labels, axis=0, return_inverse=True)
+    group_ids = group_ids.reshape(-1)
+    order = np.argsort(group_ids, kind="stable")
+    sizes = np.bincount(group_ids)
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    return (torch.from_numpy(group_ids), torch.from_numpy(order),
+            torch.from_numpy(offsets), torch.from_numpy(sizes))
+
+
+class BalancedDistributedSampler(DistributedSampler):
+    """Draws the samples of every rank with replacement so that the groups of `balance_by`
+    ("id", "source", "race", "gender", "age" or a combination such as "race,gender", read from
+    `dataset.get_sample_labels()`) are balanced.
+    A group of n samples is drawn with a probability proportional to n ** (1 - balance_power):
+    0 keeps the natural distribution, 1 draws every group equally often. A draw is O(1): the
+    group from an alias table, then a uniform sample of the group from per-group index arrays.
+    Samples without the label (-1) form their own group. Deterministic for an epoch and seed."""
+
+    def __init__(
+        self,
+        dataset,
+        num_replicas=None,  # world_size
+        rank=None,  # local_rank
+        balance_by="id",
+        balance_power=1.0,
+        seed=0,
+    ):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        if not hasattr(dataset, "get_sample_labels"):
+            raise ValueError(f"{type(dataset).__name__} has no get_sample_labels(), can not balance the samples")
+        sample_labels = dataset.get_sample_labels()
+        names = [name.strip() for name in balance_by.split(",")]
+        for name in names:
+            if name not in sample_labels:
+                raise ValueError(f"can not balance by '{name}', labels of the dataset: {list(sample_labels)}")
+        self.balance_by = balance_by
+        self.balance_power = balance_power
+        self.group_ids, self.order, self.offsets, self.sizes = group_samples(
+            np.stack([sample_labels[name] for name in names], axis=1))
+        self.group_prob, self.group_alias = build_alias_table(self.sizes.double().numpy() ** (1.0 - balance_power))
+        self.epoch_stats = None
+
+    def rank_indices(self):
+        key = (self.epoch, self.seed, self.balance_power)
+        if self._indices_key == key:
+            return self._indices
+        g = torch.Generator()
+        # every rank draws its own samples, from a seed unique for the epoch and the rank
+        g.manual_seed(self.seed + self.epoch * self.num_replicas + self.rank)
+        num_groups = len(self.sizes)
+        k = torch.randint(num_groups, (self.num_samples,), generator=g)
+        keep = torch.rand(self.num_samples, generator=g, dtype=torch.float64) < self.group_prob[k]
+        groups = torch.where(keep, k, self.group_alias[k])
+        offsets = (torch.rand(self.num_samples, generator=g, dtype=torch.float64) * self.sizes[groups]).long()
+        indices = self.order[self.offsets[groups] + offsets]
+
+        self.epoch_stats = self.compute_stats(groups, indices)
+        if self.rank == 0:
+            logging.info(
+                f"Balanced sampler ({self.balance_by}) epoch {self.epoch}: " +
+                ", ".join(f"{name} {value:.4g}" for name, value in self.epoch_stats.items()))
+        self._indices, self._indices_key = indices, key
+        return indices
+
+    def compute_stats(self, groups, indices):
+        draws = torch.bincount(groups, minlength=len(self.sizes)).double()
+        return {
+            "groups": len(self.sizes),
+            "group_draws_min": draws.min().item(),
+            "group_draws_max": draws.max().item(),
+            "group_draws_std/mean": (draws.std() / draws.mean()).item() if len(draws) > 1 else 0.0,
+            "groups_drawn": (draws > 0).double().mean().item(),
+            "unique_samples": torch.unique(indices).numel() / len(indices),
+        }
+
+
+class PKDistributedSampler(DistributedSampler):
+    """Orders the samples of every rank in batches of P identities x K images (`num_instances`),
+    with P = batch_size // K, for in-batch pair, triplet or intra-class terms. Every epoch the
+    identities are shuffled (cycled when the epoch needs more identity slots than identities, no
+    identity twice in a batch) and every identity gets the next K of its shuffled images each time
+    it occurs, so the epoch goes through all of them before repeating one.
+    The images of every identity are picked from per-identity index arrays, in one sort per epoch.
+    The same order is built on every rank from the epoch and seed, each rank takes every
+    num_replicas-th batch. Use it with the same batch_size in the DataLoader and drop_last."""
+
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        num_instances=4,
+        num_replicas=None,  # world_size
+        rank=None,  # local_rank
+        seed=0,
+    ):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        if batch_size % num_instances != 0:
+            raise ValueError(f"batch_size ({batch_size}) must be a multiple of num_instances ({num_instances})")
+        if not hasattr(dataset, "get_sample_labels"):
+            raise ValueError(f"{type(dataset).__name__} has no get_sample_labels(), can not group the identities")
+        self.batch_size = batch_size
+        self.num_instances = num_instances
+        self.num_identities = batch_size // num_instances
+        self.group_ids, self.order, self.offsets, self.sizes = group_samples(dataset.get_sample_labels()["id"])
+        if len(self.sizes) < self.num_identities:
+            raise ValueError(f"{len(self.sizes)} identities, less than the {self.num_identities} of a batch")
+        # whole batches only, the same number on every rank
+        self.num_batches = len(self.dataset) // (self.num_replicas * self.batch_size)
+        self.num_samples = self.num_batches * self.batch_size
+        self.total_size = self.num_samples * self.num_replicas
+
+    def rank_indices(self):
+        key = (self.epoch, self.seed)
+        if self._indices_key == key:
+            return self._indices
+        g = torch.Generator()
+        g.manual_seed(self.epoch + self.seed)
+        num_groups = len(self.sizes)
+
+        # images of every identity in a random order: shuffle, then stable sort by identity
+        perm = torch.randperm(len(self.group_ids), generator=g)
+        order = perm[torch.sort(self.group_ids[perm], stable=True)[1]]
+
+        # identity of every slot of every batch, of all ranks: one permutation of the identities per
+        # cycle, the identities of the batch that spans a cycle boundary are all different
+        num_slots = self.num_batches * self.num_replicas * self.num_identities
+        cycles = []
+        for c in range(math.ceil(num_slots / num_groups)):
+            perm = torch.randperm(num_groups, generator=g)
+            tail = (c * num_groups) % self.num_identities
+            if tail:
+                taken = torch.isin(perm, cycles[-1][-tail:])
+                head = perm[~taken]
+                perm = torch.cat([head[: self.num_identities - tail], perm[taken], head[self.num_identities - tail :]])
+            cycles.append(perm)
+        identities = torch.cat(cycles)[:num_slots]
+        # occurrence of the identity in the epoch (its cycle), the next K of its images every time
+        occurrences = torch.arange(num_slots) // num_groups
+        identities = identities.view(self.num_batches * self.num_replicas, self.num_identities)
+        occurrences = occurrences.view(self.num_batches * self.num_replicas, self.num_identities)
+        identities = identities[self.rank :: self.num_replicas].reshape(-1)
+        occurrences = occurrences[self.rank :: self.num_replicas].reshape(-1)
+
+        # K images per identity, wrapping around the images of the identity
+        instance = occurrences.unsqueeze(1) * self.num_instances + torch.arange(self.num_instances)
+        positions = self.offsets[identities].unsqueeze(1) + instance % self.sizes[identities].unsqueeze(1)
+        indices = order[positions].reshape(-1)
         assert len(indices) == self.num_samples
 
-        return iter(indices)
+        self._indices, self._indices_key = indices, key
+        return indices
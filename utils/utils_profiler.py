@@ -0,0 +1,86 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+class StepProfiler(object):
+    """
+    Opt-in per-phase timings of the training step (e.g. data, h2d, forward, heads, backward, optimizer).
+    On the GPU the phases are recorded with CUDA events, read back only when `summary` is called, so
+    profiling adds no synchronization to the steps; on the CPU the wall clock is used.
+    `record` adds host-side timings (e.g. the dataloader wait) and `gauge` sampled values (e.g. the
+    depth of the prefetch queue). `summary` returns rolling percentiles over the last `window` steps
+    and the peak device memory since the previous summary.
+    Example:
+    --------
+    >>> with profiler.phase("forward"):
+    >>>     local_embeddings = backbone(img)
+    >>> profiler.step()
+    """
+
+    def __init__(self, enabled=True, window=100, percentiles=(50, 90, 99)):
+        self.enabled = enabled
+        self.cuda = torch.cuda.is_available()
+        self.percentiles = percentiles
+        self.steps = deque(maxlen=window)
+        self.current = {}
+
+    @contextmanager
+    def phase(self, name, stream=None):
+        if not self.enabled:
+            yield
+            return
+        if self.cuda:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record(stream)
+            yield
+            end.record(stream)
+            self.current.setdefault(name, []).append((start, end))
+        else:
+            tic = time.perf_counter()
+            yield
+            self.record(name, (time.perf_counter() - tic) * 1000)
+
+    def record(self, name, milliseconds):
+        if self.enabled:
+            self.current.setdefault(name, []).append(milliseconds)
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.current.setdefault(name, []).append(float(value))
+
+    def step(self):
+        if self.enabled and self.current:
+            self.steps.append(self.current)
+            self.current = {}
+
+    @staticmethod
+    def _value(item):
+        if isinstance(item, tuple):
+            start, end = item
+            return start.elapsed_time(end)
+        return item
+
+    def summary(self):
+        """ {"<phase>_p50": ms, ..., "peak_memory_gb": GB}, synchronizes the device once """
+        if not self.enabled or not self.steps:
+            return {}
+        if self.cuda:
+            torch.cuda.synchronize()
+        values = {}
+        for step in self.steps:
+            for name, items in step.items():
+                values.setdefault(name, []).append(sum(self._value(item) for item in items))
+        self.steps.clear()
+
+        stats = {}
+        for name, samples in values.items():
+            for q, value in zip(self.percentiles, np.percentile(samples, self.percentiles)):
+                stats[f"{name}_p{q}"] = float(value)
+        if self.cuda:
+            stats["peak_memory_gb"] = torch.cuda.max_memory_allocated() / 1024 ** 3
+            torch.cuda.reset_peak_memory_stats()
+        return stats
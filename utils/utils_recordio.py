@@ -0,0 +1,219 @@
+import numbers
+import os
+import struct
+from collections import namedtuple
+from mmap import ACCESS_READ, mmap
+
+import cv2
+import numpy as np
+
+# mxnet-free RecordIO: reads and writes the .rec/.idx files of mx.recordio (train.rec of the
+# insightface datasets, im2rec) byte for byte, plus the image decoding of mx.image, e.g.:
+# imgrec = IndexedRecordIO("train.idx", "train.rec", "r")   # the .rec file is memory-mapped
+# header, img = unpack_img(imgrec.read_idx(1))               # RGB uint8 HWC, as mx.image.imdecode
+# See benchmark_recordio.py for the parity and read speed against mxnet.
+
+MAGIC = 0xced7230a
+_MAGIC_BYTES = struct.pack("<I", MAGIC)
+_LENGTH_MASK = (1 << 29) - 1
+_IR_FORMAT = "<IfQQ"
+_IR_SIZE = struct.calcsize(_IR_FORMAT)
+
+# flag: number of float32 labels stored before the payload (0: `label` is the label)
+IRHeader = namedtuple("HEADER", ["flag", "label", "id", "id2"])
+
+
+class RecordIO(object):
+    """
+    Sequential .rec reader/writer, as mx.recordio.MXRecordIO. A record is a magic number, a
+    length word (cflag in the upper 3 bits) and the payload padded to 4 bytes; payloads that
+    contain the magic number are split in parts (cflag 1: first, 2: middle, 3: last) without it.
+    In read mode the file is memory-mapped (`use_mmap`), which also shares it between the
+    DataLoader workers.
+    """
+
+    def __init__(self, uri, flag="r", use_mmap=True):
+        if flag not in ("r", "w"):
+            raise ValueError(f"flag must be 'r' or 'w', not {flag}")
+        self.uri = uri
+        self.flag = flag
+        self.use_mmap = use_mmap
+        self.open()
+
+    def open(self):
+        self.pos = 0
+        self.data = None
+        if self.flag == "w":
+            self.file = open(self.uri, "wb")
+            return
+        self.file = open(self.uri, "rb")
+        if self.use_mmap and os.fstat(self.file.fileno()).st_size > 0:
+            self.data = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # mmaps and files do not pickle, spawned DataLoader workers open the file again
+        state = self.__dict__.copy()
+        state.pop("data")
+        state.pop("file")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def reset(self):
+        self.close()
+        self.open()
+
+    def tell(self):
+        return self.file.tell() if self.flag == "w" else self.pos
+
+    def _read(self, pos, size):
+        if self.data is not None:
+            return self.data[pos:pos + size]
+        self.file.seek(pos)
+        return self.file.read(size)
+
+    def read_at(self, pos):
+        """ (record at byte offset `pos` or None at the end of the file, offset of the next record) """
+        parts = []
+        while True:
+            head = self._read(pos, 8)
+            if len(head) < 8:
+                if parts:
+                    raise ValueError(f"{self.uri}: truncated record at {pos}")
+                return None, pos
+            magic, lrecord = struct.unpack("<II", head)
+            if magic != MAGIC:
+                raise ValueError(f"{self.uri}: invalid RecordIO magic at {pos}")
+            cflag, length = lrecord >> 29, lrecord & _LENGTH_MASK
+            parts.append(self._read(pos + 8, length))
+            pos += 8 + ((length + 3) >> 2 << 2)
+            if cflag in (0, 3):
+                break
+        return parts[0] if len(parts) == 1 else _MAGIC_BYTES.join(parts), pos
+
+    def read(self):
+        record, self.pos = self.read_at(self.pos)
+        return record
+
+    def _write_part(self, cflag, part):
+        self.file.write(struct.pack("<II", MAGIC, (cflag << 29) | len(part)))
+        self.file.write(part)
+        self.file.write(b"\0" * (-len(part) % 4))
+
+    def write(self, buf):
+        if self.flag != "w":
+            raise ValueError(f"{self.uri} is open for reading")
+        buf = bytes(buf)
+        if len(buf) > _LENGTH_MASK:
+            raise ValueError(f"record of {len(buf)} bytes, RecordIO records are < 2 ** 29 bytes")
+        # the magic number is only searched at 4-byte aligned offsets, as dmlc-core
+        words = np.frombuffer(buf, dtype="<u4", count=len(buf) // 4) if len(buf) >= 4 else np.empty(0)
+        splits = np.flatnonzero(words == MAGIC) * 4
+        start = 0
+        for split in splits:
+            self._write_part(1 if start == 0 else 2, buf[start:split])
+            start = split + 4
+        self._write_part(3 if start else 0, buf[start:])
+
+
+class IndexedRecordIO(RecordIO):
+    """ RecordIO with random access through its .idx file (`key`\\t`offset` lines), as mx.recordio.MXIndexedRecordIO """
+
+    def __init__(self, idx_path, uri, flag="r", key_type=int, use_mmap=True):
+        self.idx_path = idx_path
+        self.key_type = key_type
+        super(IndexedRecordIO, self).__init__(uri, flag, use_mmap)
+
+    def open(self):
+        super(IndexedRecordIO, self).open()
+        self.idx = {}
+        self.keys = []
+        if self.flag == "w":
+            self.fidx = open(self.idx_path, "w")
+            return
+        self.fidx = None
+        with open(self.idx_path) as f:
+            for line in f:
+                line = line.strip().split("\t")
+                if len(line) < 2:
+                    continue
+                key = self.key_type(line[0])
+                self.idx[key] = int(line[1])
+                self.keys.append(key)
+
+    def close(self):
+        if self.fidx is not None:
+            self.fidx.close()
+            self.fidx = None
+        super(IndexedRecordIO, self).close()
+
+    def __getstate__(self):
+        state = super(IndexedRecordIO, self).__getstate__()
+        state.pop("fidx")
+        return state
+
+    def read_idx(self, key):
+        return self.read_at(self.idx[key])[0]
+
+    def write_idx(self, key, buf):
+        pos = self.tell()
+        self.write(buf)
+        self.fidx.write("%s\t%d\n" % (str(key), pos))
+        self.idx[key] = pos
+        self.keys.append(key)
+
+
+def pack(header, s):
+    """ Record of an IRHeader and a payload, a non-scalar label goes before the payload, as mx.recordio.pack """
+    header = IRHeader(*header)
+    if isinstance(header.label, numbers.Number):
+        header = header._replace(flag=0)
+    else:
+        label = np.asarray(header.label, dtype=np.float32)
+        header = header._replace(flag=label.size, label=0)
+        s = label.tobytes() + bytes(s)
+    return struct.pack(_IR_FORMAT, *header) + bytes(s)
+
+
+def unpack(s):
+    """ (IRHeader, payload) of a record, the label is a float32 array when header.flag > 0 """
+    header = IRHeader(*struct.unpack(_IR_FORMAT, s[:_IR_SIZE]))
+    s = s[_IR_SIZE:]
+    if header.flag > 0:
+        header = header._replace(label=np.frombuffer(s, dtype=np.float32, count=header.flag))
+        s = s[header.flag * 4:]
+    return header, s
+
+
+def imdecode(buf, to_rgb=True):
+    """ uint8 HWC image of an encoded (JPEG, PNG) buffer, RGB as mx.image.imdecode """
+    img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("the buffer is not a decodable image")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB) if to_rgb else img
+
+
+def unpack_img(s, to_rgb=True):
+    header, img = unpack(s)
+    return header, imdecode(img, to_rgb)
+
+
+def resize_short(img, size, interpolation=cv2.INTER_CUBIC):
+    """ Resizes the shorter edge of an HWC image to `size`, as mx.image.resize_short (its interp=2 is cv2's bicubic) """
+    h, w = img.shape[:2]
+    new_h, new_w = (size * h // w, size) if h > w else (size, size * w // h)
+    return cv2.resize(img, (new_w, new_h), interpolation=interpolation)